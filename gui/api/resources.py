@@ -37,7 +37,7 @@ from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.forms.models import inlineformset_factory
-from django.http import HttpResponse, QueryDict
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
 from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
 
@@ -58,6 +58,7 @@ from freenasUI.network.forms import AliasForm
 from freenasUI.network.models import Alias, Interfaces
 from freenasUI.plugins import availablePlugins, Plugin
 from freenasUI.plugins.models import Plugins
+from freenasUI.reporting import rrd
 from freenasUI.services.forms import iSCSITargetPortalIPForm
 from freenasUI.services.models import iSCSITargetPortal, iSCSITargetPortalIP
 from freenasUI.sharing.models import NFS_Share, NFS_Share_Path
@@ -69,7 +70,7 @@ from freenasUI.storage.models import Disk, Replication
 from freenasUI.system.alert import alertPlugins, Alert
 from tastypie import fields
 from tastypie.http import (
-    HttpAccepted,
+    HttpAccepted, HttpBadRequest,
     HttpCreated, HttpMethodNotAllowed, HttpMultipleChoices, HttpNotFound
 )
 from tastypie.exceptions import ImmediateHttpResponse
@@ -160,6 +161,85 @@ class AlertResource(DojoResource):
         return bundle
 
 
+class ReportingExportResource(DojoResource):
+    """
+    Time series of the reporting graphs as JSON, see rrd.xport_json
+
+    Query:
+        metric - "plugin" or "plugin:identifier", may be repeated; every
+                 identifier of the plugin is exported if none is given
+        unit, step - time span, as for the reporting graphs
+        start, end - time span as unix timestamps, instead of unit/step
+        maxpoints - downsample to at most this many rows per metric
+    """
+
+    class Meta:
+        allowed_methods = ['get']
+        resource_name = 'reporting/export'
+        object_class = object
+
+    def prepend_urls(self):
+        return [
+            url(
+                r"^(?P<resource_name>%s)%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('export'),
+                name="api_reporting_export"
+            ),
+        ]
+
+    def _metrics(self, request):
+        plugins = []
+        unit = request.GET.get('unit', 'hourly')
+        if unit not in ('hourly', 'daily', 'weekly', 'monthly', 'yearly'):
+            raise ValueError("Invalid unit: %s" % unit)
+        step = int(request.GET.get('step', 0))
+        for metric in request.GET.getlist('metric'):
+            name, identifier = (metric.split(':', 1) + [None])[:2]
+            klass = rrd.name2plugin.get(name)
+            if klass is None:
+                raise ValueError("Unknown metric: %s" % name)
+            ids = klass(rrd.RRD_BASE_PATH).get_identifiers()
+            if ids is None:
+                ids = [None]
+            elif identifier is not None:
+                if identifier not in ids:
+                    raise ValueError("Unknown identifier: %s" % metric)
+                ids = [identifier]
+            for ident in ids:
+                plugins.append(klass(
+                    base_path=rrd.RRD_BASE_PATH,
+                    unit=unit,
+                    step=step,
+                    identifier=ident,
+                ))
+        if not plugins:
+            raise ValueError("No metric given")
+        return plugins
+
+    def export(self, request, **kwargs):
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            plugins = self._metrics(request)
+            kwargs = {}
+            for name in ('maxpoints', 'start', 'end'):
+                value = request.GET.get(name)
+                if value:
+                    kwargs[name] = int(value)
+        except ValueError, e:
+            raise ImmediateHttpResponse(response=HttpBadRequest(str(e)))
+
+        self.log_throttled_access(request)
+        return StreamingHttpResponse(
+            rrd.xport_json(plugins, **kwargs),
+            content_type='application/json',
+        )
+
+
 class DiskResourceMixin(object):
 
     class Meta:
@@ -907,6 +987,7 @@ class ReplicationResourceMixin(object):
     def dehydrate(self, bundle):
         bundle = super(ReplicationResourceMixin, self).dehydrate(bundle)
         bundle.data['repl_status'] = bundle.obj.status
+        bundle.data['repl_stats'] = bundle.obj.repl_laststats
         bundle.data['repl_remote_hostname'] = (
             bundle.obj.repl_remote.ssh_remote_hostname
         )
@@ -1618,6 +1699,39 @@ class JailTemplateResourceMixin(object):
         return bundle
 
 
+class SnapshotList(object):
+    """
+    Lazy sequence of snapshots handed to the paginator so only
+    the requested page is fetched from the snapshot index
+    """
+
+    def __init__(self, **query):
+        self._query = query
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = notifier().zfs_snapshot_query(
+                limit=0, **self._query
+            )[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError("Only slices are supported")
+        offset = item.start or 0
+        limit = None
+        if item.stop is not None:
+            limit = max(item.stop - offset, 0)
+        self._count, snaps = notifier().zfs_snapshot_query(
+            offset=offset, limit=limit, **self._query
+        )
+        return snaps
+
+
 class SnapshotResource(DojoResource):
 
     id = fields.CharField(attribute='filesystem')
@@ -1635,33 +1749,42 @@ class SnapshotResource(DojoResource):
         resource_name = 'storage/snapshot'
 
     def get_list(self, request, **kwargs):
-        snapshots = notifier().zfs_snapshot_list()
-        results = []
-        for snaps in snapshots.values():
-            results.extend(snaps)
         FIELD_MAP = {
-            'used': 'used_bytes',
-            'refer': 'refer_bytes',
+            'name': 'name',
+            'fullname': 'name',
+            'used': 'used',
+            'refer': 'refer',
+            'creation': 'creation',
+            'mostrecent': 'mostrecent',
             'extra': 'mostrecent',
         }
 
-        # Get a list of snapshots in remote sides to show whether it has been
-        # transfered already or not
-        self._repl = {}
-        for repl in Replication.objects.all():
-            self._repl[repl] = notifier().repl_remote_snapshots(repl)
+        query = {}
+        for key in ('dataset', 'prefix', 'state'):
+            if request.GET.get(key):
+                query[key] = request.GET.get(key).encode('utf8')
+        if request.GET.get('recursive') in ('0', 'false'):
+            query['recursive'] = False
+        for key in ('since', 'until'):
+            if request.GET.get(key):
+                try:
+                    query[key] = int(request.GET.get(key))
+                except ValueError:
+                    raise ImmediateHttpResponse(
+                        response=self.error_response(request, {
+                            key: _('Expected seconds since the epoch'),
+                        })
+                    )
 
-        for sfield in self._apply_sorting(request.GET):
+        # Only the first sort field is honored, it is pushed down
+        # to the snapshot index
+        for sfield in self._apply_sorting(request.GET)[:1]:
             if sfield.startswith('-'):
-                field = sfield[1:]
-                reverse = True
-            else:
-                field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            results.sort(
-                key=lambda item: getattr(item, field),
-                reverse=reverse)
+                query['reverse'] = True
+                sfield = sfield[1:]
+            query['order'] = FIELD_MAP.get(sfield)
+
+        results = SnapshotList(**query)
         paginator = self._meta.paginator_class(
             request,
             results,
@@ -1671,10 +1794,24 @@ class SnapshotResource(DojoResource):
             collection_name=self._meta.collection_name,
         )
         to_be_serialized = paginator.page()
+        page = to_be_serialized[self._meta.collection_name]
+
+        # Get a list of snapshots in remote sides to show whether it has been
+        # transfered already or not, only for the datasets in this page
+        self._repl = {}
+        filesystems = set(snap.filesystem for snap in page)
+        for repl in Replication.objects.all():
+            for fs in filesystems:
+                if fs == repl.repl_filesystem or fs.startswith(
+                    repl.repl_filesystem + '/'
+                ):
+                    self._repl[repl] = notifier().repl_remote_snapshots(repl)
+                    break
+
         # Dehydrate the bundles in preparation for serialization.
         bundles = []
 
-        for obj in to_be_serialized[self._meta.collection_name]:
+        for obj in page:
             bundle = self.build_bundle(obj=obj, request=request)
             bundles.append(self.full_dehydrate(bundle))
 
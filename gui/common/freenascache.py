@@ -25,11 +25,19 @@
 #
 #####################################################################
 
-import os
+import atexit
+import contextlib
 import cPickle as pickle
+import grp
 import logging
+import marshal
+import os
+import pwd
+import sqlite3
+import struct
+import threading
+import weakref
 
-from bsddb3 import db
 from freenasUI.common.system import (
     get_freenas_var,
     ldap_enabled,
@@ -92,28 +100,206 @@ FLAGS_CACHE_WRITE_GROUP  = 0x00000008
 FLAGS_CACHE_READ_QUERY   = 0x00000010
 FLAGS_CACHE_WRITE_QUERY  = 0x00000020
 
+#
+# On disk every cache is a single SQLite table.  Records are stored in a
+# compact tagged binary form (one type byte followed by a marshal payload)
+# instead of pickles, and the fields we look entries up by are copied into
+# indexed columns when the record is written.
+#
+FREENAS_CACHEFILE = ".cache.sqlite"
+FREENAS_CACHEVERSION = 1
+
+#
+# Rows fetched per query while iterating a cache.
+#
+FREENAS_CACHECHUNK = 512
+
+RECORD_PASSWD = 'P'
+RECORD_GROUP = 'G'
+RECORD_ENTRY = 'E'
+RECORD_MARSHAL = 'M'
+RECORD_PICKLE = 'K'
+
+CACHE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        name TEXT COLLATE NOCASE,
+        uid INTEGER,
+        gid INTEGER,
+        sid TEXT,
+        data BLOB NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS cache_name ON cache (name)",
+    "CREATE INDEX IF NOT EXISTS cache_uid ON cache (uid)",
+    "CREATE INDEX IF NOT EXISTS cache_gid ON cache (gid)",
+    "CREATE INDEX IF NOT EXISTS cache_sid ON cache (sid)",
+)
+
+CACHE_INDEXES = ('name', 'uid', 'gid', 'sid')
+
+_open_caches = weakref.WeakSet()
+
+
+def sid_to_string(sid):
+    """Convert a binary objectSid to its S-1-5-... string form"""
+    if not sid or len(sid) < 8:
+        return None
+
+    revision = ord(sid[0])
+    count = ord(sid[1])
+    authority = struct.unpack('>Q', '\0\0' + sid[2:8])[0]
+    if len(sid) < 8 + 4 * count:
+        return None
+
+    subauths = struct.unpack('<%dI' % count, sid[8:8 + 4 * count])
+    return 'S-%d-%d%s' % (
+        revision,
+        authority,
+        ''.join(['-%d' % s for s in subauths]),
+    )
+
+
+def _first(attrs, *names):
+    for name in names:
+        value = attrs.get(name)
+        if value:
+            return value[0]
+    return None
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_entry(value):
+    return (
+        isinstance(value, tuple) and len(value) == 2 and
+        isinstance(value[0], basestring) and isinstance(value[1], dict)
+    )
+
+
+def encode_record(value):
+    """
+    Encode a cache value
+
+    Returns the record bytes and the (name, uid, gid, sid) index tuple.
+    """
+    name = uid = gid = sid = None
+
+    if isinstance(value, pwd.struct_passwd):
+        tag, payload = RECORD_PASSWD, tuple(value)
+        name, uid, gid = value.pw_name, value.pw_uid, value.pw_gid
+
+    elif isinstance(value, grp.struct_group):
+        tag, payload = RECORD_GROUP, tuple(value)
+        name, gid = value.gr_name, value.gr_gid
+
+    elif _is_entry(value):
+        tag, payload = RECORD_ENTRY, value
+        attrs = value[1]
+        name = _first(attrs, 'sAMAccountName', 'uid', 'cn')
+        uid = _int_or_none(_first(attrs, 'uidNumber'))
+        gid = _int_or_none(_first(attrs, 'gidNumber'))
+        sid = sid_to_string(_first(attrs, 'objectSid'))
+
+    else:
+        tag, payload = RECORD_MARSHAL, value
+
+    try:
+        data = tag + marshal.dumps(payload, 2)
+    except ValueError:
+        data = RECORD_PICKLE + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    return data, (name, uid, gid, sid)
+
+
+def decode_record(data):
+    data = str(data)
+    tag, payload = data[0], data[1:]
+
+    if tag == RECORD_PICKLE:
+        return pickle.loads(payload)
+
+    value = marshal.loads(payload)
+    if tag == RECORD_PASSWD:
+        return pwd.struct_passwd(value)
+    elif tag == RECORD_GROUP:
+        return grp.struct_group(value)
+    return value
+
+
+def _sync_all():
+    for cache in list(_open_caches):
+        try:
+            cache.sync()
+        except sqlite3.Error:
+            pass
+
+atexit.register(_sync_all)
+
+
 class FreeNAS_BaseCache(object):
     def __init__(self, cachedir=FREENAS_CACHEDIR):
         log.debug("FreeNAS_BaseCache._init__: enter")
 
         self.cachedir = cachedir
-        self.__cachefile = os.path.join(self.cachedir, ".cache.db")
+        self.__cachefile = os.path.join(self.cachedir, FREENAS_CACHEFILE)
 
         if not self.__dir_exists(self.cachedir):
             os.makedirs(self.cachedir)
 
-        self.__dbenv = db.DBEnv()
-        self.__dbenv.open(self.cachedir,
-            db.DB_INIT_CDB | db.DB_INIT_MPOOL | db.DB_CREATE, 0700)
-
-        self.__cache = db.DB(self.__dbenv)
-        self.__cache.open(self.__cachefile, None, db.DB_BTREE, db.DB_CREATE)
+        self.__lock = threading.RLock()
+        self.__pending = 0
+        self.__intransaction = False
+        self.__cache = self.__open()
+        _open_caches.add(self)
 
         log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
         log.debug("FreeNAS_BaseCache._init__: cachefile = %s",
             self.__cachefile)
         log.debug("FreeNAS_BaseCache._init__: leave")
 
+    def __open(self):
+        conn = sqlite3.connect(
+            self.__cachefile, timeout=30, check_same_thread=False
+        )
+        conn.text_factory = str
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA journal_mode = WAL")
+
+        #
+        # The schema is created along with the format version, so a
+        # matching version means there is nothing to do. Otherwise check
+        # again under an explicit write lock, so two processes opening a
+        # fresh cache don't trip over each other.
+        #
+        conn.isolation_level = None
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != FREENAS_CACHEVERSION:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version != FREENAS_CACHEVERSION:
+                    log.debug("FreeNAS_BaseCache.__open: cache format %d, "
+                        "recreating", version)
+                    conn.execute("DROP TABLE IF EXISTS cache")
+                    for sql in CACHE_SCHEMA:
+                        conn.execute(sql)
+                    conn.execute(
+                        "PRAGMA user_version = %d" % FREENAS_CACHEVERSION
+                    )
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                conn.close()
+                raise
+        conn.isolation_level = ""
+
+        return conn
+
     def __dir_exists(self, path):
         path_exists = False
         try:
@@ -125,75 +311,250 @@ class FreeNAS_BaseCache(object):
 
         return path_exists
 
+    def __execute(self, sql, args=()):
+        with self.__lock:
+            return self.__cache.execute(sql, args).fetchall()
+
+    def __commit(self):
+        self.__cache.commit()
+        self.__pending = 0
+
+    def __put(self, key, value, overwrite):
+        data, index = encode_record(value)
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+
+        #
+        # Outside of transaction() every write is committed right away,
+        # an open write transaction would hold off every other writer of
+        # the cache, in this process or another one.
+        #
+        with self.__lock:
+            self.__cache.execute(
+                verb + " INTO cache (key, name, uid, gid, sid, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, ) + index + (buffer(data), )
+            )
+            self.__pending += 1
+            if not self.__intransaction:
+                self.__commit()
+
+    def __scan(self, columns, where="", args=(), limit=None):
+        """
+        Walk the rows matching `where' in key order, FREENAS_CACHECHUNK
+        rows at a time, so the whole cache is never held in memory.
+        """
+        last = None
+        while True:
+            chunk = FREENAS_CACHECHUNK
+            if limit is not None:
+                chunk = min(chunk, limit)
+                if chunk <= 0:
+                    return
+
+            clauses = [where] if where else []
+            params = list(args)
+            if last is not None:
+                clauses.append("key > ?")
+                params.append(last)
+            sql = "SELECT key, %s FROM cache" % columns
+            if clauses:
+                sql += " WHERE " + " AND ".join(clauses)
+            sql += " ORDER BY key LIMIT %d" % chunk
+
+            rows = self.__execute(sql, params)
+            for row in rows:
+                yield row
+            if len(rows) < chunk:
+                return
+
+            last = rows[-1][0]
+            if limit is not None:
+                limit -= len(rows)
+
     def __len__(self):
-        return len(self.__cache)
+        return self.__execute("SELECT COUNT(*) FROM cache")[0][0]
 
     def __iter__(self):
-        for key in sorted(self.__cache.keys()):
-            obj = pickle.loads(self.__cache[key])
-            yield obj
+        return self.itervalues()
+
+    def __contains__(self, key):
+        return self.has_key(key)
 
     def __getitem__(self, key):
-        return pickle.loads(self.__cache.get(key))
+        rows = self.__execute("SELECT data FROM cache WHERE key = ?", (key, ))
+        if not rows:
+            raise KeyError(key)
+        return decode_record(rows[0][0])
 
     def __setitem__(self, key, value, overwrite=False):
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(value)
+        self.__put(key, value, overwrite)
 
     def has_key(self, key):
-        return self.__cache.has_key(key)
+        return bool(
+            self.__execute("SELECT 1 FROM cache WHERE key = ?", (key, ))
+        )
+
+    def iterkeys(self):
+        for row in self.__scan("1"):
+            yield row[0]
+
+    def itervalues(self):
+        for row in self.__scan("data"):
+            yield decode_record(row[1])
+
+    def iteritems(self):
+        for row in self.__scan("data"):
+            yield (row[0], decode_record(row[1]))
 
     def keys(self):
-        return self.__cache.keys()
+        return list(self.iterkeys())
 
     def values(self):
-        cache_values = []
-        for key in self.__cache.keys():
-            cache_values.append(pickle.loads(self.__cache[key]))
-        return cache_values
+        return list(self.itervalues())
 
     def items(self):
-        cache_items = []
-        for key in self.__cache.keys():
-            cache_items.append((key, pickle.loads(self.__cache[key])))
-        return cache_items
+        return list(self.iteritems())
+
+    def find_items(self, **kwargs):
+        """
+        Iterate over the (key, entry) pairs matching all of the given
+        index fields (name, uid, gid, sid), in key order
+        """
+        clauses, args = [], []
+        for field in CACHE_INDEXES:
+            if field in kwargs:
+                clauses.append("%s = ?" % field)
+                args.append(kwargs.pop(field))
+        if kwargs:
+            raise TypeError("Unknown cache index: %s" % ", ".join(kwargs))
+
+        for row in self.__scan("data", " AND ".join(clauses), args):
+            yield (row[0], decode_record(row[1]))
+
+    def find(self, **kwargs):
+        for key, entry in self.find_items(**kwargs):
+            yield entry
+
+    def __find_one(self, **kwargs):
+        for entry in self.find(**kwargs):
+            return entry
+        return None
+
+    def get_by_name(self, name):
+        return self.__find_one(name=name)
+
+    def get_by_uid(self, uid):
+        return self.__find_one(uid=uid)
+
+    def get_by_gid(self, gid):
+        return self.__find_one(gid=gid)
+
+    def get_by_sid(self, sid):
+        return self.__find_one(sid=sid)
+
+    def search(self, prefix, limit=None):
+        """
+        Iterate over the entries whose name starts with `prefix'
+        (case insensitive), in key order
+        """
+        if not prefix:
+            for entry in self.itervalues():
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield entry
+            return
+
+        #
+        # A range over the NOCASE name index rather than LIKE, so SQLite
+        # can seek straight to the first match.
+        #
+        where = "name >= ? AND name < ?"
+        args = (prefix, prefix + '\xf4\x8f\xbf\xbf')
+        for row in self.__scan("data", where, args, limit=limit):
+            yield decode_record(row[1])
 
     def empty(self):
-        return (len(self.__cache) == 0)
+        return not self.__execute("SELECT 1 FROM cache LIMIT 1")
 
     def expire(self):
-        for key in self.__cache.keys():
-            self.__cache.delete(key)
-        self.__cache.close()
-        os.unlink(self.__cachefile)
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.__cachefile + suffix)
+            except OSError:
+                pass
 
     def read(self, key):
         if not key:
             return None
 
-        pobj = pickle.loads(self.__cache[key])
-        return pobj
+        return self[key]
 
     def write(self, key, entry, overwrite=False):
         if not key:
             return False
 
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(entry)
-
+        self.__put(key, entry, overwrite)
         return True
 
     def delete(self, key):
         if not key:
             return False
 
-        self.__cache.delete(key)
+        with self.__lock:
+            self.__cache.execute("DELETE FROM cache WHERE key = ?", (key, ))
+            if self.__intransaction:
+                self.__pending += 1
+            else:
+                self.__commit()
         return True
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group writes so other readers see either none or all of them.
+        Nothing is committed until the block exits; an exception rolls
+        the whole block back.
+        """
+        with self.__lock:
+            if self.__intransaction:
+                yield self
+                return
+
+            self.sync()
+            self.__intransaction = True
+            try:
+                yield self
+            except:
+                self.__cache.rollback()
+                self.__pending = 0
+                raise
+            else:
+                self.__commit()
+            finally:
+                self.__intransaction = False
+
+    def sync(self):
+        with self.__lock:
+            if self.__pending:
+                self.__commit()
+
     def close(self):
-        self.__cache.close()
+        with self.__lock:
+            if self.__cache is None:
+                return
+            self.__commit()
+            self.__cache.close()
+            self.__cache = None
+        _open_caches.discard(self)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
@@ -26,14 +26,17 @@
 #####################################################################
 import grp
 import hashlib
+import json
 import ldap
 import logging
 import os
 import pwd
+import threading
+import time
 import types
 
 from dns import resolver
-from ldap.controls import SimplePagedResultsControl
+from ldap.controls import LDAPControl, SimplePagedResultsControl
 
 from freenasUI.common.system import (
     get_freenas_var,
@@ -65,6 +68,24 @@ FREENAS_LDAP_CACERTFILE = get_freenas_var("CERT_FILE")
 
 FREENAS_LDAP_PAGESIZE = get_freenas_var("FREENAS_LDAP_PAGESIZE", 1024)
 
+#
+# Bound connections kept per server/credentials, how long an idle one is
+# kept around and after how long idle it is checked before being reused
+#
+FREENAS_LDAP_POOL_SIZE = int(get_freenas_var("FREENAS_LDAP_POOL_SIZE", 4))
+FREENAS_LDAP_POOL_IDLE = int(get_freenas_var("FREENAS_LDAP_POOL_IDLE", 300))
+FREENAS_LDAP_POOL_CHECK = int(get_freenas_var("FREENAS_LDAP_POOL_CHECK", 30))
+
+#
+# Per directory cache high-water mark used by the incremental sync
+#
+FREENAS_LDAP_SYNCFILE = ".sync"
+
+#
+# LDAP_SERVER_SHOW_DELETED_OID, lets the sync see AD tombstones
+#
+FREENAS_AD_SHOW_DELETED = "1.2.840.113556.1.4.417"
+
 ldap.protocol_version = FREENAS_LDAP_VERSION
 ldap.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
 
@@ -80,6 +101,93 @@ class FreeNAS_LDAP_Exception(FreeNAS_LDAP_Directory_Exception):
     pass
 
 
+class FreeNAS_LDAP_Pool(object):
+    """
+    Process wide pool of bound LDAP handles.
+
+    Handles are keyed by uri, ssl mode and credentials. A handle is owned
+    by one directory object between open() and close(), after that it
+    waits in the pool for the next open() with the same key.
+    """
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
+            return cls.__instance
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__idle = {}
+
+    def _alive(self, handle):
+        try:
+            handle.search_ext_s('', ldap.SCOPE_BASE, '(objectclass=*)',
+                ['1.1'], timeout=5)
+            return True
+        except ldap.LDAPError, e:
+            log.debug("FreeNAS_LDAP_Pool._alive: %s", e)
+            return False
+
+    def acquire(self, key, connect):
+        """
+        Return an idle handle for ``key`` or a new one from ``connect``
+        """
+        now = time.time()
+        while True:
+            with self.__lock:
+                idle = self.__idle.get(key)
+                if not idle:
+                    break
+                handle, since = idle.pop()
+
+            if now - since > FREENAS_LDAP_POOL_IDLE:
+                self.discard(handle)
+            elif now - since > FREENAS_LDAP_POOL_CHECK and \
+                not self._alive(handle):
+                self.discard(handle)
+            else:
+                log.debug("FreeNAS_LDAP_Pool.acquire: reusing handle")
+                return handle
+
+        return connect()
+
+    def release(self, key, handle):
+        if handle is None:
+            return
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < FREENAS_LDAP_POOL_SIZE:
+                idle.append((handle, time.time()))
+                return
+        self.discard(handle)
+
+    def discard(self, handle):
+        with self.__lock:
+            for idle in self.__idle.values():
+                for entry in idle:
+                    if entry[0] is handle:
+                        idle.remove(entry)
+                        break
+        try:
+            handle.unbind()
+        except ldap.LDAPError:
+            pass
+
+    def clear(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for handles in idle.values():
+            for handle, since in handles:
+                try:
+                    handle.unbind()
+                except ldap.LDAPError:
+                    pass
+
+
 class FreeNAS_LDAP_Directory(object):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_Directory.__init__: enter")
@@ -120,6 +228,7 @@ class FreeNAS_LDAP_Directory(object):
 
         self._handle = None
         self._isopen = False
+        self._key = None
         self._cache = FreeNAS_LDAP_QueryCache()
         self._settings = []
 
@@ -135,10 +244,14 @@ class FreeNAS_LDAP_Directory(object):
     def _save(self):
         _s = {}
         _s.update(self.__dict__)
+        # The handle is not ours to keep once it is back in the pool
+        for k in ('_handle', '_isopen', '_key'):
+            _s.pop(k, None)
         self._settings.append(_s)
 
     def _restore(self):
         if self._settings:
+            self.close()
             _s = self._settings.pop()
             self.__dict__.update(_s)
 
@@ -187,83 +300,121 @@ class FreeNAS_LDAP_Directory(object):
         uri = "%s://%s:%d" % (proto, self.host, self.port)
         return uri
 
-    def open(self):
-        log.debug("FreeNAS_LDAP_Directory.open: enter")
+    def _connect(self):
+        """
+        Create a new bound handle, None if it could not be bound
+        """
+        log.debug("FreeNAS_LDAP_Directory._connect: enter")
 
-        if self._isopen:
-            return True
+        uri = self._geturi()
+        log.debug("FreeNAS_LDAP_Directory._connect: uri = %s", uri)
 
-        if self.host:
-            uri = self._geturi()
-            log.debug("FreeNAS_LDAP_Directory.open: uri = %s", uri)
+        handle = ldap.initialize(uri)
+        log.debug("FreeNAS_LDAP_Directory._connect: initialized")
 
-            self._handle = ldap.initialize(self._geturi())
-            log.debug("FreeNAS_LDAP_Directory.open: initialized")
+        res = None
+        handle.protocol_version = FREENAS_LDAP_VERSION
+        handle.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
+        handle.set_option(ldap.OPT_NETWORK_TIMEOUT, 10.0)
 
-        if self._handle:
-            res = None
-            self._handle.protocol_version = FREENAS_LDAP_VERSION
-            self._handle.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
-            self._handle.set_option(ldap.OPT_NETWORK_TIMEOUT, 10.0)
+        if self.ssl in (FREENAS_LDAP_USESSL, FREENAS_LDAP_USETLS):
+            handle.set_option(ldap.OPT_X_TLS_ALLOW, 1)
+            handle.set_option(ldap.OPT_X_TLS_CACERTFILE, FREENAS_LDAP_CACERTFILE)
+            handle.set_option(ldap.OPT_X_TLS_NEWCTX, ldap.OPT_X_TLS_DEMAND)
 
-            if self.ssl in (FREENAS_LDAP_USESSL, FREENAS_LDAP_USETLS):
-                self._handle.set_option(ldap.OPT_X_TLS_ALLOW, 1)
-                self._handle.set_option(ldap.OPT_X_TLS_CACERTFILE, FREENAS_LDAP_CACERTFILE)
-                self._handle.set_option(ldap.OPT_X_TLS_NEWCTX, ldap.OPT_X_TLS_DEMAND)
+        if self.ssl == FREENAS_LDAP_USETLS:
+            try:
+                handle.start_tls_s()
+                log.debug("FreeNAS_LDAP_Directory._connect: started TLS")
 
-            if self.ssl == FREENAS_LDAP_USETLS:
-                try:
-                    self._handle.start_tls_s()
-                    log.debug("FreeNAS_LDAP_Directory.open: started TLS")
+            except ldap.LDAPError, e:
+                self._logex(e)
+                pass
 
-                except ldap.LDAPError, e:
-                    self._logex(e)
-                    pass
+        if self.binddn and self.bindpw:
+            try:
+                log.debug("FreeNAS_LDAP_Directory._connect: "
+                    "trying to bind to %s:%d", self.host, self.port)
+                res = handle.simple_bind_s(self.binddn, self.bindpw)
+                log.debug("FreeNAS_LDAP_Directory._connect: binded")
+
+            except ldap.LDAPError, e:
+                log.debug("FreeNAS_LDAP_Directory._connect: "
+                    "coud not bind to %s:%d", self.host, self.port)
+                self._logex(e)
+                res = None
+        else:
+            try:
+                log.debug("FreeNAS_LDAP_Directory._connect: "
+                    "(anonymous bind) trying to bind to %s:%d", self.host, self.port)
+                res = handle.simple_bind_s()
+                log.debug("FreeNAS_LDAP_Directory._connect: binded")
+
+            except ldap.LDAPError, e:
+                log.debug("FreeNAS_LDAP_Directory._connect: "
+                    "coud not bind to %s:%d", self.host, self.port)
+                self._logex(e)
+                res = None
+
+        if not res:
+            try:
+                handle.unbind()
+            except ldap.LDAPError:
+                pass
+            handle = None
 
-            if self.binddn and self.bindpw:
-                try:
-                    log.debug("FreeNAS_LDAP_Directory.open: "
-                        "trying to bind to %s:%d", self.host, self.port)
-                    res = self._handle.simple_bind_s(self.binddn, self.bindpw)
-                    log.debug("FreeNAS_LDAP_Directory.open: binded")
-
-                except ldap.LDAPError, e:
-                    log.debug("FreeNAS_LDAP_Directory.open: "
-                        "coud not bind to %s:%d", self.host, self.port)
-                    self._logex(e)
-                    res = None
-            else:
-                try:
-                    log.debug("FreeNAS_LDAP_Directory.open: "
-                        "(anonymous bind) trying to bind to %s:%d", self.host, self.port)
-                    res = self._handle.simple_bind_s()
-                    log.debug("FreeNAS_LDAP_Directory.open: binded")
+        log.debug("FreeNAS_LDAP_Directory._connect: leave")
+        return handle
 
-                except ldap.LDAPError, e:
-                    log.debug("FreeNAS_LDAP_Directory.open: "
-                        "coud not bind to %s:%d", self.host, self.port)
-                    self._logex(e)
-                    res = None
+    def _poolkey(self):
+        m = hashlib.sha256()
+        m.update(self.bindpw or '')
+        return (self._geturi(), self.ssl, self.binddn, m.hexdigest())
 
-            if res:
-                self._isopen = True
-                log.debug("FreeNAS_LDAP_Directory.open: connection open")
+    def open(self):
+        log.debug("FreeNAS_LDAP_Directory.open: enter")
+
+        if self._isopen:
+            return True
+
+        if self.host:
+            #
+            # The key is kept aside, host and port may be changed before
+            # the handle goes back to the pool in close()
+            #
+            self._key = self._poolkey()
+            self._handle = FreeNAS_LDAP_Pool.get().acquire(
+                self._key, self._connect)
+
+        if self._handle:
+            self._isopen = True
+            log.debug("FreeNAS_LDAP_Directory.open: connection open")
 
         log.debug("FreeNAS_LDAP_Directory.open: leave")
         return (self._isopen == True)
 
     def unbind(self):
         if self._handle:
-            self._handle.unbind()
+            FreeNAS_LDAP_Pool.get().discard(self._handle)
+            self._handle = None
+            self._isopen = False
             log.debug("FreeNAS_LDAP_Directory.unbind: unbind")
 
     def close(self):
         if self._isopen:
-            self.unbind()
+            FreeNAS_LDAP_Pool.get().release(self._key, self._handle)
             self._handle = None
             self._isopen = False
             log.debug("FreeNAS_LDAP_Directory.close: connection closed")
 
+    def _reconnect(self):
+        """
+        Throw away a handle the server has dropped and get another one
+        """
+        log.debug("FreeNAS_LDAP_Directory._reconnect: server down, reconnecting")
+        self.unbind()
+        return self.open()
+
     def _search(self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None, attributes=None,
         attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
         log.debug("FreeNAS_LDAP_Directory._search: enter")
@@ -271,16 +422,10 @@ class FreeNAS_LDAP_Directory(object):
         if not self._isopen:
             return None
 
-        #
-        # XXX
-        # For some reason passing attributes causes paged search results to hang/fail
-        # after a a certain numbe of pages. I can't figure out why. This is a workaround.
-        # XXX
-        #
-        attributes = None
-
         m = hashlib.sha256()
         m.update(filter + self.host + str(self.port) + (basedn if basedn else ''))
+        if attributes:
+            m.update(','.join(attributes))
         key = m.hexdigest()
         m = None
 
@@ -288,96 +433,83 @@ class FreeNAS_LDAP_Directory(object):
             log.debug("FreeNAS_LDAP_Directory._search: query in cache")
             return self._cache[key]
 
-        result = []
-        results = []
-        paged = SimplePagedResultsControl(
-            True,
-            size=self.pagesize,
-            cookie=''
-        )
+        result = list(self._search_iter(basedn, scope, filter, attributes,
+            attrsonly=attrsonly, serverctrls=serverctrls,
+            clientctrls=clientctrls, timeout=timeout, sizelimit=sizelimit))
 
-        paged_ctrls = {
-            SimplePagedResultsControl.controlType: SimplePagedResultsControl,
-        }
+        if self.pagesize <= 0:
+            self._cache[key] = result
+
+        log.debug("FreeNAS_LDAP_Directory._search: %d results", len(result))
+        log.debug("FreeNAS_LDAP_Directory._search: leave")
+        return result
+
+    def _search_iter(self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None,
+        attributes=None, attrsonly=0, serverctrls=None, clientctrls=None,
+        timeout=-1, sizelimit=0):
+        """
+        Search yielding (dn, attrs) entries as they come in.
+
+        With a pagesize set the search is paged and only one page is
+        held in memory at a time. ``attributes`` limits what the server
+        sends back for each entry.
+        """
+        log.debug("FreeNAS_LDAP_Directory._search_iter: enter")
+        if not self._isopen:
+            return
+
+        if attributes:
+            attributes = [str(a) for a in attributes]
 
         if self.pagesize > 0:
-            log.debug("FreeNAS_LDAP_Directory._search: pagesize = %d",
+            log.debug("FreeNAS_LDAP_Directory._search_iter: pagesize = %d",
                 self.pagesize)
+            for page in self._search_pages(basedn, scope, filter, attributes,
+                serverctrls):
+                for entry in page:
+                    yield entry
+            log.debug("FreeNAS_LDAP_Directory._search_iter: leave")
+            return
 
-            page = 0
-            while True:
-                log.debug("FreeNAS_LDAP_Directory._search: getting page %d",
-                    page)
-                serverctrls = [paged]
+        log.debug("FreeNAS_LDAP_Directory._search_iter: pagesize = 0")
 
+        retry = True
+        while True:
+            try:
                 id = self._handle.search_ext(
-                   basedn,
-                   scope,
-                   filterstr=filter,
-                   attrlist=attributes,
-                   attrsonly=attrsonly,
-                   serverctrls=serverctrls,
-                   clientctrls=clientctrls,
-                   timeout=timeout,
-                   sizelimit=sizelimit
+                    basedn,
+                    scope,
+                    filterstr=filter,
+                    attrlist=attributes,
+                    attrsonly=attrsonly,
+                    serverctrls=serverctrls,
+                    clientctrls=clientctrls,
+                    timeout=timeout,
+                    sizelimit=sizelimit
                 )
+                type, data = self._handle.result(id, 0)
+                break
 
-                (rtype, rdata, rmsgid, serverctrls) = self._handle.result3(
-                    id, resp_ctrl_classes=paged_ctrls
-                )
-
-                result.extend(rdata)
-
-                paged.size = 0
-                paged.cookie = cookie = None
-                for sc in serverctrls:
-                    if sc.controlType == SimplePagedResultsControl.controlType:
-                        cookie = sc.cookie
-                        if cookie:
-                            paged.cookie = cookie
-                            paged.size = self.pagesize
-
-                        break
-
-                if not cookie:
-                    break
-
-                page += 1
-        else:
-            log.debug("FreeNAS_LDAP_Directory._search: pagesize = 0")
-
-            id = self._handle.search_ext(
-                basedn,
-                scope,
-                filterstr=filter,
-                attrlist=attributes,
-                attrsonly=attrsonly,
-                serverctrls=serverctrls,
-                clientctrls=clientctrls,
-                timeout=timeout,
-                sizelimit=sizelimit
-            )
-
-            type = ldap.RES_SEARCH_ENTRY
-            while type != ldap.RES_SEARCH_RESULT:
-                try:
-                    type, data = self._handle.result(id, 0)
+            except ldap.SERVER_DOWN:
+                if not retry or not self._reconnect():
+                    raise
+                retry = False
 
-                except ldap.LDAPError, e:
-                    self._logex(e)
-                    break
+        while True:
+            for entry in data:
+                yield entry
 
-                results.append(data)
+            if type == ldap.RES_SEARCH_RESULT:
+                break
 
-            for i in range(len(results)):
-                for entry in results[i]:
-                    result.append(entry)
+            try:
+                type, data = self._handle.result(id, 0)
 
-            self._cache[key] = result
+            except ldap.LDAPError, e:
+                self._logex(e)
+                break
 
-        log.debug("FreeNAS_LDAP_Directory._search: %d results", len(result))
-        log.debug("FreeNAS_LDAP_Directory._search: leave")
-        return result
+        log.debug("FreeNAS_LDAP_Directory._search_iter: leave")
 
     def search(self):
         log.debug("FreeNAS_LDAP_Directory.search: enter")
@@ -391,6 +523,74 @@ class FreeNAS_LDAP_Directory(object):
         return results
 
 
+    def _search_pages(self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None,
+        attributes=None, serverctrls=None):
+        """
+        Paged search yielding one page of entries at a time.
+
+        Unlike _search() nothing is kept in the query cache and the
+        whole result set is never held in memory.
+        """
+        log.debug("FreeNAS_LDAP_Directory._search_pages: enter")
+        log.debug("FreeNAS_LDAP_Directory._search_pages: basedn = '%s', "
+            "filter = '%s'", basedn, filter)
+        if not self._isopen:
+            return
+
+        pagesize = self.pagesize if self.pagesize > 0 else FREENAS_LDAP_PAGESIZE
+        paged = SimplePagedResultsControl(True, size=pagesize, cookie='')
+        paged_ctrls = {
+            SimplePagedResultsControl.controlType: SimplePagedResultsControl,
+        }
+
+        page = 0
+        retry = True
+        while True:
+            log.debug("FreeNAS_LDAP_Directory._search_pages: getting page %d",
+                page)
+
+            try:
+                id = self._handle.search_ext(
+                    basedn,
+                    scope,
+                    filterstr=filter,
+                    attrlist=attributes,
+                    serverctrls=[paged] + (serverctrls or [])
+                )
+
+                (rtype, rdata, rmsgid, rctrls) = self._handle.result3(
+                    id, resp_ctrl_classes=paged_ctrls
+                )
+
+            except ldap.SERVER_DOWN:
+                #
+                # The cookie is only good on the connection that got it,
+                # a dropped pooled connection can only be retried before
+                # the first page.
+                #
+                if page > 0 or not retry or not self._reconnect():
+                    raise
+                retry = False
+                continue
+
+            # Skip referrals
+            yield [r for r in rdata if r[0] is not None]
+
+            cookie = None
+            for sc in rctrls:
+                if sc.controlType == SimplePagedResultsControl.controlType:
+                    cookie = sc.cookie
+                    break
+
+            if not cookie:
+                break
+
+            paged.cookie = cookie
+            page += 1
+
+        log.debug("FreeNAS_LDAP_Directory._search_pages: leave")
+
+
 class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
     def __db_init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_Base.__db_init__: enter")
@@ -557,12 +757,14 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_user: leave")
         return ldap_user
 
-    def get_users(self):
-        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+    def iter_users(self):
+        """
+        Generator over the directory users, one page fetched at a time
+        """
+        log.debug("FreeNAS_LDAP_Base.iter_users: enter")
         isopen = self._isopen
         self.open()
 
-        users = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=person)(objectclass=account))(uid=*))'
 
@@ -570,15 +772,22 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
             basedn = "%s,%s" % (self.usersuffix, self.basedn)
         else:
             basedn = "%s" % self.basedn
-	
-        results = self._search(basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+
+        try:
+            for r in self._search_iter(basedn, scope, filter, self.attributes):
                 if r[0]:
-                    users.append(r)
+                    yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
+
+        log.debug("FreeNAS_LDAP_Base.iter_users: leave")
+
+    def get_users(self):
+        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+
+        users = list(self.iter_users())
 
         log.debug("FreeNAS_LDAP_Base.get_users: leave")
         return users
@@ -621,12 +830,14 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_group: leave")
         return ldap_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_LDAP_Base.get_groups: enter")
+    def iter_groups(self):
+        """
+        Generator over the directory groups, one page fetched at a time
+        """
+        log.debug("FreeNAS_LDAP_Base.iter_groups: enter")
         isopen = self._isopen
         self.open()
 
-        groups = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=posixgroup)(gidnumber=*))'
 
@@ -634,15 +845,22 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
             basedn = "%s,%s" % (self.groupsuffix, self.basedn)
         else:
             basedn = "%s" % self.basedn
-	
-        results = self._search(basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+
+        try:
+            for r in self._search_iter(basedn, scope, filter, self.attributes):
                 if r[0]:
-                    groups.append(r)
+                    yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
+
+        log.debug("FreeNAS_LDAP_Base.iter_groups: leave")
+
+    def get_groups(self):
+        log.debug("FreeNAS_LDAP_Base.get_groups: enter")
+
+        groups = list(self.iter_groups())
 
         log.debug("FreeNAS_LDAP_Base.get_groups: leave")
         return groups
@@ -729,14 +947,14 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
             ad = FreeNAS_ActiveDirectory_Base(**args)
 
             ret = ad.open()
+            ad.close()
             if ret == True:
+                # The bound handle stays in the pool for the caller
                 host = ad.host
                 port = ad.port
                 ret = (host, port)
                 break
 
-            ad.close()
-
         if not ret:
             ret = (None, None)
             log.debug("FreeNAS_ActiveDirectory_Base.dc_connect: "
@@ -1272,29 +1490,41 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_ActiveDirectory_Base.get_user: leave")
         return ad_user
 
-    def get_users(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
+    def iter_users(self):
+        """
+        Generator over the domain users, one page fetched at a time
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_users: enter")
         isopen = self._isopen
         self.open()
 
-        users = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=user)(objectclass=person))(sAMAccountName=*))'
-        if self.attributes and 'sAMAccountType' not in self.attributes:
-            self.attributes.append('sAMAccountType')
+        attributes = self.attributes
+        if attributes and 'sAMAccountType' not in attributes:
+            attributes = attributes + ['sAMAccountType']
 
-        results = self._search(self.basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+        count = 0
+        try:
+            for r in self._search_iter(self.basedn, scope, filter, attributes):
                 if r[0] and r[1] and r[1].has_key('sAMAccountType'):
                     type = int(r[1]['sAMAccountType'][0])
                     if not (type & 0x1):
-                        users.append(r)
+                        count += 1
+                        yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
+
+        self.ucount = count
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_users: leave")
+
+    def get_users(self):
+        log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
+
+        users = list(self.iter_users())
 
-        self.ucount = len(users)
         log.debug("FreeNAS_ActiveDirectory_Base.get_users: leave")
         return users
 
@@ -1353,29 +1583,41 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_ActiveDirectory_Base.get_group: leave")
         return ad_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
+    def iter_groups(self):
+        """
+        Generator over the domain groups, one page fetched at a time
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_groups: enter")
         isopen = self._isopen
         self.open()
 
-        groups = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=group)(sAMAccountName=*))'
-        if self.attributes and 'groupType' not in self.attributes:
-            self.attributes.append('groupType')
+        attributes = self.attributes
+        if attributes and 'groupType' not in attributes:
+            attributes = attributes + ['groupType']
 
-        results = self._search(self.basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+        count = 0
+        try:
+            for r in self._search_iter(self.basedn, scope, filter, attributes):
                 if r[0]:
                     type = int(r[1]['groupType'][0])
                     if not (type & 0x1):
-                        groups.append(r)
+                        count += 1
+                        yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
+
+        self.gcount = count
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_groups: leave")
+
+    def get_groups(self):
+        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
+
+        groups = list(self.iter_groups())
 
-        self.ucount = len(groups)
         log.debug("FreeNAS_ActiveDirectory_Base.get_groups: leave")
         return groups
 
@@ -1496,7 +1738,7 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
 
         else:
             log.debug("FreeNAS_LDAP_Users.__get_users: LDAP users not in cache")
-            ldap_users = self.get_users()
+            ldap_users = self.iter_users()
 
         for u in ldap_users:
             CN = str(u[0])
@@ -1634,7 +1876,7 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
             else:
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
                     "AD [%s] users not in cache" % n)
-                ad_users = self.get_users()
+                ad_users = self.iter_users()
 
             for u in ad_users:
                 CN = str(u[0])
@@ -1761,7 +2003,7 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
 
         else:
             log.debug("FreeNAS_LDAP_Groups.__get_groups: LDAP groups not in cache")
-            ldap_groups = self.get_groups()
+            ldap_groups = self.iter_groups()
 
         for g in ldap_groups:
             CN = str(g[0])
@@ -1900,7 +2142,7 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
             else:
                 log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
                     "AD [%s] groups not in cache", n)
-                ad_groups = self.get_groups()
+                ad_groups = self.iter_groups()
 
             for g in ad_groups:
                 sAMAccountName = g[1]['sAMAccountName'][0]
@@ -2301,3 +2543,412 @@ class FreeNAS_Directory_User(object):
 
         log.debug("FreeNAS_Directory_User.__new__: leave")
         return obj
+
+
+#
+# Incremental directory cache sync
+#
+# Instead of expiring the caches and enumerating the whole directory,
+# the sync keeps a high-water mark next to each directory cache and only
+# asks the server for what changed since then: uSNChanged for Active
+# Directory (per domain controller) and modifyTimestamp for LDAP.  The
+# changes of one run are applied in a single cache transaction, so
+# readers never see a half filled cache.  Without a usable high-water
+# mark a full pass is made and entries that are gone are pruned
+# afterwards, the cache is never emptied first.
+#
+class FreeNAS_Directory_SyncSet(object):
+    """
+    One kind of directory object (users or groups) and the pair of
+    caches it is synced into
+    """
+
+    def __init__(self, **kwargs):
+        self.dcache = kwargs['dcache']
+        self.cache = kwargs['cache']
+        self.markers = kwargs['markers']
+        self.basedn = kwargs.get('basedn', None)
+        self.filter = kwargs['filter']
+        self.objectclass = kwargs.get('objectclass', None)
+        self.name = kwargs['name']
+        self.dkey = kwargs.get('dkey', lambda entry, name: str(entry[0]))
+        self.ckey = kwargs.get('ckey', lambda name: name)
+        self.resolve = kwargs['resolve']
+        self.accept = kwargs.get('accept', lambda entry: True)
+
+
+def _sync_counts():
+    return {'added': 0, 'changed': 0, 'deleted': 0}
+
+
+def _sync_state_file(sset):
+    return os.path.join(sset.dcache.cachedir, FREENAS_LDAP_SYNCFILE)
+
+
+def _sync_state_read(sset):
+    try:
+        with open(_sync_state_file(sset), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _sync_state_write(sset, state):
+    path = _sync_state_file(sset)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def _sync_loaded(sset, write=False):
+    ret = True
+    for cache, marker in zip((sset.cache, sset.dcache), sset.markers):
+        path = os.path.join(cache.cachedir, marker)
+        if write:
+            with open(path, 'w+') as f:
+                f.close()
+        elif not os.access(path, os.F_OK):
+            ret = False
+    return ret
+
+
+def _sync_remove(sset, dkey, entry, counts):
+    sset.dcache.delete(dkey)
+    try:
+        sset.cache.delete(sset.ckey(sset.name(entry)))
+    except (KeyError, IndexError, TypeError):
+        pass
+
+    if counts is not None:
+        counts['deleted'] += 1
+
+
+def _sync_entry(sset, entry, counts, seen=None):
+    """
+    Add or update one directory entry, `seen' collects the directory
+    and resolved cache keys during a full pass
+    """
+    try:
+        name = sset.name(entry)
+    except (KeyError, IndexError):
+        return
+
+    dkey = sset.dkey(entry, name)
+    if not sset.accept(entry):
+        if sset.dcache.has_key(dkey):
+            _sync_remove(sset, dkey, sset.dcache[dkey], counts)
+        return
+
+    existed = False
+
+    #
+    # Renamed or moved objects keep their SID, drop the old record
+    #
+    sid = entry[1].get('objectSid')
+    sid = sid_to_string(sid[0]) if sid else None
+    if sid:
+        for okey, old in list(sset.dcache.find_items(sid=sid)):
+            if okey != dkey:
+                _sync_remove(sset, okey, old, None)
+                existed = True
+
+    ckey = sset.ckey(name)
+    if seen is not None:
+        seen[0].add(dkey)
+        seen[1].add(ckey)
+
+    if sset.dcache.has_key(dkey):
+        existed = True
+        if sset.dcache[dkey] == entry and sset.cache.has_key(ckey):
+            return
+
+    sset.dcache.write(dkey, entry, True)
+    try:
+        sset.cache.write(ckey, sset.resolve(name), True)
+    except KeyError:
+        sset.cache.delete(ckey)
+
+    counts['changed' if existed else 'added'] += 1
+
+
+def _sync_tombstone(sset, entry, counts):
+    sid = entry[1].get('objectSid')
+    if not sid:
+        return
+
+    for dkey, old in list(sset.dcache.find_items(sid=sid_to_string(sid[0]))):
+        _sync_remove(sset, dkey, old, counts)
+
+
+def _sync_prune(sset, dkeys, ckeys, counts):
+    stale = [k for k in sset.dcache.iterkeys() if k not in dkeys]
+    for dkey in stale:
+        _sync_remove(sset, dkey, sset.dcache[dkey], counts)
+
+    if ckeys is not None:
+        stale = [k for k in sset.cache.iterkeys() if k not in ckeys]
+        for ckey in stale:
+            sset.cache.delete(ckey)
+
+
+class FreeNAS_ActiveDirectory_Sync(FreeNAS_ActiveDirectory):
+    def __init__(self, **kwargs):
+        log.debug("FreeNAS_ActiveDirectory_Sync.__init__: enter")
+
+        super(FreeNAS_ActiveDirectory_Sync, self).__init__(**kwargs)
+
+        if kwargs.has_key('netbiosname') and kwargs['netbiosname']:
+            self.__domains = self.get_domains(netbiosname=kwargs['netbiosname'])
+        else:
+            self.__domains = self.get_domains()
+
+        log.debug("FreeNAS_ActiveDirectory_Sync.__init__: leave")
+
+    def __sets(self, n):
+        if self.default or self.unix:
+            uname = lambda e: str(e[1]['sAMAccountName'][0])
+            gname = lambda e: str("%s%s%s" % (
+                n, FREENAS_AD_SEPARATOR, e[1]['sAMAccountName'][0]))
+        else:
+            uname = lambda e: str("%s%s%s" % (
+                n, FREENAS_AD_SEPARATOR, e[1]['sAMAccountName'][0]))
+            gname = lambda e: str(e[1]['sAMAccountName'][0])
+
+        def accept(attr):
+            def _accept(entry):
+                try:
+                    return not (int(entry[1][attr][0]) & 0x1)
+                except (KeyError, IndexError, ValueError):
+                    return False
+            return _accept
+
+        users = FreeNAS_Directory_SyncSet(
+            dcache=FreeNAS_Directory_UserCache(dir=n),
+            cache=FreeNAS_UserCache(dir=n),
+            markers=('.ul', '.dul'),
+            filter='(&(|(objectclass=user)(objectclass=person))(sAMAccountName=*))',
+            objectclass='(objectclass=user)',
+            name=uname,
+            resolve=pwd.getpwnam,
+            accept=accept('sAMAccountType'),
+        )
+
+        groups = FreeNAS_Directory_SyncSet(
+            dcache=FreeNAS_Directory_GroupCache(dir=n),
+            cache=FreeNAS_GroupCache(dir=n),
+            markers=('.gl', '.dgl'),
+            filter='(&(objectclass=group)(sAMAccountName=*))',
+            objectclass='(objectclass=group)',
+            name=gname,
+            dkey=lambda entry, name: name.upper(),
+            ckey=lambda name: name.upper(),
+            resolve=grp.getgrnam,
+            accept=accept('groupType'),
+        )
+
+        return (('users', users), ('groups', groups))
+
+    def __sync_set(self, sset, server, usn, full):
+        state = _sync_state_read(sset)
+        incremental = (
+            not full and state is not None and
+            state.get('server') == server and
+            state.get('usn', usn + 1) <= usn and
+            _sync_loaded(sset)
+        )
+
+        counts = _sync_counts()
+        if incremental:
+            filter = '(&%s(uSNChanged>=%d))' % (sset.filter, state['usn'] + 1)
+            seen = None
+        else:
+            filter = sset.filter
+            seen = (set(), set())
+
+        log.debug("FreeNAS_ActiveDirectory_Sync.__sync_set: %s sync, "
+            "filter = '%s'", "incremental" if incremental else "full", filter)
+
+        with sset.dcache.transaction():
+            with sset.cache.transaction():
+                for page in self._search_pages(self.basedn,
+                    ldap.SCOPE_SUBTREE, filter):
+                    for entry in page:
+                        _sync_entry(sset, entry, counts, seen)
+
+                if incremental:
+                    filter = '(&(isDeleted=TRUE)(uSNChanged>=%d)%s)' % (
+                        state['usn'] + 1, sset.objectclass)
+                    ctrls = [LDAPControl(FREENAS_AD_SHOW_DELETED, True)]
+                    for page in self._search_pages(self.basedn,
+                        ldap.SCOPE_SUBTREE, filter, ['objectSid'], ctrls):
+                        for entry in page:
+                            _sync_tombstone(sset, entry, counts)
+                else:
+                    _sync_prune(sset, seen[0], seen[1], counts)
+
+        _sync_state_write(sset, {'server': server, 'usn': usn})
+        _sync_loaded(sset, True)
+
+        return counts
+
+    def sync(self, full=False):
+        """
+        Bring the user and group caches of every domain up to date.
+
+        Returns {netbiosname: {'users': counts, 'groups': counts}}
+        where counts holds the number of entries added, changed and
+        deleted.
+        """
+        log.debug("FreeNAS_ActiveDirectory_Sync.sync: enter")
+
+        results = {}
+        self._save()
+        for d in self.__domains:
+            n = d['nETBIOSName']
+
+            #
+            # uSNChanged is local to a domain controller, the whole
+            # domain is synced against the one we connect to here.
+            #
+            (self.host, self.port) = self.dc_connect(d['dnsRoot'], self.binddn, self.bindpw)
+            self.basedn = d['nCName']
+            self.pagesize = FREENAS_LDAP_PAGESIZE
+
+            self.close()
+            self.open()
+            if not self._isopen:
+                log.debug("FreeNAS_ActiveDirectory_Sync.sync: "
+                    "unable to connect to a domain controller for %s", n)
+                continue
+
+            rootDSE = self._handle.search_s('', ldap.SCOPE_BASE,
+                '(objectclass=*)', ['dsServiceName', 'highestCommittedUSN'])
+            server = rootDSE[0][1]['dsServiceName'][0]
+            usn = long(rootDSE[0][1]['highestCommittedUSN'][0])
+
+            log.debug("FreeNAS_ActiveDirectory_Sync.sync: "
+                "domain = %s, server = %s, usn = %d", n, server, usn)
+
+            results[n] = {}
+            for kind, sset in self.__sets(n):
+                results[n][kind] = self.__sync_set(sset, server, usn, full)
+
+        self.close()
+        self._restore()
+
+        log.debug("FreeNAS_ActiveDirectory_Sync.sync: leave")
+        return results
+
+
+class FreeNAS_LDAP_Sync(FreeNAS_LDAP):
+    def __init__(self, **kwargs):
+        log.debug("FreeNAS_LDAP_Sync.__init__: enter")
+
+        super(FreeNAS_LDAP_Sync, self).__init__(**kwargs)
+
+        log.debug("FreeNAS_LDAP_Sync.__init__: leave")
+
+    def __basedn(self, suffix):
+        if suffix:
+            return "%s,%s" % (suffix, self.basedn)
+        return "%s" % self.basedn
+
+    def __sets(self):
+        users = FreeNAS_Directory_SyncSet(
+            dcache=FreeNAS_Directory_UserCache(),
+            cache=FreeNAS_UserCache(),
+            markers=('.ul', '.dul'),
+            basedn=self.__basedn(self.usersuffix),
+            filter='(&(|(objectclass=person)(objectclass=account))(uid=*))',
+            name=lambda e: str(e[1]['uid'][0]),
+            resolve=pwd.getpwnam,
+        )
+
+        groups = FreeNAS_Directory_SyncSet(
+            dcache=FreeNAS_Directory_GroupCache(),
+            cache=FreeNAS_GroupCache(),
+            markers=('.gl', '.dgl'),
+            basedn=self.__basedn(self.groupsuffix),
+            filter='(&(objectclass=posixgroup)(gidnumber=*))',
+            name=lambda e: str(e[1]['cn'][0]),
+            resolve=grp.getgrnam,
+        )
+
+        return (('users', users), ('groups', groups))
+
+    def __sync_set(self, sset, full):
+        state = _sync_state_read(sset)
+        incremental = (
+            not full and state is not None and
+            state.get('server') == self.host and
+            state.get('timestamp') and
+            _sync_loaded(sset)
+        )
+
+        counts = _sync_counts()
+        if incremental:
+            filter = '(&%s(modifyTimestamp>=%s))' % (
+                sset.filter, state['timestamp'])
+            seen = None
+        else:
+            filter = sset.filter
+            seen = (set(), set())
+
+        log.debug("FreeNAS_LDAP_Sync.__sync_set: %s sync, filter = '%s'",
+            "incremental" if incremental else "full", filter)
+
+        #
+        # modifyTimestamp is operational and has to be asked for, the
+        # new high-water mark is the newest one we got back.
+        #
+        timestamp = state.get('timestamp') if incremental else None
+        with sset.dcache.transaction():
+            with sset.cache.transaction():
+                for page in self._search_pages(sset.basedn,
+                    ldap.SCOPE_SUBTREE, filter, ['*', 'modifyTimestamp']):
+                    for entry in page:
+                        ts = entry[1].get('modifyTimestamp')
+                        if ts and ts[0] > timestamp:
+                            timestamp = ts[0]
+                        _sync_entry(sset, entry, counts, seen)
+
+                #
+                # Plain LDAP keeps no tombstones, deletions are found by
+                # listing the DNs that still exist.
+                #
+                if incremental:
+                    dns = set()
+                    for page in self._search_pages(sset.basedn,
+                        ldap.SCOPE_SUBTREE, sset.filter, ['1.1']):
+                        dns.update([str(entry[0]) for entry in page])
+                    _sync_prune(sset, dns, None, counts)
+                else:
+                    _sync_prune(sset, seen[0], seen[1], counts)
+
+        _sync_state_write(sset, {'server': self.host, 'timestamp': timestamp})
+        _sync_loaded(sset, True)
+
+        return counts
+
+    def sync(self, full=False):
+        """
+        Bring the LDAP user and group caches up to date.
+
+        Returns {'users': counts, 'groups': counts} where counts holds
+        the number of entries added, changed and deleted.
+        """
+        log.debug("FreeNAS_LDAP_Sync.sync: enter")
+
+        results = {}
+        isopen = self._isopen
+        self.open()
+        self.pagesize = FREENAS_LDAP_PAGESIZE
+
+        for kind, sset in self.__sets():
+            results[kind] = self.__sync_set(sset, full)
+
+        if not isopen:
+            self.close()
+
+        log.debug("FreeNAS_LDAP_Sync.sync: leave")
+        return results
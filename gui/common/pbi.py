@@ -39,6 +39,7 @@ PBI_APPDIR = "/var/pbi"
 PBID_DBDIR = "/var/db/pbi"
 PBID_REPOSDIR = "%s/repos" % PBID_DBDIR
 PBID_INDEXDIR = "%s/index" % PBID_DBDIR
+PBID_MIRRORSDIR = "%s/mirrors" % PBID_DBDIR
 PBID_ICONSDIR = "%s/repo-icons" % PBID_DBDIR
 
 JEXEC_PATH = "/usr/sbin/jexec"
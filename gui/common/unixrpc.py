@@ -0,0 +1,235 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+XML-RPC over unix domain sockets
+
+Used to talk to the local helper daemons (webshell, zfsstate).
+A request is the marshaled XML-RPC call, terminated by the client
+shutting down its write side; the response is sent back and the
+connection closed by the server.
+
+The persistent variant keeps the connection open instead: every
+request and response is preceded by its length in bytes on a line
+of its own, see PersistentUnixTransport/PersistentUnixRPCHandler.
+"""
+import SocketServer
+import socket
+import xmlrpclib
+
+
+class UnixTransport(xmlrpclib.Transport):
+
+    def __init__(self, timeout=5, *args, **kwargs):
+        self.timeout = timeout
+        xmlrpclib.Transport.__init__(self, *args, **kwargs)
+
+    def make_connection(self, addr):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.sock.settimeout(self.timeout)
+        return self.sock
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        # issue XML-RPC request
+
+        self.make_connection(host)
+
+        try:
+            self.sock.sendall(request_body + "\n")
+            self.sock.shutdown(socket.SHUT_WR)
+            p, u = self.getparser()
+
+            while 1:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                p.feed(data)
+
+            self.sock.close()
+            p.close()
+
+            return u.close()
+        except xmlrpclib.Fault:
+            raise
+        except Exception:
+            # All unexpected errors leave connection in
+            # a strange state, so we clear it.
+            self.close()
+            raise
+
+    def close(self):
+        sock = getattr(self, 'sock', None)
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class PersistentUnixTransport(UnixTransport):
+    """
+    Reuse the same connection for every request
+
+    The transport is not thread safe, use one per thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sock = None
+        self.rfile = None
+        UnixTransport.__init__(self, *args, **kwargs)
+
+    def single_request(self, host, handler, request_body, verbose=0):
+
+        while True:
+            reused = self.sock is not None
+            if not reused:
+                self.make_connection(host)
+                self.rfile = self.sock.makefile('rb')
+            try:
+                self.sock.sendall(
+                    "%d\n%s" % (len(request_body), request_body)
+                )
+                header = self.rfile.readline()
+            except socket.timeout:
+                self.close()
+                raise
+            except socket.error:
+                # Server went away while we were idle
+                self.close()
+                if reused:
+                    continue
+                raise
+            if not header and reused:
+                # Same as above, the request has not been processed
+                # so it is safe to send it again
+                self.close()
+                continue
+            try:
+                length = int(header)
+                data = self.rfile.read(length)
+                if len(data) != length:
+                    raise socket.error("Connection closed by server")
+                p, u = self.getparser()
+                p.feed(data)
+                p.close()
+                return u.close()
+            except xmlrpclib.Fault:
+                raise
+            except Exception:
+                # All unexpected errors leave connection in
+                # a strange state, so we clear it.
+                self.close()
+                raise
+
+    def close(self):
+        if self.rfile is not None:
+            self.rfile.close()
+            self.rfile = None
+        UnixTransport.close(self)
+
+
+class UnixServerProxy(xmlrpclib.ServerProxy):
+
+    def __init__(self, addr, timeout=5, allow_none=False, transport=None):
+
+        self.__handler = "/"
+        self.__host = addr
+        if transport is None:
+            transport = UnixTransport(timeout=timeout)
+        self.__transport = transport
+        self.__encoding = None
+        self.__verbose = 0
+        self.__allow_none = allow_none
+
+    def __request(self, methodname, params):
+        # call a method on the remote server
+
+        request = xmlrpclib.dumps(
+            params,
+            methodname,
+            encoding=self.__encoding,
+            allow_none=self.__allow_none,
+        )
+
+        response = self.__transport.request(
+            self.__host,
+            self.__handler,
+            request,
+            verbose=self.__verbose
+        )
+
+        if len(response) == 1:
+            response = response[0]
+
+        return response
+
+    def __getattr__(self, name):
+        # magic method dispatcher
+        return xmlrpclib._Method(self.__request, name)
+
+
+class UnixRPCHandler(SocketServer.StreamRequestHandler):
+    """
+    Read the whole request until the client shuts down its write side
+    and reply with the marshaled response.
+    """
+
+    def handle(self):
+        data = self.rfile.read().strip()
+        if not data:
+            return
+        self.wfile.write(self.server.dispatcher._marshaled_dispatch(data))
+
+
+class PersistentUnixRPCHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve length prefixed requests until the client closes the
+    connection.
+    """
+
+    def handle(self):
+        while True:
+            header = self.rfile.readline()
+            if not header:
+                break
+            try:
+                length = int(header)
+            except ValueError:
+                break
+            data = self.rfile.read(length)
+            if len(data) != length:
+                break
+            response = self.server.dispatcher._marshaled_dispatch(data)
+            self.wfile.write("%d\n%s" % (len(response), response))
+
+
+class ThreadingUnixRPCServer(
+    SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer
+):
+
+    daemon_threads = True
@@ -25,8 +25,11 @@
 #
 # $FreeBSD$
 #####################################################################
+import copy
 import logging
 import os
+import threading
+import time
 
 log = logging.getLogger('common.warden')
 
@@ -987,6 +990,93 @@ class warden_zfsrmsnap(warden_base):
             WARDEN_ZFSRMSNAP, flags, **kwargs)
 
 
+# Seconds the output of ``warden list`` is shared between callers
+WARDEN_LIST_TTL = 10
+
+# Commands that do not change the state of any jail
+WARDEN_READONLY = (
+    warden_checkup,
+    warden_details,
+    warden_export,
+    warden_get,
+    warden_list,
+    warden_pbis,
+    warden_pkgs,
+    warden_zfslistclone,
+    warden_zfslistsnap,
+)
+
+
+class WardenState(object):
+    """
+    Output of ``warden list`` shared by every caller in the process for
+    WARDEN_LIST_TTL seconds, indexed by id, host and status
+
+    Warden calls that change a jail invalidate it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._jails = []
+        self._by_id = {}
+        self._by_host = {}
+        self._by_status = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+
+    def _load(self):
+        if (
+            self._loaded is not None and
+            time.time() - self._loaded < WARDEN_LIST_TTL
+        ):
+            return
+        wlist = warden_list()
+        jails = wlist.parse(wlist.run())
+        jails.sort(key=lambda j: int(j[WARDEN_KEY_ID]))
+        by_id, by_host, by_status = {}, {}, {}
+        for jail in jails:
+            by_id[str(jail.get(WARDEN_KEY_ID))] = jail
+            by_host[jail.get(WARDEN_KEY_HOST)] = jail
+            by_status.setdefault(jail.get(WARDEN_KEY_STATUS), []).append(jail)
+        self._jails = jails
+        self._by_id = by_id
+        self._by_host = by_host
+        self._by_status = by_status
+        self._loaded = time.time()
+
+    def jails(self):
+        """
+        Copy of every jail, ordered by id
+        """
+        with self._lock:
+            self._load()
+            return copy.deepcopy(self._jails)
+
+    def lookup(self, id=None, host=None, status=None):
+        """
+        Copy of the jails matching all of the given id, host and status
+        """
+        with self._lock:
+            self._load()
+            jails = self._jails
+            if id is not None:
+                jail = self._by_id.get(str(id))
+                jails = [jail] if jail is not None else []
+            if host is not None:
+                jail = self._by_host.get(host)
+                jails = [j for j in jails if j is jail]
+            if status is not None:
+                matches = self._by_status.get(status, [])
+                jails = [j for j in jails if j in matches]
+            return copy.deepcopy(jails)
+
+
+warden_state = WardenState()
+
+
 class Warden(warden_base):
     def __init__(self, flags=WARDEN_FLAGS_NONE, **kwargs):
         self.flags = flags
@@ -1022,7 +1112,16 @@ class Warden(warden_base):
 
     def __call(self, obj):
         if obj is not None:
-            tmp = obj.run()
+            if isinstance(obj, WARDEN_READONLY):
+                tmp = obj.run()
+            else:
+                # Also after running it, another thread may have listed
+                # the jails while the command was changing them
+                warden_state.invalidate()
+                try:
+                    tmp = obj.run()
+                finally:
+                    warden_state.invalidate()
             if tmp is not None and len(tmp) > 1:
                 if hasattr(obj, "parse"):
                     return obj.parse(tmp)
@@ -1061,6 +1160,8 @@ class Warden(warden_base):
         return self.__call(warden_get(flags, **kwargs))
 
     def list(self, flags=WARDEN_FLAGS_NONE, **kwargs):
+        if flags == WARDEN_FLAGS_NONE and not kwargs:
+            return warden_state.jails()
         return self.__call(warden_list(flags, **kwargs))
 
     def pkgs(self, flags=WARDEN_FLAGS_NONE, **kwargs):
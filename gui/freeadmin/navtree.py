@@ -27,12 +27,15 @@
 import json
 import logging
 import re
+import threading
+import time
 
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch, resolve, reverse
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.forms import ModelForm
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language, ugettext_lazy as _
 
 import eventlet
 from freenasUI.common.log import log_traceback
@@ -46,9 +49,16 @@ from freenasUI.freeadmin.tree import (
 from freenasUI.jails.models import Jails
 from freenasUI.plugins.models import Plugins
 from freenasUI.plugins.utils import get_base_url
+from freenasUI.plugins.utils.health import plugin_health
 
 log = logging.getLogger('freeadmin.navtree')
 
+# Seconds a generated tree is reused for; saving or deleting any model
+# invalidates it sooner
+NAVTREE_TTL = 300
+# Seconds the menus fetched from running plugins are reused for
+PLUGINS_TTL = 60
+
 
 class ModelFormsDict(dict):
 
@@ -88,6 +98,13 @@ class NavTree(object):
         self._modelforms = ModelFormsDict()
         self._navs = {}
         self._generated = False
+        self._lock = threading.RLock()
+        # Bumped by invalidate(), the tree is rebuilt when it changes
+        self._generation = 0
+        self._built = None
+        self._plugins = None
+        self._menus = {}
+        self._app_labels = set()
 
     def isGenerated(self):
         return self._generated
@@ -199,6 +216,67 @@ class NavTree(object):
                             _models[form._meta.model] = form
             self._modelforms.update(_models)
 
+    def invalidate(self, *args, **kwargs):
+        """
+        Drop the generated tree and the plugin menus
+
+        Also used as the receiver of the model signals
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields and set(update_fields) == set(['last_login']):
+            return
+        with self._lock:
+            self._generation += 1
+            self._plugins = None
+            self._menus.clear()
+
+    def _model_changed(self, sender, **kwargs):
+        if sender._meta.app_label not in self._app_labels:
+            return
+        self.invalidate(**kwargs)
+
+    def connect_signals(self):
+        self._app_labels = set(
+            app.rsplit('.', 1)[-1] for app in settings.INSTALLED_APPS
+            if app.startswith('freenasUI.') or app == 'django.contrib.auth'
+        )
+        for signal in (post_save, post_delete, m2m_changed):
+            signal.connect(
+                self._model_changed,
+                dispatch_uid='navtree_invalidate',
+            )
+
+    def menu(self, request):
+        """
+        JSON of the tree as seen by request.user
+
+        The tree is only generated again once it has been invalidated, is
+        older than NAVTREE_TTL or its plugin menus expired; the JSON is
+        kept per user and language until then.
+        """
+        with self._lock:
+            if self._stale():
+                self._menus.clear()
+                self.generate(request)
+            key = (request.user.pk, get_language())
+            menu = self._menus.get(key)
+            if menu is None:
+                menu = json.dumps(self.dijitTree(request.user))
+                self._menus[key] = menu
+            return menu
+
+    def _stale(self):
+        if self._built is None:
+            return True
+        generation, built = self._built
+        now = time.time()
+        return (
+            generation != self._generation or
+            now - built > NAVTREE_TTL or
+            self._plugins is None or
+            now - self._plugins[0] > PLUGINS_TTL
+        )
+
     def generate(self, request=None):
         """
         Tree Menu Auto Generate
@@ -216,6 +294,7 @@ class NavTree(object):
         """
 
         self._generated = True
+        self._built = (self._generation, time.time())
         self._navs.clear()
         tree_roots.clear()
         childs_of = []
@@ -294,13 +373,7 @@ class NavTree(object):
 
         self.replace_navs(tree_roots)
 
-        jails = []
-        #FIXME: use .filter
-        for j in Jails.objects.all():
-            if j.jail_type == WARDEN_TYPE_PLUGINJAIL and \
-                j.jail_status == WARDEN_STATUS_RUNNING:
-                jails.append(j)
-        self._get_plugins_nodes(request, jails)
+        self._get_plugins_nodes(request)
 
     def _generate_app(self, app, request, tree_roots, childs_of):
 
@@ -500,33 +573,27 @@ class NavTree(object):
 
     def _plugin_fetch(self, args):
         plugin, host, request = args
-        if re.match('^.+\[.+\]', host, re.I):
-            import urllib2
-        else:
-            from eventlet.green import urllib2
-
-        data = None
-        url = "%s/plugins/%s/%d/_s/treemenu" % (host, plugin.plugin_name, plugin.id)
-        try:
-            opener = urllib2.build_opener()
-            opener.addheaders = [(
-                'Cookie', 'sessionid=%s' % (
-                    request.COOKIES.get("sessionid", ''),
-                )
-            )]
-            #TODO: Increase timeout based on number of plugins
-            response = opener.open(url, None, 5)
-            data = response.read()
-            if not data:
-                log.warn(_("Empty data returned from %s") % (url,))
-        except Exception, e:
-            log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
-                'url': url,
-                'error': e,
-            })
+        # Last menu the plugin returned if it does not answer this time
+        url, data = plugin_health.fetch(
+            plugin, host, request, 'treemenu', keep=True
+        )
         return plugin, url, data
 
-    def _get_plugins_nodes(self, request, jails):
+    def _fetch_plugins(self, request):
+        """
+        Menus of the enabled plugins whose jail is running, fetched at
+        most every PLUGINS_TTL seconds
+        """
+        now = time.time()
+        if self._plugins is not None and now - self._plugins[0] < PLUGINS_TTL:
+            return self._plugins[1]
+
+        jails = []
+        #FIXME: use .filter
+        for j in Jails.objects.all():
+            if j.jail_type == WARDEN_TYPE_PLUGINJAIL and \
+                j.jail_status == WARDEN_STATUS_RUNNING:
+                jails.append(j)
 
         host = get_base_url(request)
         args = map(
@@ -534,7 +601,13 @@ class NavTree(object):
             Plugins.objects.filter(plugin_enabled=True, plugin_jail__in=[jail.jail_host for jail in jails]))
 
         pool = eventlet.GreenPool(20)
-        for plugin, url, data in pool.imap(self._plugin_fetch, args):
+        fetched = list(pool.imap(self._plugin_fetch, args))
+        self._plugins = (now, fetched)
+        return fetched
+
+    def _get_plugins_nodes(self, request):
+
+        for plugin, url, data in self._fetch_plugins(request):
 
             if not data:
                 continue
@@ -1,7 +1,6 @@
 from functools import update_wrapper
 
 import hashlib
-import json
 import logging
 import re
 
@@ -234,9 +233,7 @@ class FreeAdminSite(object):
     def menu(self, request):
         from freenasUI.freeadmin.navtree import navtree
         try:
-            navtree.generate(request)
-            final = navtree.dijitTree(request.user)
-            data = json.dumps(final)
+            data = navtree.menu(request)
         except Exception, e:
             log.debug("Fatal error while generating the tree json: %s", e)
             data = ""
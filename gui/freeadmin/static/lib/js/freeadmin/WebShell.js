@@ -38,6 +38,8 @@ define([
     qtime: 100,
     retry: 0,
     cy: 0,
+    rev: 0,
+    rows: [],
     kb: [],
     connections: [],
     sizeChange: true,
@@ -185,6 +187,24 @@ define([
       this.islocked = true;
       this._stopConnections();
     },
+    render: function(data) {
+      // Rows are sent only when they changed since this.rev
+      if(data.h != this.rows.length) {
+        domConst.empty(this._content);
+        this.rows = [];
+        for(var y = 0; y < data.h; y++) {
+          this.rows.push(domConst.create("span", null, this._content));
+          this._content.appendChild(dWindow.doc.createTextNode("\n"));
+        }
+      }
+      var changed = false;
+      for(var y in data.rows) {
+        this.rows[y].innerHTML = data.rows[y];
+        changed = true;
+      }
+      this.rev = data.rev;
+      return changed;
+    },
     paste: function(string) {
       for(chr in string) {
         this.queue(string[chr]);
@@ -205,7 +225,8 @@ define([
             shell: this.shell,
             w: this.width,
             h: this.height,
-            k: send
+            k: send,
+            r: this.rev
           },
           headers: {
             'Content-Type': 'application/x-www-form-urlencoded',
@@ -213,7 +234,7 @@ define([
           },
           sync: false,
           preventCache: true,
-          handleAs: 'text'
+          handleAs: 'json'
         }).then(function(data) {
 
           me.islocked = false;
@@ -223,11 +244,8 @@ define([
           }
 
           me.retry = 0;
-          cy = data.substring(45, 48);
-          html = data.substring(52);
-          if(html.length > 0) {
-            me._content.innerHTML = html;
-            me.handler('curs', cy);
+          if(me.render(data)) {
+            me.handler('curs', data.cy);
             qtime = 100;
           } else {
             qtime *= 2;
@@ -299,6 +299,10 @@ class JailCreateForm(ModelForm):
                 os.unlink(createfile)
             return
 
+        # Not a database insert, no signal tells the menu about it
+        from freenasUI.freeadmin.navtree import navtree
+        navtree.invalidate()
+
         if os.path.exists(createfile):
             os.unlink(createfile)
 
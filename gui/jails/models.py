@@ -296,6 +296,9 @@ class Jails(Model):
                     _("This jail is required by %d plugin(s)") % qs.count()
                 )
         Warden().delete(jail=self.jail_host, flags=WARDEN_DELETE_FLAGS_CONFIRM)
+        # Not a database delete, no signal tells the menu about it
+        from freenasUI.freeadmin.navtree import navtree
+        navtree.invalidate()
 
     def is_linux_jail(self):
         is_linux = False
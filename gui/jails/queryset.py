@@ -28,44 +28,37 @@ import logging
 
 from django.db.models.query import QuerySet
 
-from freenasUI.common.warden import Warden
+from freenasUI.common.warden import warden_state
 
 log = logging.getLogger('jails.queryset')
 
+# Model fields looked up through the warden_state indexes
+INDEXED = {
+    'id': 'id',
+    'jail_host': 'host',
+    'jail_status': 'status',
+}
+
 
 #
-# XXX - Should implement order_by() and filter() methods
+# XXX - Only the parts of the QuerySet API used on Jails are implemented
 #
 class JailsQuerySet(QuerySet):
 
     def __init__(self, model=None, query=None, using=None):
         super(JailsQuerySet, self).__init__(model, query, using)
         self.__wlist_cache = None
-        self.__wcount_cache = None
 
     @property
     def __wlist(self):
         if self.__wlist_cache is None:
             try:
-                wlist = Warden().list()
+                wlist = warden_state.jails()
             except:
                 wlist = []
-            self.__wcount_cache = len(wlist)
-
-            tl = []
-            wlist = self.__order_by(wlist, "id")
-            for wj in wlist:
-                tj = self.__to_model_dict(wj)
-                tl.append(tj)
-            self.__wlist_cache = tl
+            self.__wlist_cache = [self.__to_model_dict(wj) for wj in wlist]
         return self.__wlist_cache
 
-    @property
-    def __wcount(self):
-        if self.__wcount_cache is None:
-            self.__wcount_cache = len(self.__wlist)
-        return self.__wcount_cache
-
     def __ispk(self, k):
         ispk = False
         if (k == "id" or k == "-id"):
@@ -90,57 +83,77 @@ class JailsQuerySet(QuerySet):
 
         return tj
 
+    def __matches(self, wj, kwargs):
+        for k, v in kwargs.items():
+            key = self.__key(k)
+            if self.__ispk(key):
+                v = int(v)
+            if key not in wj or str(wj[key]) != str(v):
+                return False
+        return True
+
+    def __lookup(self, kwargs):
+        """
+        Model dicts matching all of kwargs
+
+        A queryset not evaluated yet goes through the warden_state indexes
+        for id, jail_host and jail_status instead of scanning every jail.
+        """
+        index = {}
+        for k, v in kwargs.items():
+            key = self.__key(k)
+            if key in INDEXED:
+                index[INDEXED[key]] = v
+        if self.__wlist_cache is None and index:
+            try:
+                wlist = [
+                    self.__to_model_dict(wj)
+                    for wj in warden_state.lookup(**index)
+                ]
+            except:
+                wlist = []
+        else:
+            wlist = self.__wlist
+        return [wj for wj in wlist if self.__matches(wj, kwargs)]
+
     def iterator(self):
         for wj in self.__wlist:
             yield self.model(**wj)
 
     def count(self):
-        return self.__wcount
+        return len(self.__wlist)
+
+    def exists(self):
+        return len(self.__wlist) > 0
 
     def __order_by(self, wlist, *fields):
-        for fn in fields:
-            fn = self.__key(fn)
-            wlist = sorted(wlist, key=lambda k: k[fn])
+        # Stable sorts from the last field to the first
+        for fn in reversed(fields):
+            if not fn:
+                continue
+            reverse = fn.startswith('-')
+            key = self.__key(fn.lstrip('-'))
+            if key == 'id':
+                sortkey = lambda k: int(k['id'])
+            else:
+                sortkey = lambda k: k.get(key)
+            wlist = sorted(wlist, key=sortkey, reverse=reverse)
         return wlist
 
     def order_by(self, *fields):
-        models = []
-
-        wlist = self.__wlist
-        for fn in fields:
-            fn = self.__key(fn)
-            wlist = sorted(wlist, key=lambda k: k[fn])
-
-        for wj in wlist:
-            models.append(self.model(**wj))
-
-        return models
+        return [
+            self.model(**wj) for wj in self.__order_by(self.__wlist, *fields)
+        ]
 
     def latest(self, field_name=None):
-        if field_name is not None:
-            field_name = "-%s" % field_name
-        #FIXME: not efficient
-        models = self.order_by(field_name)
+        models = self.order_by("-%s" % (field_name or 'id', ))
         if len(models) == 0:
             raise self.model.DoesNotExist
         else:
             return models[0]
 
     def get(self, *args, **kwargs):
-        results = []
-        for wj in self.__wlist:
-
-            found = 0
-            count = len(kwargs)
-            for k in kwargs:
-                key = self.__key(k)
-                if self.__ispk(key):
-                    kwargs[k] = int(kwargs[k])
-                if key in wj and str(wj[key]) == str(kwargs[k]):
-                    found += 1
-
-            if found == count:
-                results.append(wj)
+        results = self.__lookup(kwargs)
 
         if len(results) == 0:
             raise self.model.DoesNotExist("Jail matching query does not exist")
@@ -155,25 +168,12 @@ class JailsQuerySet(QuerySet):
             klass=None, setup=False, **kwargs
         )
         c.__wlist_cache = self.__wlist_cache
-        c.__wcount_cache = self.__wcount_cache
         return c
 
     #
     # Minimal filter() implementation....
     #
     def filter(self, *args, **kwargs):
-        for wj in list(self.__wlist):
-
-            found = 0
-            count = len(kwargs)
-            for k in kwargs:
-                key = self.__key(k)
-                if self.__ispk(key):
-                    kwargs[k] = int(kwargs[k])
-                if key in wj and str(wj[key]) == str(kwargs[k]):
-                    found += 1
-
-            if found != count:
-                self.__wlist_cache.remove(wj)
-
-        return self
+        c = self._clone()
+        c.__wlist_cache = self.__lookup(kwargs)
+        return c
@@ -35,6 +35,7 @@ from django.http import HttpResponse
 from django.shortcuts import render
 from django.utils.translation import ugettext as _
 
+from freenasUI.freeadmin.navtree import navtree
 from freenasUI.freeadmin.views import JsonResp
 from freenasUI.jails import forms, models
 from freenasUI.jails.utils import get_jails_index
@@ -130,6 +131,7 @@ def jail_start(request, id):
         try:
             notifier().reload("http")  # Jail IP reflects nginx plugins.conf
             Warden().start(jail=jail.jail_host)
+            navtree.invalidate()
             return JsonResp(
                 request,
                 message=_("Jail successfully started.")
@@ -151,6 +153,7 @@ def jail_stop(request, id):
     if request.method == 'POST':
         try:
             Warden().stop(jail=jail.jail_host)
+            navtree.invalidate()
             return JsonResp(
                 request,
                 message=_("Jail successfully stopped.")
@@ -0,0 +1,135 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Persistent cache of disk identities (serial number, media size, ident)
+
+Probing a serial number means running smartctl against the disk, which
+adds up on large enclosures. Entries are keyed by device name and by the
+GEOM generation of the disk: media size, sector size, ident, description
+and LUN id as found in kern.geom.confxml, plus the GEOM provider id for
+disks that have neither an ident nor a LUN id. Any change there (e.g.
+another disk in the same slot) invalidates the entry and the disk is
+probed again. Disks whose serial number could not be read are not
+cached.
+"""
+import json
+import logging
+import os
+import tempfile
+
+log = logging.getLogger('middleware.diskcache')
+
+# /var is a memory disk, keep it across reboots next to the config
+CACHEFILE = '/data/disk_identity.json'
+
+# Disks probed at the same time by notifier.probe_disks()
+PROBE_WORKERS = 16
+
+
+def generation(provider):
+    """
+    GEOM generation of the DISK ``provider`` (see middleware/geom.py)
+    """
+    if provider is None:
+        return None
+    gen = [
+        provider.mediasize,
+        provider.sectorsize,
+        provider.config.get('ident'),
+        provider.config.get('descr'),
+        provider.config.get('lunid'),
+    ]
+    if not gen[2] and not gen[4]:
+        # Nothing tells apart two disks of the same model and size, tie
+        # the entry to this attachment of the disk (the provider id is
+        # the address of the kernel object, a new one for a new disk)
+        gen.append(provider.id)
+    return gen
+
+
+class DiskIdentityCache(object):
+
+    def __init__(self, path=CACHEFILE):
+        self.path = path
+        self._dirty = False
+        try:
+            with open(self.path, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def get(self, devname, gen):
+        """
+        Cached identity of ``devname`` if its GEOM generation is still
+        ``gen``, None otherwise
+        """
+        if gen is None:
+            return None
+        entry = self._entries.get(devname)
+        if entry is None or entry.get('generation') != gen:
+            return None
+        if not entry.get('serial'):
+            return None
+        return entry
+
+    def set(self, devname, gen, serial=None, mediasize=None, ident=None):
+        """
+        Remember the identity of ``devname``; a disk without a serial
+        number is forgotten instead so it is probed again next time
+        """
+        if not serial:
+            if self._entries.pop(devname, None) is not None:
+                self._dirty = True
+            return
+        self._entries[devname] = {
+            'generation': gen,
+            'serial': serial,
+            'mediasize': mediasize,
+            'ident': ident,
+        }
+        self._dirty = True
+
+    def prune(self, devnames):
+        """
+        Forget about disks that are not in ``devnames`` anymore
+        """
+        for devname in self._entries.keys():
+            if devname not in devnames:
+                del self._entries[devname]
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(tmp, self.path)
+            self._dirty = False
+        except (IOError, OSError), e:
+            log.warn("Unable to write %s: %s", self.path, e)
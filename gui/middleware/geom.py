@@ -0,0 +1,329 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Parsed model of the GEOM tree (sysctl kern.geom.confxml)
+
+The XML is parsed once into Geom/Provider/Consumer objects indexed by
+id, class and name, provider name, disk ident, label and GPT rawuuid,
+so lookups no longer need an XPath query over the whole tree.
+
+A parsed topology is shared between operations as long as the stamp
+file is left alone; devd touches it on every GEOM/DEVFS event (see
+/etc/devd/geom.conf) and invalidate() does the same after the
+middleware changes the tree itself.
+"""
+import logging
+import os
+import threading
+import time
+
+from xml.etree import cElementTree as ElementTree
+
+log = logging.getLogger('middleware.geom')
+
+STAMPFILE = '/var/run/geom.stamp'
+# Upper bound on the age of a shared topology, in case an event is missed
+CACHE_TTL = 60
+
+
+def _config(node):
+    if node is None:
+        return {}
+    return dict((child.tag, child.text or '') for child in node)
+
+
+class Geom(object):
+
+    def __init__(self, cls, node):
+        self.id = node.get('id')
+        self.cls = cls
+        self.name = node.findtext('name')
+        self.rank = node.findtext('rank')
+        config = node.find('config')
+        # Some geoms (e.g. gmirror synchronization) have no config at all
+        self.has_config = config is not None
+        self.config = _config(config)
+        self.providers = []
+        self.consumers = []
+
+    def __repr__(self):
+        return "<Geom: %s/%s>" % (self.cls, self.name)
+
+
+class Provider(object):
+
+    def __init__(self, geom, node):
+        self.id = node.get('id')
+        self.geom = geom
+        self.name = node.findtext('name')
+        self.mode = node.findtext('mode')
+        self.mediasize = node.findtext('mediasize')
+        self.sectorsize = node.findtext('sectorsize')
+        self.config = _config(node.find('config'))
+
+    def __repr__(self):
+        return "<Provider: %s>" % self.name
+
+
+class Consumer(object):
+
+    def __init__(self, geom, node):
+        self.id = node.get('id')
+        self.geom = geom
+        self.mode = node.findtext('mode')
+        self.config = _config(node.find('config'))
+        ref = node.find('provider')
+        self.provider_ref = ref.get('ref') if ref is not None else None
+        # Resolved once the whole tree has been read
+        self.provider = None
+
+    def __repr__(self):
+        return "<Consumer: %s of %s>" % (self.provider, self.geom)
+
+
+class GEOMTopology(object):
+
+    def __init__(self, confxml):
+        if isinstance(confxml, unicode):
+            confxml = confxml.encode('utf-8')
+        self.classes = {}
+        self.providers = {}
+        self.provider_names = {}
+        self.idents = {}
+        self.rawuuids = {}
+        self._geoms = {}
+        self._consumers_of = {}
+
+        consumers = []
+        for cnode in ElementTree.fromstring(confxml).findall('class'):
+            cls = cnode.findtext('name')
+            geoms = self.classes.setdefault(cls, [])
+            for gnode in cnode.findall('geom'):
+                geom = Geom(cls, gnode)
+                geoms.append(geom)
+                self._geoms.setdefault((cls, geom.name), geom)
+                for pnode in gnode.findall('provider'):
+                    prov = Provider(geom, pnode)
+                    geom.providers.append(prov)
+                    self.providers[prov.id] = prov
+                    self.provider_names.setdefault(prov.name, prov)
+                    if cls == 'DISK' and prov.config.get('ident'):
+                        self.idents.setdefault(
+                            prov.config['ident'], []
+                        ).append(prov)
+                    if cls == 'PART' and prov.config.get('rawuuid'):
+                        self.rawuuids.setdefault(
+                            prov.config['rawuuid'], []
+                        ).append(prov)
+                for conode in gnode.findall('consumer'):
+                    consumer = Consumer(geom, conode)
+                    geom.consumers.append(consumer)
+                    consumers.append(consumer)
+
+        for consumer in consumers:
+            consumer.provider = self.providers.get(consumer.provider_ref)
+            self._consumers_of.setdefault(
+                consumer.provider_ref, []
+            ).append(consumer)
+
+    def geoms(self, cls):
+        return self.classes.get(cls, [])
+
+    def geom(self, cls, name):
+        return self._geoms.get((cls, name))
+
+    def provider(self, id):
+        return self.providers.get(id)
+
+    def provider_by_name(self, name, cls=None):
+        prov = self.provider_names.get(name)
+        if prov is not None and cls is not None and prov.geom.cls != cls:
+            return None
+        return prov
+
+    def by_ident(self, ident):
+        return self.idents.get(ident, [])
+
+    def by_label(self, label):
+        """
+        Provider of the GEOM_LABEL ``label`` (e.g. gptid/..., ufs/name)
+        """
+        return self.provider_by_name(label, 'LABEL')
+
+    def by_rawuuid(self, rawuuid):
+        return self.rawuuids.get(rawuuid, [])
+
+    def rawuuid(self, name):
+        """
+        GPT rawuuid of the partition ``name``
+        """
+        prov = self.provider_by_name(name, 'PART')
+        if prov is None:
+            return None
+        return prov.config.get('rawuuid') or None
+
+    def part_rawuuid(self, name, type):
+        """
+        GPT rawuuid of the partition ``name`` if it is of ``type``, or of
+        the first partition of ``type`` on the disk ``name``
+        """
+        prov = self.provider_by_name(name, 'PART')
+        if prov is not None:
+            provs = [prov]
+        else:
+            provs = self.partitions(name)
+        for prov in provs:
+            if prov.config.get('type') == type and prov.config.get('rawuuid'):
+                return prov.config['rawuuid']
+        return None
+
+    def consumers_of(self, provider):
+        return self._consumers_of.get(provider.id, [])
+
+    def mediasize(self, name):
+        """
+        Media size of the disk ``name`` as a string, None if not a disk
+        """
+        geom = self.geom('DISK', name)
+        if geom is None or not geom.providers:
+            return None
+        return geom.providers[0].mediasize
+
+    def backing_provider(self, provider):
+        """
+        Provider consumed by the geom of ``provider``, e.g. the partition
+        under a label or the disk under a partition
+        """
+        for consumer in provider.geom.consumers:
+            if consumer.provider is not None:
+                return consumer.provider
+        return None
+
+    def label_target(self, label):
+        """
+        Provider labeled as ``label``, None if there is no such label
+        """
+        prov = self.by_label(label)
+        if prov is None:
+            return None
+        return self.backing_provider(prov)
+
+    def dev_target(self, name):
+        """
+        Provider behind the /dev entry ``name`` (GEOM_DEV)
+        """
+        geom = self.geom('DEV', name)
+        if geom is None:
+            return None
+        for consumer in geom.consumers:
+            if consumer.provider is not None:
+                return consumer.provider
+        return None
+
+    def labels(self, provider):
+        """
+        GEOM_LABEL providers of ``provider``
+        """
+        return [
+            c.geom.providers[0] for c in self.consumers_of(provider)
+            if c.geom.cls == 'LABEL' and c.geom.providers
+        ]
+
+    def partitions(self, disk, type=None):
+        """
+        Partition providers of ``disk``, of GPT ``type`` if given
+        """
+        geom = self.geom('PART', disk)
+        if geom is None:
+            return []
+        if type is None:
+            return list(geom.providers)
+        return [p for p in geom.providers if p.config.get('type') == type]
+
+    def dependents(self, provider):
+        """
+        All geoms stacked on top of ``provider``, recursively
+        """
+        geoms = []
+        for consumer in self.consumers_of(provider):
+            geoms.append(consumer.geom)
+            for prov in consumer.geom.providers:
+                geoms.extend(self.dependents(prov))
+        return geoms
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _stamp():
+    try:
+        st = os.stat(STAMPFILE)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def get_topology(loader):
+    """
+    Return the shared topology, calling ``loader`` for kern.geom.confxml
+    if it has been invalidated since it was built.
+    """
+    stamp = _stamp()
+    now = time.time()
+    with _cache_lock:
+        if (
+            stamp is not None and
+            _cache.get('stamp') == stamp and
+            # mtime may only have a 1 second resolution
+            _cache['built'] > stamp[1] + 1 and
+            now - _cache['built'] < CACHE_TTL
+        ):
+            return _cache['topology']
+    topology = GEOMTopology(loader())
+    with _cache_lock:
+        _cache.update({
+            'stamp': stamp,
+            'built': now,
+            'topology': topology,
+        })
+    return topology
+
+
+def invalidate():
+    """
+    Drop the shared topology, in this and every other process
+    """
+    with _cache_lock:
+        _cache.clear()
+    try:
+        tmp = "%s.%d" % (STAMPFILE, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write("%f\n" % time.time())
+        os.rename(tmp, STAMPFILE)
+    except (IOError, OSError), e:
+        log.debug("Unable to update %s: %s", STAMPFILE, e)
@@ -45,19 +45,19 @@ class Multipath(object):
             devs.append(consumer.devname)
         return devs
 
-    def __init__(self, doc, xmlnode):
-        self.name = xmlnode.xpathEval("./name")[0].content
+    def __init__(self, topology, geom):
+        self.name = geom.name
         self.devname = "multipath/%s" % self.name
-        self._status =  xmlnode.xpathEval("./config/State")[0].content
+        self._status = geom.config.get('State', 'Unknown')
         self.consumers = []
-        for consumer in xmlnode.xpathEval("./consumer"):
-            status = consumer.xpathEval("./config/State")[0].content
-            provref = consumer.xpathEval("./provider/@ref")[0].content
-            prov = doc.xpathEval("//provider[@id = '%s']" % provref)[0]
-            self.consumers.append(Consumer(status, prov))
+        for consumer in geom.consumers:
+            status = consumer.config.get('State', 'Unknown')
+            if consumer.provider is None:
+                continue
+            self.consumers.append(Consumer(status, consumer.provider))
 
-        self.__xml = xmlnode
-        self.__doc = doc
+        self.__geom = geom
+        self.__topology = topology
 
     def __repr__(self):
         return "<Multipath:%s [%s]>" % (self.name, ",".join(self.devices))
@@ -65,11 +65,8 @@ class Multipath(object):
 
 class Consumer(object):
 
-    def __init__(self, status, xmlnode):
+    def __init__(self, status, provider):
         self.status = status
-        self.devname = xmlnode.xpathEval("./name")[0].content
-        try:
-            self.lunid = xmlnode.xpathEval("./config/lunid")[0].content
-        except:
-            self.lunid = ''
-        self.__xml = xmlnode
+        self.devname = provider.name
+        self.lunid = provider.config.get('lunid', '')
+        self.__provider = provider
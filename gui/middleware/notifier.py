@@ -36,11 +36,11 @@ actions.
 
 from collections import defaultdict, OrderedDict
 from decimal import Decimal
+from multiprocessing.pool import ThreadPool
 import ctypes
 import errno
 import glob
 import grp
-import libxml2
 import logging
 import os
 import pipes
@@ -93,7 +93,6 @@ from freenasUI.common.pbi import (
     PBI_PATCH_FLAGS_OUTDIR, PBI_PATCH_FLAGS_NOCHECKSIG
 )
 from freenasUI.common.system import (
-    exclude_path,
     get_mounted_filesystems,
     umount,
     get_sw_name
@@ -101,7 +100,7 @@ from freenasUI.common.system import (
 from freenasUI.common.warden import (Warden, WardenJail,
     WARDEN_TYPE_PLUGINJAIL, WARDEN_STATUS_RUNNING)
 from freenasUI.freeadmin.hook import HookMetaclass
-from freenasUI.middleware import zfs
+from freenasUI.middleware import diskcache, geom, permission, zfs, zfsstate
 from freenasUI.middleware.encryption import random_wipe
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.multipath import Multipath
@@ -110,6 +109,11 @@ import sysctl
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
 log = logging.getLogger('middleware.notifier')
 
+# Snapshots of replication remotes, keyed by (host, port, user)
+REPL_REMOTE_SNAPSHOTS_TTL = 120
+_repl_remote_snapshots = {}
+_repl_remote_snapshots_lock = threading.Lock()
+
 
 class StartNotify(threading.Thread):
     """
@@ -250,6 +254,7 @@ class notifier:
             'upsmon': ('upsmon', '/var/db/nut/upsmon.pid'),
             'smartd': ('smartd', '/var/run/smartd.pid'),
             'webshell': (None, '/var/run/webshell.pid'),
+            'zfsstate': (None, '/var/run/zfsstate.pid'),
         }
 
     def _started_notify(self, verb, what):
@@ -386,6 +391,19 @@ class notifier:
             pass
         self._system_nolog("/usr/local/bin/python /usr/local/www/freenasUI/tools/webshell.py")
 
+    def _start_zfsstate(self):
+        self._system_nolog("/usr/local/bin/python /usr/local/www/freenasUI/tools/zfsstate.py")
+
+    def _restart_zfsstate(self):
+        try:
+            with open('/var/run/zfsstate.pid', 'r') as f:
+                pid = f.read()
+                os.kill(int(pid), signal.SIGTERM)
+                time.sleep(0.2)
+        except:
+            pass
+        self._system_nolog("/usr/local/bin/python /usr/local/www/freenasUI/tools/zfsstate.py")
+
     def _restart_iscsitarget(self):
         self._system("/usr/sbin/service ix-istgt quietstart")
         self._system("/usr/sbin/service istgt forcestop")
@@ -1028,8 +1046,8 @@ class notifier:
                 raise MiddlewareError('Unable to GPT format the disk "%s"' % devname)
 
         # We might need to sync with reality (e.g. devname -> uuid)
-        # Invalidating confxml is required or changes wont be seen
-        self.__confxml = None
+        # Invalidating the GEOM topology is required or changes wont be seen
+        self._geom_invalidate()
         self.sync_disk(devname)
 
     def __gpt_unlabeldisk(self, devname):
@@ -1045,8 +1063,8 @@ class notifier:
         self._system("gpart destroy -F /dev/%s" % devname)
 
         # We might need to sync with reality (e.g. uuid -> devname)
-        # Invalidating confxml is required or changes wont be seen
-        self.__confxml = None
+        # Invalidating the GEOM topology is required or changes wont be seen
+        self._geom_invalidate()
         self.sync_disk(devname)
 
     def unlabel_disk(self, devname):
@@ -1218,12 +1236,8 @@ class notifier:
                 raise MiddlewareError("Unable to remove key: %s" % (err, ))
 
     def geli_is_decrypted(self, dev):
-        doc = self._geom_confxml()
-        geom = doc.xpathEval("//class[name = 'ELI']/geom[name = '%s.eli']" % (
-            dev,
-            )
-            )
-        if geom:
+        topology = self._geom_topology()
+        if topology.geom('ELI', '%s.eli' % (dev, )):
             return True
         return False
 
@@ -1327,19 +1341,20 @@ class notifier:
         (GELI on UFS not supported yet)
         """
         providers = []
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         disks = self.get_disks()
         for disk in disks:
-            parts = [node.content for node in doc.xpathEval("//class[name = 'PART']/geom[name = '%s']/provider/config[type = 'freebsd-zfs']/../name" % disk)]
+            parts = [prov.name for prov in topology.partitions(disk, 'freebsd-zfs')]
             if not parts:
                 parts = [disk]
             for part in parts:
                 proc = self._pipeopen("geli dump %s" % part)
                 proc.communicate()
                 if proc.returncode == 0:
-                    gptid = doc.xpathEval("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % part)
+                    prov = topology.provider_by_name(part)
+                    gptid = topology.labels(prov) if prov else []
                     if gptid:
-                        providers.append((gptid[0].content, part))
+                        providers.append((gptid[0].name, part))
                     else:
                         providers.append((part, part))
         return providers
@@ -1351,27 +1366,22 @@ class notifier:
                                  devname = disk,
                                  swapsize=swapsize)
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         for disk in disks:
             devname = self.part_type_from_device('zfs', disk)
+            uuid = topology.rawuuid(devname)
             if encrypt:
-                uuid = doc.xpathEval("//class[name = 'PART']"
-                    "/geom//provider[name = '%s']/config/rawuuid" % (devname, )
-                    )
                 if not uuid:
                     log.warn("Could not determine GPT uuid for %s", devname)
                     raise MiddlewareError('Unable to determine GPT UUID for %s' % devname)
                 else:
-                    devname = self.__encrypt_device("gptid/%s" % uuid[0].content, disk, volume)
+                    devname = self.__encrypt_device("gptid/%s" % uuid, disk, volume)
             else:
-                uuid = doc.xpathEval("//class[name = 'PART']"
-                    "/geom//provider[name = '%s']/config/rawuuid" % (devname, )
-                    )
                 if not uuid:
                     log.warn("Could not determine GPT uuid for %s", devname)
                     devname = "/dev/%s" % devname
                 else:
-                    devname = "/dev/gptid/%s" % uuid[0].content
+                    devname = "/dev/gptid/%s" % uuid
             vdevs.append(devname)
 
         return vdevs
@@ -1524,6 +1534,8 @@ class notifier:
         zfsproc = self._pipeopen("/sbin/zfs create %s -V %s %s" % (options, size, name))
         zfs_err = zfsproc.communicate()[1]
         zfs_error = zfsproc.wait()
+        if zfs_error == 0:
+            zfsstate.invalidate(name)
         return zfs_error, zfs_err
 
     def create_zfs_dataset(self, path, props=None):
@@ -1538,37 +1550,27 @@ class notifier:
         zfs_output, zfs_err = zfsproc.communicate()
         zfs_error = zfsproc.wait()
         if zfs_error == 0:
+            zfsstate.invalidate(path)
             self.restart("collectd")
         return zfs_error, zfs_err
 
     def list_zfs_vols(self, volname):
         """Return a dictionary that contains all ZFS volumes list"""
-        zfsproc = self._pipeopen("/sbin/zfs list -H -o name,volsize,used,avail,refer -t volume -r %s" % (str(volname),))
-        zfs_output, zfs_err = zfsproc.communicate()
-        zfs_output = zfs_output.split('\n')
+        rows = zfsstate.dataset_rows(str(volname), types='volume')
         retval = {}
-        for line in zfs_output:
-            if line == "":
-                continue
-            data = line.split('\t')
+        for data in rows:
             retval[data[0]] = {
-                'volsize': data[1],
-                'used': data[2],
-                'avail': data[3],
-                'refer': data[4],
+                'volsize': zfs.zfs_nicenum(data[6]),
+                'used': zfs.zfs_nicenum(data[2]),
+                'avail': zfs.zfs_nicenum(data[3]),
+                'refer': zfs.zfs_nicenum(data[4]),
             }
         return retval
 
     def list_zfs_fsvols(self):
-        proc = self._pipeopen("/sbin/zfs list -H -o name -t volume,filesystem")
-        out, err = proc.communicate()
-        out = out.split('\n')
         retval = OrderedDict()
-        if proc.returncode == 0:
-            for line in out:
-                if not line:
-                    continue
-                retval[line] = line
+        for data in zfsstate.dataset_rows():
+            retval[data[0]] = data[0]
         return retval
 
     def __snapshot_hold(self, name):
@@ -1584,14 +1586,27 @@ class notifier:
                 return True
         return False
 
-    def repl_remote_snapshots(self, repl):
+    def repl_remote_snapshots(self, repl, cached=True):
         """
-        Get a list of snapshots in the remote side
+        Get the set of snapshots in the remote side
+
+        The result is kept for REPL_REMOTE_SNAPSHOTS_TTL seconds per
+        remote so it is not fetched over ssh on every request.
         """
         if repl.repl_remote.ssh_remote_dedicateduser_enabled:
             user = repl.repl_remote.ssh_remote_dedicateduser
         else:
             user = 'root'
+        key = (
+            repl.repl_remote.ssh_remote_hostname,
+            repl.repl_remote.ssh_remote_port,
+            user,
+        )
+        now = time.time()
+        with _repl_remote_snapshots_lock:
+            entry = _repl_remote_snapshots.get(key)
+        if cached and entry and now - entry[0] < REPL_REMOTE_SNAPSHOTS_TTL:
+            return entry[1]
         proc = self._pipeopen('/usr/bin/ssh -i /data/ssh/replication -o ConnectTimeout=3 -p %s %s@%s "zfs list -Ht snapshot -o name"' % (
             repl.repl_remote.ssh_remote_port,
             user,
@@ -1599,8 +1614,12 @@ class notifier:
         ))
         data = proc.communicate()[0]
         if proc.returncode != 0:
-            return []
-        return data.strip('\n').split('\n')
+            snaps = frozenset()
+        else:
+            snaps = frozenset(data.strip('\n').split('\n'))
+        with _repl_remote_snapshots_lock:
+            _repl_remote_snapshots[key] = (now, snaps)
+        return snaps
 
     def destroy_zfs_dataset(self, path, recursive=False):
         retval = None
@@ -1628,6 +1647,7 @@ class notifier:
             else:
                 zfsproc = self._pipeopen("zfs destroy %s" % (path))
             retval = zfsproc.communicate()[1]
+            zfsstate.invalidate(path, recursive=recursive)
             if zfsproc.returncode == 0:
                 from freenasUI.storage.models import Task, Replication
                 Task.objects.filter(task_filesystem=path).delete()
@@ -1643,6 +1663,7 @@ class notifier:
     def destroy_zfs_vol(self, name):
         zfsproc = self._pipeopen("zfs destroy %s" % (str(name),))
         retval = zfsproc.communicate()[1]
+        zfsstate.invalidate(str(name))
         return retval
 
     def __destroy_zfs_volume(self, volume):
@@ -1651,6 +1672,7 @@ class notifier:
         # First, destroy the zpool.
         disks = volume.get_disks()
         self._system("zpool destroy -f %s" % (vol_name, ))
+        zfsstate.invalidate(vol_name, recursive=True)
 
         # Clear out disks associated with the volume
         for disk in disks:
@@ -1700,7 +1722,7 @@ class notifier:
         provider = self.get_label_consumer('ufs', u_name)
         if not provider:
             return None
-        geom_type = provider.xpathEval("../../name")[0].content.lower()
+        geom_type = provider.geom.cls.lower()
 
         if geom_type not in ('mirror', 'stripe', 'raid3'):
             # Grab disk from the group
@@ -1708,7 +1730,7 @@ class notifier:
             self._system("umount -f /dev/ufs/" + u_name)
             self.__gpt_unlabeldisk(devname = disk)
         else:
-            g_name = provider.xpathEval("../name")[0].content
+            g_name = provider.geom.name
             self._system("swapoff -a")
             self._system("umount -f /dev/ufs/" + u_name)
             self._system("geom %s stop %s" % (geom_type, g_name))
@@ -1765,16 +1787,13 @@ class notifier:
         if to_label == '':
             raise MiddlewareError('freebsd-zfs partition could not be found')
 
-        doc = self._geom_confxml()
-        uuid = doc.xpathEval("//class[name = 'PART']"
-            "/geom//provider[name = '%s']/config/rawuuid" % (to_label, )
-            )
+        uuid = self._geom_topology().rawuuid(to_label)
         if not encrypt:
             if not uuid:
                 log.warn("Could not determine GPT uuid for %s", to_label)
                 devname = to_label
             else:
-                devname = "gptid/%s" % uuid[0].content
+                devname = "gptid/%s" % uuid
         else:
             if not uuid:
                 log.warn("Could not determine GPT uuid for %s", to_label)
@@ -1783,7 +1802,7 @@ class notifier:
                 from_diskobj = Disk.objects.filter(disk_name=from_disk, disk_enabled=True)
                 if from_diskobj.exists():
                     EncryptedDisk.objects.filter(encrypted_volume=volume, encrypted_disk=from_diskobj[0]).delete()
-                devname = self.__encrypt_device("gptid/%s" % uuid[0].content, to_disk, volume, passphrase=passphrase)
+                devname = self.__encrypt_device("gptid/%s" % uuid, to_disk, volume, passphrase=passphrase)
 
         larger_ashift = 0
         try:
@@ -2009,7 +2028,7 @@ class notifier:
         self._system("/usr/sbin/service swap1 quietstart")
         self._system("/usr/sbin/service mountlate quietstart")
         self.restart("collectd")
-        self.__confxml = None
+        self._geom_invalidate()
 
     # Create a user in system then samba
     def __pw_with_password(self, command, password):
@@ -2316,34 +2335,48 @@ class notifier:
             winexists = False
 
         if winexists:
-            if not mode:
-                mode = '0755'
-            script = "/usr/local/www/freenasUI/tools/winacl.sh"
-            args=" -o '%s' -g '%s' -d %s " % (user, group, mode)
-            if recursive:
-                apply_paths = exclude_path(path, exclude)
-                apply_paths = map(lambda y: (y, ' -r '), apply_paths)
-                if len(apply_paths) > 1:
-                    apply_paths.insert(0, (path, ''))
-            else:
-                apply_paths = [(path, '')]
-            for apath, flags in apply_paths:
-                fargs = args + "%s -p '%s'" % (flags, apath)
-                cmd = "%s %s" % (script, fargs)
-                log.debug("XXX: CMD = %s", cmd)
-                self._system(cmd)
-
+            # The ACL is reset instead, as tools/winacl.sh did
+            mode = None
         else:
-            if recursive:
-                apply_paths = exclude_path(path, exclude)
-                apply_paths = map(lambda y: (y, '-R'), apply_paths)
-                if len(apply_paths) > 1:
-                    apply_paths.insert(0, (path, ''))
-            else:
-                apply_paths = [(path, '')]
-            for apath, flags in apply_paths:
-                self._system("/usr/sbin/chown %s '%s':'%s' '%s'" % (flags, user, group, apath))
-                self._system("/bin/chmod %s %s '%s'" % (flags, mode, apath))
+            mode = int(mode, 8)
+
+        try:
+            uid = pwd.getpwnam(user).pw_uid
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError, e:
+            raise MiddlewareError(_("Unknown user or group: %s") % e)
+
+        if not recursive:
+            try:
+                permission.apply_one(
+                    path, os.lstat(path), uid, gid, mode, winacl=winexists
+                )
+            except OSError, e:
+                raise MiddlewareError(
+                    _("Failed to change permissions: %s") % e
+                )
+            return
+
+        progress = permission.get_progress()
+        if progress and progress['state'] in ('starting', 'running'):
+            raise MiddlewareError(_(
+                "Permissions of %s are still being changed"
+            ) % progress['path'])
+
+        # Walks the tree in the background, see middleware/permission.py
+        args = [
+            "/usr/local/bin/python",
+            "/usr/local/www/freenasUI/tools/permission.py",
+        ]
+        if winexists:
+            args.append('-a')
+        if mode is not None:
+            args.extend(['-m', '%o' % mode])
+        for e in exclude:
+            args.extend(['-x', e])
+        args.extend([str(uid), str(gid), path])
+        if subprocess.Popen(args, close_fds=True).wait() != 0:
+            raise MiddlewareError(_("Failed to start changing permissions"))
 
     def mp_get_permission(self, path):
         if os.path.isdir(path):
@@ -2398,12 +2431,9 @@ class notifier:
 
         sw_name = get_sw_name()
         label = "%smdu" % (sw_name, )
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
-        pref = doc.xpathEval("//class[name = 'LABEL']/geom/"
-            "provider[name = 'ufs/%s']/../consumer/provider/@ref" % (label, ))
-        #prov = doc.xpathEval("//provider[@id = '%s']" % pref[0].content)
-        if not pref:
+        if not topology.label_target('ufs/%s' % (label, )):
             proc = self._pipeopen("/sbin/mdconfig -a -t swap -s 2800m")
             mddev, err = proc.communicate()
             if proc.returncode != 0:
@@ -2438,17 +2468,13 @@ class notifier:
 
         sw_name = get_sw_name()
         label = "%smdu" % (sw_name, )
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
-        pref = doc.xpathEval("//class[name = 'LABEL']/geom/"
-            "provider[name = 'ufs/%s']/../consumer/provider/@ref" % (label, ))
-        if not pref:
-            return False
-        prov = doc.xpathEval("//class[name = 'MD']//provider[@id = '%s']/name" % pref[0].content)
-        if not prov:
+        prov = topology.label_target('ufs/%s' % (label, ))
+        if not prov or prov.geom.cls != 'MD':
             return False
 
-        mddev = prov[0].content
+        mddev = prov.name
 
         self._system("umount /dev/ufs/%s" % (label, ))
         proc = self._pipeopen("mdconfig -d -u %s" % (mddev, ))
@@ -2459,10 +2485,35 @@ class notifier:
         return True
 
 
-    def validate_update(self, path):
+    def validate_update(self, path, extracted=False):
+        """
+        Extract the update image ``path`` and run its pre-install checks
+
+        ``extracted`` tells the image has already been extracted next to
+        it while it was uploaded (see system/firmware.py) and only the
+        checks are left.
+        """
 
         os.chdir(os.path.dirname(path))
 
+        if not extracted:
+            self._extract_update(path)
+
+        try:
+            subprocess.check_output(
+                                    ['bin/install_worker.sh', 'pre-install'],
+                                    stderr=subprocess.STDOUT,
+                                    )
+        except subprocess.CalledProcessError, cpe:
+            raise MiddlewareError('The firmware does not meet the '
+                                  'pre-install criteria: %s' % (cpe.output, ))
+        finally:
+            os.chdir('/')
+        # XXX: bleh
+        return True
+
+    def _extract_update(self, path):
+
         # XXX: ugly
         self._system("rm -rf */")
 
@@ -2504,18 +2555,6 @@ class notifier:
             fp.write("3|\n")
             fp.flush()
         os.unlink('/tmp/.extract_progress')
-        try:
-            subprocess.check_output(
-                                    ['bin/install_worker.sh', 'pre-install'],
-                                    stderr=subprocess.STDOUT,
-                                    )
-        except subprocess.CalledProcessError, cpe:
-            raise MiddlewareError('The firmware does not meet the '
-                                  'pre-install criteria: %s' % (cpe.output, ))
-        finally:
-            os.chdir('/')
-        # XXX: bleh
-        return True
 
     def apply_update(self, path):
         os.chdir(os.path.dirname(path))
@@ -3058,13 +3097,12 @@ class notifier:
             provider = self.get_label_consumer('ufs', name)
             if not provider:
                 return 'UNKNOWN'
-            gtype = provider.xpathEval("../../name")[0].content
+            gtype = provider.geom.cls
 
             if gtype in ('MIRROR', 'STRIPE', 'RAID3'):
 
-                search = provider.xpathEval("../config/State")
-                if len(search) > 0:
-                    status = search[0].content
+                if 'State' in provider.geom.config:
+                    status = provider.geom.config['State']
 
             else:
                 p1 = self._pipeopen('mount|grep "/dev/ufs/%s"' % (name, ))
@@ -3206,30 +3244,30 @@ class notifier:
         """
 
         volumes = []
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         # Detect GEOM mirror, stripe and raid3
-        for geom in ('mirror', 'stripe', 'raid3'):
-            search = doc.xpathEval("//class[name = '%s']/geom/config" % (geom.upper(),))
-            for entry in search:
-                label = entry.xpathEval('../name')[0].content
+        for gclass in ('mirror', 'stripe', 'raid3'):
+            for entry in topology.geoms(gclass.upper()):
+                if not entry.has_config:
+                    continue
+                label = entry.name
                 disks = []
-                for consumer in entry.xpathEval('../consumer/provider'):
-                    provider = consumer.prop("ref")
-                    device = doc.xpathEval("//class[name = 'DISK']//provider[@id = '%s']/name" % provider)
+                for consumer in entry.consumers:
+                    provider = consumer.provider
                     # The raid might be degraded
-                    if len(device) > 0:
-                        disks.append({'name': device[0].content})
+                    if provider is not None and provider.geom.cls == 'DISK':
+                        disks.append({'name': provider.name})
 
                 # Next thing is find out whether this is a raw block device or has GPT
                 #TODO: MBR?
-                search = doc.xpathEval("//class[name = 'PART']/geom[name = '%s/%s']/provider//config[type = 'freebsd-ufs']" % (geom,label))
+                search = topology.partitions('%s/%s' % (gclass, label), 'freebsd-ufs')
                 if len(search) > 0:
-                    label = search[0].xpathEval("../name")[0].content.split('/', 1)[1]
+                    label = search[0].name.split('/', 1)[1]
                 volumes.append({
                     'label': label,
                     'type': 'geom',
-                    'group_type': geom,
-                    'disks': {'vdevs': [{'disks': disks, 'name': geom}]},
+                    'group_type': gclass,
+                    'disks': {'vdevs': [{'disks': disks, 'name': gclass}]},
                     })
 
         pool_name = re.compile(r'pool: (?P<name>%s).*?id: (?P<id>\d+)' % (zfs.ZPOOL_NAME_RE, ), re.I|re.M|re.S)
@@ -3240,8 +3278,14 @@ class notifier:
             # get status part of the pool
             status = res.split('id: %s\n' % zid)[1].split('pool:')[0]
             try:
-                roots = zfs.parse_status(pool, doc, 'id: %s\n%s' % (zid, status))
+                roots = zfs.parse_status(
+                    pool, topology, 'id: %s\n%s' % (zid, status)
+                )
+            except (NameError, TypeError, AttributeError):
+                # Bugs, not a status we cannot make sense of
+                raise
             except Exception, e:
+                # The parser raises a plain Exception on unexpected vdevs
                 log.warn("Error parsing %s: %s", pool, e)
                 continue
 
@@ -3348,13 +3392,16 @@ class notifier:
             stdout, stderr = p1.communicate()
 
         if vol_fstype != 'ZFS':
-            geom_type = provider.xpathEval("../../name")[0].content.lower()
+            geom_type = provider.geom.cls.lower()
             if geom_type in ('mirror', 'stripe', 'raid3'):
-                g_name = provider.xpathEval("../name")[0].content
+                g_name = provider.geom.name
                 self._system("geom %s stop %s" % (geom_type, g_name))
 
         self.start("syslogd")
 
+        if vol_fstype == 'ZFS':
+            zfsstate.invalidate(vol_name, recursive=True)
+
         if not succeeded and p1.returncode:
             raise MiddlewareError('Failed to detach %s with "%s" (exited '
                                   'with %d): %s' %
@@ -3411,39 +3458,55 @@ class notifier:
     def zfs_snapshot_list(self, path=None):
         fsinfo = dict()
 
-        zfsproc = self._pipeopen("/sbin/zfs list -t volume -o name -H")
-        zvols = filter(lambda y: y != '', zfsproc.communicate()[0].split('\n'))
+        zvols = set(
+            row[0] for row in zfsstate.dataset_rows(types='volume')
+        )
 
-        if path:
-            zfsproc = self._pipeopen("/sbin/zfs list -r -t snapshot -H -S creation %s" % path)
-        else:
-            zfsproc = self._pipeopen("/sbin/zfs list -t snapshot -H -S creation")
-        lines = zfsproc.communicate()[0].split('\n')
-        for line in lines:
-            if line != '':
-                list = line.split('\t')
-                snapname = list[0]
-                used = list[1]
-                refer = list[3]
-                fs, name = snapname.split('@')
-                try:
-                    snaplist = fsinfo[fs]
-                    mostrecent = False
-                except:
-                    snaplist = []
-                    mostrecent = True
-                snaplist.insert(0,
-                    zfs.Snapshot(
-                        name=name,
-                        filesystem=fs,
-                        used=used,
-                        refer=refer,
-                        mostrecent=mostrecent,
-                        parent_type='filesystem' if fs not in zvols else 'volume'
-                    ))
-                fsinfo[fs] = snaplist
+        # Rows are ordered by creation within each dataset
+        for row in zfsstate.snapshot_rows(path):
+            fs = row[0].split('@', 1)[0]
+            fsinfo.setdefault(fs, []).append(zfs.Snapshot.from_row(
+                row,
+                parent_type='filesystem' if fs not in zvols else 'volume'
+            ))
+        for snaplist in fsinfo.values():
+            snaplist[-1].mostrecent = True
         return fsinfo
 
+    def zfs_snapshot_query(self, dataset=None, recursive=True, prefix=None,
+                           since=None, until=None, state=None, order=None,
+                           reverse=False, offset=0, limit=None):
+        """
+        Filtered, sorted and paginated snapshot listing
+
+        Only the requested page is turned into zfs.Snapshot objects.
+
+        Returns:
+            tuple(int, list)
+                int -> total number of snapshots matching the filters
+                list -> zfs.Snapshot objects of the page
+        """
+        total, rows = zfsstate.snapshot_query(
+            dataset=dataset,
+            recursive=recursive,
+            prefix=prefix,
+            since=since,
+            until=until,
+            state=state,
+            order=order,
+            reverse=reverse,
+            offset=offset,
+            limit=limit,
+        )
+        snaps = []
+        for row in rows:
+            snaps.append(zfs.Snapshot.from_row(
+                row,
+                parent_type=row[5] or 'filesystem',
+                mostrecent=row[6] == '1',
+            ))
+        return total, snaps
+
     def zfs_mksnap(self, dataset, name, recursive=False):
         if recursive:
             p1 = self._pipeopen("/sbin/zfs snapshot -r %s@%s" % (dataset, name))
@@ -3452,16 +3515,20 @@ class notifier:
         if p1.wait() != 0:
             err = p1.communicate()[1]
             raise MiddlewareError("Snapshot could not be taken: %s" % err)
+        zfsstate.invalidate("%s@%s" % (dataset, name), recursive=recursive)
         return True
 
     def zfs_clonesnap(self, snapshot, dataset):
         zfsproc = self._pipeopen('zfs clone %s %s' % (snapshot, dataset))
         retval = zfsproc.communicate()[1]
+        zfsstate.invalidate(dataset)
         return retval
 
     def rollback_zfs_snapshot(self, snapshot):
         zfsproc = self._pipeopen('zfs rollback %s' % (snapshot))
         retval = zfsproc.communicate()[1]
+        # Rolling back destroys every later snapshot of the dataset
+        zfsstate.invalidate(snapshot.split('@', 1)[0])
         return retval
 
     def config_restore(self):
@@ -3499,22 +3566,13 @@ class notifier:
     def zfs_get_options(self, name=None, recursive=False, props=None):
         noinherit_fields = ['quota', 'refquota', 'reservation', 'refreservation']
 
-        if props is None:
-            props = 'all'
-        else:
-            props = ','.join(props)
-
-        zfsproc = self._pipeopen("/sbin/zfs get %s -H -o name,property,value,source %s %s" % (
-            '-r' if recursive else '',
-            props,
-            str(name) if name else '',
-        ))
-        zfs_output = zfsproc.communicate()[0]
+        rows = zfsstate.property_rows(
+            str(name) if name else None,
+            recursive=recursive,
+            props=props,
+        )
         retval = {}
-        for line in zfs_output.split('\n'):
-            if not line:
-                continue
-            data = line.split('\t')
+        for data in rows:
             if recursive:
                 if data[0] not in retval:
                     dval = retval[data[0]] = {}
@@ -3543,6 +3601,8 @@ class notifier:
         zfsproc = self._pipeopen('zfs set %s=%s "%s"' % (item, value, name))
         err = zfsproc.communicate()[1]
         if zfsproc.returncode == 0:
+            # Children may inherit the property
+            zfsstate.invalidate(name, recursive='@' not in name)
             return True, None
         return False, err
 
@@ -3564,6 +3624,7 @@ class notifier:
         zfsproc = self._pipeopen(zfscmd)
         err = zfsproc.communicate()[1]
         if zfsproc.returncode == 0:
+            zfsstate.invalidate(name, recursive='@' not in name or recursive)
             return True, None
         return False, err
 
@@ -3625,8 +3686,8 @@ class notifier:
         provider = self.get_label_consumer('ufs', volume.vol_name)
         if not provider:
             raise ValueError("UFS Volume %s not found" % (volume.vol_name,))
-        class_name = provider.xpathEval("../../name")[0].content
-        geom_name = provider.xpathEval("../name")[0].content
+        class_name = provider.geom.cls
+        geom_name = provider.geom.name
 
         if class_name == "MIRROR":
             rv = self._system_nolog("geom mirror forget %s" % (geom_name,))
@@ -3640,9 +3701,10 @@ class notifier:
             return 0
 
         elif class_name == "RAID3":
-            numbers = provider.xpathEval("../consumer/config/Number")
-            ncomponents =int( provider.xpathEval("../config/Components")[0].content)
-            numbers = [int(node.content) for node in numbers]
+            ncomponents = int(provider.geom.config['Components'])
+            numbers = [int(consumer.config['Number'])
+                for consumer in provider.geom.consumers
+                if 'Number' in consumer.config]
             lacking = [x for x in xrange(ncomponents) if x not in numbers][0]
             p1 = self._pipeopen("geom raid3 insert -n %d %s %s" % \
                                         (lacking, str(geom_name), str(to_disk),))
@@ -3699,15 +3761,24 @@ class notifier:
         return self._system_nolog("ifconfig %s -laggport %s" % (lagg, iface))
 
     def __init__(self):
-        self.__confxml = None
+        self.__geom = None
         self.__camcontrol = None
         self.__diskserial = {}
         self.__twcli = {}
 
-    def _geom_confxml(self):
-        if self.__confxml is None:
-            self.__confxml = libxml2.parseDoc(self.sysctl('kern.geom.confxml'))
-        return self.__confxml
+    def _geom_topology(self):
+        """
+        GEOM topology for this operation, see middleware/geom.py
+        """
+        if self.__geom is None:
+            self.__geom = geom.get_topology(
+                lambda: self.sysctl('kern.geom.confxml')
+            )
+        return self.__geom
+
+    def _geom_invalidate(self):
+        self.__geom = None
+        geom.invalidate()
 
     def __get_twcli(self, controller):
         if controller in self.__twcli:
@@ -3728,6 +3799,16 @@ class notifier:
         if devname in self.__diskserial:
             return self.__diskserial.get(devname)
 
+        serial = self._probe_serial(devname)
+        if serial:
+            self.__diskserial[devname] = serial
+        return serial
+
+    def _probe_serial(self, devname):
+        """
+        Ask the disk for its serial number through smartctl, bypassing
+        every cache
+        """
         args = ["/dev/%s" % devname]
         camcontrol = self._camcontrol_list()
         info = camcontrol.get(devname)
@@ -3773,56 +3854,108 @@ class notifier:
         output = p1.communicate()[0]
         search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
         if search:
-            serial = search.group("serial")
-            self.__diskserial[devname] = serial
-            return serial
+            return search.group("serial")
         return None
 
+    def probe_disks(self, devnames, prune=False):
+        """
+        Load the serial number of ``devnames`` from the disk identity
+        cache, probing in parallel the disks not there or whose GEOM
+        entry has changed since (see middleware/diskcache.py).
+
+        Returns:
+            A dict(devname) = seconds spent probing, None for a cache hit
+        """
+        topology = self._geom_topology()
+        cache = diskcache.DiskIdentityCache()
+
+        times = {}
+        probe = []
+        for devname in devnames:
+            geom_disk = topology.geom('DISK', devname)
+            provider = geom_disk.providers[0] \
+                if geom_disk and geom_disk.providers else None
+            gen = diskcache.generation(provider)
+            entry = cache.get(devname, gen)
+            if entry is not None:
+                self.__diskserial[devname] = entry['serial']
+                times[devname] = None
+            else:
+                probe.append((devname, gen, provider))
+
+        if probe:
+            # Shared by all workers, parse it once up front
+            self._camcontrol_list()
+
+            def _probe(devname):
+                start = time.time()
+                return self._probe_serial(devname), time.time() - start
+
+            pool = ThreadPool(min(len(probe), diskcache.PROBE_WORKERS))
+            try:
+                results = pool.map(_probe, [item[0] for item in probe])
+            finally:
+                pool.close()
+                pool.join()
+
+            for (devname, gen, provider), (serial, elapsed) in zip(
+                probe, results
+            ):
+                times[devname] = elapsed
+                # smartctl may fail for now, do not remember that
+                if serial:
+                    self.__diskserial[devname] = serial
+                cache.set(
+                    devname,
+                    gen,
+                    serial=serial,
+                    mediasize=provider.mediasize if provider else None,
+                    ident=provider.config.get('ident') if provider else None,
+                )
+
+        if prune:
+            cache.prune(devnames)
+        cache.save()
+        return times
+
     def label_to_disk(self, name):
         """
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         # try to find the provider from GEOM_LABEL
-        search = doc.xpathEval("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0].content
-        else:
+        provider = topology.label_target(name)
+        if provider is None:
             # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpathEval("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0].content
-            else:
+            provider = topology.dev_target(name)
+            if provider is None:
                 return None
-        search = doc.xpathEval("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].content
-        if search[0].parent.parent.xpathEval("./name")[0].content in ('ELI', ):
+        disk = provider.geom.name
+        if provider.geom.cls in ('ELI', ):
             return self.label_to_disk(disk.replace(".eli", ""))
         return disk
 
     def device_to_identifier(self, name):
         name = str(name)
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         serial = self.serial_from_device(name)
         if serial:
             return "{serial}%s" % serial
 
-        search = doc.xpathEval("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].content
-        search = doc.xpathEval("//class[name = 'PART']/geom/..//*[name = '%s']//config[type = 'freebsd-ufs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].content
+        for type in ('freebsd-zfs', 'freebsd-ufs'):
+            uuid = topology.part_rawuuid(name, type)
+            if uuid:
+                return "{uuid}%s" % uuid
 
-        search = doc.xpathEval("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % name)
-        if len(search) > 0:
-            return "{label}%s" % search[0].content
+        provider = topology.provider_by_name(name)
+        labels = topology.labels(provider) if provider else []
+        if labels:
+            return "{label}%s" % labels[0].name
 
-        search = doc.xpathEval("//class[name = 'DEV']/geom[name = '%s']" % name)
-        if len(search) > 0:
+        if topology.geom('DEV', name):
             return "{devicename}%s" % name
 
         return ''
@@ -3832,7 +3965,7 @@ class notifier:
         if not ident:
             return None
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
         if not search:
@@ -3842,29 +3975,32 @@ class notifier:
         value = search.group("value")
 
         if tp == 'uuid':
-            search = doc.xpathEval("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.content.startswith("label"):
-                        return entry.content
+            for provider in topology.by_rawuuid(value):
+                if not provider.geom.name.startswith("label"):
+                    return provider.geom.name
             return None
 
         elif tp == 'label':
-            search = doc.xpathEval("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].content
+            provider = topology.by_label(value)
+            if provider is not None:
+                return provider.geom.name
             return None
 
         elif tp == 'serial':
-            for devname in self.__get_disks():
+            disks = self.__get_disks()
+            # GEOM ident is usually the serial, try those disks first
+            candidates = [
+                provider.name for provider in topology.by_ident(value)
+                if provider.name in disks
+            ]
+            for devname in candidates + disks:
                 serial = self.serial_from_device(devname)
                 if serial == value:
                     return devname
             return None
 
         elif tp == 'devicename':
-            search = doc.xpathEval("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
+            if topology.geom('DEV', value):
                 return value
             return None
         else:
@@ -3875,11 +4011,11 @@ class notifier:
         Given a partition a type and a disk name (adaX)
         get the first partition that matches the type
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         #TODO get from MBR as well?
-        search = doc.xpathEval("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-%s']/../name" % (device, name))
+        search = topology.partitions(device, 'freebsd-%s' % (name, ))
         if len(search) > 0:
-            return search[0].content
+            return search[0].name
         else:
             return ''
 
@@ -3896,23 +4032,20 @@ class notifier:
         Get the label consumer of a given ``geom`` with name ``name``
 
         Returns:
-            The provider xmlnode if found, None otherwise
+            The geom.Provider if found, None otherwise
         """
-        doc = self._geom_confxml()
-        xpath = doc.xpathEval("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % "%s/%s" % (geom, name))
-        if not xpath:
+        topology = self._geom_topology()
+        provider = topology.label_target("%s/%s" % (geom, name))
+        if provider is None:
             return None
-        providerid = xpath[0].content
-        provider = doc.xpathEval("//provider[@id = '%s']" % providerid)[0]
 
-        class_name = provider.xpathEval("../../name")[0].content
+        class_name = provider.geom.cls
 
         # We've got a GPT over the softraid, not raw UFS filesystem
         # So we need to recurse one more time
         if class_name == 'PART':
-            providerid = provider.xpathEval("../consumer/provider/@ref")[0].content
-            newprovider = doc.xpathEval("//provider[@id = '%s']" % providerid)[0]
-            class_name = newprovider.xpathEval("../../name")[0].content
+            newprovider = topology.backing_provider(provider)
+            class_name = newprovider.geom.cls
             # if this PART is really backed up by softraid the hypothesis was correct
             if class_name in ('STRIPE', 'MIRROR', 'RAID3'):
                 return newprovider
@@ -3921,21 +4054,20 @@ class notifier:
 
     def get_disks_from_provider(self, provider):
         disks = []
-        geomname = provider.xpathEval("../../name")[0].content
+        geomname = provider.geom.cls
         if geomname in ('DISK', 'PART'):
-            disks.append(provider.xpathEval("../name")[0].content)
+            disks.append(provider.geom.name)
         elif geomname in ('STRIPE', 'MIRROR', 'RAID3'):
-            doc = self._geom_confxml()
-            for prov in provider.xpathEval("../consumer/provider/@ref"):
-                prov2 = doc.xpathEval("//provider[@id = '%s']" % prov.content)[0]
-                disks.append(prov2.xpathEval("../name")[0].content)
+            for consumer in provider.geom.consumers:
+                if consumer.provider is not None:
+                    disks.append(consumer.provider.geom.name)
         else:
             #TODO log, could not get disks
             pass
         return disks
 
     def zpool_parse(self, name):
-        doc = self._geom_confxml()
+        doc = self._geom_topology()
         p1 = self._pipeopen("zpool status %s" % name)
         res = p1.communicate()[0]
         parse = zfs.parse_status(name, doc, res)
@@ -4014,9 +4146,10 @@ class notifier:
         if devname.find("/") != -1:
             return
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         self.__diskserial.clear()
         self.__camcontrol = None
+        times = self.probe_disks([devname])
 
         ident = self.device_to_identifier(devname)
         qs = Disk.objects.filter(disk_identifier=ident)
@@ -4035,22 +4168,46 @@ class notifier:
         if reg:
             disk.disk_subsystem = reg.group(1)
             disk.disk_number = int(reg.group(2))
-        mediasize = doc.xpathEval("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % devname)
+        mediasize = topology.mediasize(devname)
         if mediasize:
-            disk.disk_size = mediasize[0].content
+            disk.disk_size = mediasize
         disk.save()
+        return times
 
     def sync_disk_extra(self, disk, add=False):
         return
 
-    def sync_disks(self):
+    def _disk_changes(self, disk):
+        """
+        Fields of ``disk`` changed since it was loaded
+
+        Returns:
+            dict(field) = (old, new)
+        """
+        changes = {}
+        for field in disk._meta.fields:
+            old = disk._original_state.get(field.attname)
+            new = getattr(disk, field.attname)
+            if old != new:
+                changes[field.attname] = (old, new)
+        return changes
+
+    def sync_disks_plan(self, disks=None):
+        """
+        Compare the Disk table with the disks found in the system.
+        Nothing is written, see sync_disks() and tools/sync_disks.py -n
+
+        Returns:
+            A dict with the Disk objects to "create", the ones to "update"
+            as (disk, changes) tuples and the ones to "delete"
+        """
         from freenasUI.storage.models import Disk
 
-        doc = self._geom_confxml()
-        disks = self.__get_disks()
-        self.__diskserial.clear()
-        self.__camcontrol = None
+        topology = self._geom_topology()
+        if disks is None:
+            disks = self.__get_disks()
 
+        plan = {'create': [], 'update': [], 'delete': []}
         in_disks = {}
         serials = []
         for disk in Disk.objects.order_by('disk_enabled'):
@@ -4060,7 +4217,7 @@ class notifier:
                 # If we cant translate the indentifier to a device, give up
                 # If dskname has already been seen once then we are probably
                 # dealing with with multipath here
-                disk.delete()
+                plan['delete'].append(disk)
                 continue
             else:
                 disk.disk_enabled = True
@@ -4075,21 +4232,23 @@ class notifier:
             if disk.disk_serial:
                 serials.append(disk.disk_serial)
 
-            mediasize = doc.xpathEval("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % dskname)
+            mediasize = topology.mediasize(dskname)
             if mediasize:
-                disk.disk_size = mediasize[0].content
+                disk.disk_size = mediasize
 
             self.sync_disk_extra(disk, add=False)
 
             if dskname not in disks:
                 disk.disk_enabled = False
-                if disk._original_state.get("disk_enabled"):
-                    disk.save()
-                else:
+                if not disk._original_state.get("disk_enabled"):
                     #Duplicated disk entries in database
-                    disk.delete()
-            else:
-                disk.save()
+                    plan['delete'].append(disk)
+                    in_disks[dskname] = disk
+                    continue
+
+            changes = self._disk_changes(disk)
+            if changes:
+                plan['update'].append((disk, changes))
             in_disks[dskname] = disk
 
         for disk in disks:
@@ -4098,9 +4257,9 @@ class notifier:
                 d.disk_name = disk
                 d.disk_identifier = self.device_to_identifier(disk)
                 d.disk_serial = self.serial_from_device(disk) or ''
-                mediasize = doc.xpathEval("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+                mediasize = topology.mediasize(disk)
                 if mediasize:
-                    d.disk_size = mediasize[0].content
+                    d.disk_size = mediasize
                 if d.disk_serial:
                     if d.disk_serial in serials:
                         #Probably dealing with multipath here, do not add another
@@ -4112,7 +4271,42 @@ class notifier:
                     d.disk_subsystem = reg.group(1)
                     d.disk_number = int(reg.group(2))
                 self.sync_disk_extra(d, add=True)
-                d.save()
+                plan['create'].append(d)
+
+        return plan
+
+    def sync_disks_apply(self, plan):
+        """
+        Apply a plan from sync_disks_plan() in a single transaction
+        """
+        from django.db import transaction
+        from freenasUI.storage.models import Disk
+
+        with transaction.atomic():
+            for disk in plan['delete']:
+                disk.delete()
+            for disk, changes in plan['update']:
+                Disk.objects.filter(id=disk.id).update(**dict(
+                    (field, new) for field, (old, new) in changes.items()
+                ))
+            if plan['create']:
+                Disk.objects.bulk_create(plan['create'])
+
+        # Disk.save() is bypassed, do what it would have done
+        for disk, changes in plan['update']:
+            if 'disk_togglesmart' in changes:
+                self.restart("smartd")
+                break
+
+    def sync_disks(self):
+        disks = self.__get_disks()
+        self.__diskserial.clear()
+        self.__camcontrol = None
+        times = self.probe_disks(disks, prune=True)
+
+        self.sync_disks_apply(self.sync_disks_plan(disks))
+
+        return times
 
     def sync_encrypted(self, volume=None):
         """
@@ -4161,23 +4355,22 @@ class notifier:
         provider = self.get_label_consumer('ufs', volume.vol_name)
         if not provider:
             raise ValueError("UFS Volume %s not found" % (volume,))
-        class_name = provider.xpathEval("../../name")[0].content
+        class_name = provider.geom.cls
 
         items = []
         if class_name in ('MIRROR', 'RAID3', 'STRIPE'):
             if class_name == 'STRIPE':
-                statepath = "../config/State"
-                status = provider.xpathEval("../config/Status")[0].content
+                status = provider.geom.config['Status']
                 ncomponents = int(re.search(r'Total=(?P<total>\d+)', status).group("total"))
             else:
-                statepath = "./config/State"
-                ncomponents = int(provider.xpathEval("../config/Components")[0].content)
-            consumers = provider.xpathEval("../consumer")
-            doc = self._geom_confxml()
+                ncomponents = int(provider.geom.config['Components'])
+            consumers = provider.geom.consumers
             for consumer in consumers:
-                provid = consumer.xpathEval("./provider/@ref")[0].content
-                status = consumer.xpathEval(statepath)[0].content
-                name = doc.xpathEval("//provider[@id = '%s']/../name" % provid)[0].content
+                if class_name == 'STRIPE':
+                    status = provider.geom.config['State']
+                else:
+                    status = consumer.config['State']
+                name = consumer.provider.geom.name
                 items.append({
                     'type': 'dev',
                     'diskname': name,
@@ -4191,7 +4384,7 @@ class notifier:
                     'status': 'UNAVAIL',
                 })
         elif class_name == 'PART':
-            name = provider.xpathEval("../name")[0].content
+            name = provider.geom.name
             items.append({
                 'type': 'dev',
                 'diskname': name,
@@ -4207,9 +4400,9 @@ class notifier:
         Returns:
             A list of Multipath objects
         """
-        doc = self._geom_confxml()
-        return [Multipath(doc=doc, xmlnode=geom) \
-                for geom in doc.xpathEval("//class[name = 'MULTIPATH']/geom")
+        topology = self._geom_topology()
+        return [Multipath(topology=topology, geom=geom) \
+                for geom in topology.geoms('MULTIPATH')
             ]
 
     def multipath_create(self, name, consumers, actives=None, mode=None):
@@ -4231,8 +4424,8 @@ class notifier:
         p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         if p1.wait() != 0:
             return False
-        # We need to invalidate confxml cache
-        self.__confxml = None
+        # We need to invalidate the GEOM topology
+        self._geom_invalidate()
         if p1.wait() != 0:
             return False
         return True
@@ -4272,13 +4465,13 @@ class notifier:
         """
         from freenasUI.storage.models import Volume, Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         mp_disks = []
-        for geom in doc.xpathEval("//class[name = 'MULTIPATH']/geom"):
-            for provref in geom.xpathEval("./consumer/provider/@ref"):
-                prov = doc.xpathEval("//provider[@id = '%s']" % provref.content)[0]
-                class_name = prov.xpathEval("../../name")[0].content
+        for g in topology.geoms('MULTIPATH'):
+            for consumer in g.consumers:
+                prov = consumer.provider
+                class_name = prov.geom.cls
                 #For now just DISK is allowed
                 if class_name != 'DISK':
                     log.warn(
@@ -4287,7 +4480,7 @@ class notifier:
                         class_name
                     )
                     continue
-                disk = prov.xpathEval("../name")[0].content
+                disk = prov.geom.name
                 mp_disks.append(disk)
 
         reserved = [self._find_root_dev()]
@@ -4299,21 +4492,18 @@ class notifier:
         serials = defaultdict(list)
         active_active = []
         RE_CD = re.compile('^cd[0-9]')
-        for geom in doc.xpathEval("//class[name = 'DISK']/geom"):
-            name = geom.xpathEval("./name")[0].content
+        for g in topology.geoms('DISK'):
+            name = g.name
             if RE_CD.match(name) or name in reserved or name in mp_disks:
                 continue
-            if self._multipath_is_active(name, geom):
+            if self._multipath_is_active(name, g):
                 active_active.append(name)
             serial = self.serial_from_device(name) or ''
-            try:
-                lunid = geom.xpathEval("./provider/config/lunid")[0].content
-            except:
-                lunid = ''
+            lunid = g.providers[0].config.get('lunid', '')
             serial = serial + lunid
             if not serial:
                 continue
-            size = geom.xpathEval("./provider/mediasize")[0].content
+            size = g.providers[0].mediasize
             serials[(serial, size)].append(name)
 
         for disks in serials.values():
@@ -4322,18 +4512,17 @@ class notifier:
             name = self.multipath_next()
             self.multipath_create(name, disks, active_active)
 
-        # Grab confxml again to take new multipaths into account
-        doc = self._geom_confxml()
+        # Grab the topology again to take new multipaths into account
+        topology = self._geom_topology()
         mp_ids = []
-        for geom in doc.xpathEval("//class[name = 'MULTIPATH']/geom"):
+        for g in topology.geoms('MULTIPATH'):
             _disks = []
-            for provref in geom.xpathEval("./consumer/provider/@ref"):
-                prov = doc.xpathEval("//provider[@id = '%s']" % provref.content)[0]
-                class_name = prov.xpathEval("../../name")[0].content
+            for consumer in g.consumers:
+                prov = consumer.provider
                 #For now just DISK is allowed
-                if class_name != 'DISK':
+                if prov is None or prov.geom.cls != 'DISK':
                     continue
-                disk = prov.xpathEval("../name")[0].content
+                disk = prov.geom.name
                 _disks.append(disk)
             qs = Disk.objects.filter(
                 Q(disk_name__in=_disks)|Q(disk_multipath_member__in=_disks)
@@ -4341,7 +4530,7 @@ class notifier:
             if qs.exists():
                 diskobj = qs[0]
                 mp_ids.append(diskobj.id)
-                diskobj.disk_multipath_name = geom.xpathEval("./name")[0].content
+                diskobj.disk_multipath_name = g.name
                 if diskobj.disk_name in _disks:
                     _disks.remove(diskobj.disk_name)
                 if _disks:
@@ -4366,16 +4555,15 @@ class notifier:
         """
 
         sw_name = get_sw_name()
-        doc = self._geom_confxml()
-
-        for pref in doc.xpathEval("//class[name = 'LABEL']/geom/provider[" \
-                "starts-with(name, 'ufs/%ss')]/../consumer/provider/@ref" \
-                % (sw_name, )):
-            prov = doc.xpathEval("//provider[@id = '%s']" % pref.content)[0]
-            pid = prov.xpathEval("../consumer/provider/@ref")[0].content
-            prov = doc.xpathEval("//provider[@id = '%s']" % pid)[0]
-            name = prov.xpathEval("../name")[0].content
-            return name
+        topology = self._geom_topology()
+
+        for g in topology.geoms('LABEL'):
+            for label in g.providers:
+                if not label.name.startswith('ufs/%ss' % (sw_name, )):
+                    continue
+                prov = topology.backing_provider(label)
+                prov = topology.backing_provider(prov)
+                return prov.geom.name
         log.warn("Root device not found!")
 
     def __get_disks(self):
@@ -4423,16 +4611,14 @@ class notifier:
             A dict describing the gmirror
         """
 
-        doc = self._geom_confxml()
-        for geom in doc.xpathEval("//class[name = 'MIRROR']/geom[name = '%s']" % name):
+        geom = self._geom_topology().geom('MIRROR', name)
+        if geom is not None:
             consumers = []
-            gname = geom.xpathEval("./name")[0].content
-            status = geom.xpathEval("./config/State")[0].content
-            for consumer in geom.xpathEval("./consumer"):
-                ref = consumer.xpathEval("./provider/@ref")[0]
-                prov = doc.xpathEval("//provider[@id = '%s']" % ref.content)[0]
-                name = prov.xpathEval("./name")[0].content
-                status = consumer.xpathEval("./config/State")[0].content
+            gname = geom.name
+            status = geom.config['State']
+            for consumer in geom.consumers:
+                name = consumer.provider.name
+                status = consumer.config['State']
                 consumers.append({
                     'name': name,
                     'status': status,
@@ -4506,32 +4692,15 @@ class notifier:
             return False
         return True
 
-    def __get_geoms_recursive(self, prvid):
+    def disk_get_consumers(self, devname):
         """
-        Get _ALL_ geom nodes that depends on a given provider
+        Get _ALL_ geoms that depend on the disk ``devname``
         """
-        doc = self._geom_confxml()
-        geoms = []
-        for c in doc.xpathEval("//consumer/provider[@ref = '%s']" % (prvid, )):
-            geom = c.parent.parent
-            if geom.name != 'geom':
-                continue
-            geoms.append(geom)
-            for prov in geom.xpathEval('./provider'):
-                geoms.extend(self.__get_geoms_recursive(prov.prop('id')))
-
-        return geoms
-
-    def disk_get_consumers(self, devname):
-        doc = self._geom_confxml()
-        geom = doc.xpathEval("//class[name = 'DISK']/geom[name = '%s']" % (
-            devname,
-            ))
-        if geom:
-            provid = geom[0].xpathEval("./provider/@id")[0].content
-        else:
+        topology = self._geom_topology()
+        geom = topology.geom('DISK', devname)
+        if not geom or not geom.providers:
             raise ValueError("Unknown disk %s" % (devname, ))
-        return self.__get_geoms_recursive(provid)
+        return topology.dependents(geom.providers[0])
 
     def _do_disk_wipe_quick(self, devname):
         pipe = self._pipeopen("dd if=/dev/zero of=/dev/%s bs=1m count=1" % (devname, ))
@@ -4554,8 +4723,8 @@ class notifier:
 
     def disk_wipe(self, devname, mode='quick'):
         if mode == 'quick':
-            doc = self._geom_confxml()
-            parts = [node.content for node in doc.xpathEval("//class[name = 'PART']/geom[name = '%s']/provider/name" % devname)]
+            topology = self._geom_topology()
+            parts = [prov.name for prov in topology.partitions(devname)]
             """
             Wipe beginning and the end of every partition
             This should erase ZFS label and such to prevent further errors on replace
@@ -0,0 +1,412 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Recursive change of owner and mode
+
+The tree is walked once, applying owner and mode to every entry
+together and skipping entries which already have them. Once the top
+few levels have been expanded the remaining subtrees are shared
+between worker processes.
+
+For Windows ACLs the owner is changed and the ACL of every file and
+directory is reset to the owner@/group@/everyone@ entries of
+tools/winacl.sh in the same walk, with one setfacl for up to ACL_BATCH
+entries.
+
+A recursive change runs as a background job (tools/permission.py)
+which keeps PROGRESSFILE up to date and stops on SIGTERM.
+"""
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import stat
+import subprocess
+import tempfile
+import time
+
+log = logging.getLogger('middleware.permission')
+
+PIDFILE = '/var/tmp/permission.pid'
+PROGRESSFILE = '/var/tmp/permission.progress'
+WORKERS = 4
+# Subtrees handed out per worker, the more the better they balance
+SPLIT_FACTOR = 8
+SPLIT_DEPTH = 3
+
+SETFACL = '/bin/setfacl'
+# Paths given to a single setfacl
+ACL_BATCH = 256
+WINACL_ENTRIES = (
+    'owner@:rwxpDdaARWcCos:%(inherit)s:allow',
+    'group@:rwxpDdaARWcCos:%(inherit)s:allow',
+    'everyone@:rxDaRc:%(inherit)s:allow',
+)
+
+# Shared with the worker processes, see _init_worker
+_scanned = None
+_changed = None
+_errors = None
+_cancel = None
+
+
+def reset_winacl(paths, directories):
+    """
+    Replace the ACL of ``paths`` by the default Windows ACL; inheritance
+    flags are only set on directories
+
+    Returns:
+        int - number of paths setfacl failed on
+    """
+    if not paths:
+        return 0
+    entries = ','.join([
+        e % {'inherit': 'fd' if directories else ''} for e in WINACL_ENTRIES
+    ])
+    proc = subprocess.Popen(
+        [SETFACL, '-b', '-m', entries, '--'] + list(paths),
+        stderr=subprocess.PIPE,
+        close_fds=True,
+    )
+    err = proc.communicate()[1]
+    if proc.returncode == 0:
+        return 0
+    log.debug("setfacl failed: %s", err)
+    return min(len(paths), max(1, len(err.strip().splitlines())))
+
+
+def apply_one(path, st, uid, gid, mode, winacl=False):
+    """
+    Apply owner and mode (None to keep it) to ``path`` unless it already
+    has them, symbolic links are never followed
+
+    ``winacl`` also resets the ACL of files and directories, see
+    reset_winacl
+
+    Returns:
+        bool - whether anything changed
+    """
+    changed = False
+    if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+        os.lchown(path, uid, gid)
+        changed = True
+    if (
+        mode is not None and
+        not stat.S_ISLNK(st.st_mode) and
+        stat.S_IMODE(st.st_mode) != mode
+    ):
+        os.chmod(path, mode)
+        changed = True
+    if winacl and (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+        if reset_winacl([path], stat.S_ISDIR(st.st_mode)):
+            raise OSError(errno.EPERM, "Failed to set the ACL of %s" % path)
+        changed = True
+    return changed
+
+
+def is_excluded(path, exclude):
+    for e in exclude:
+        if path == e or path.startswith(e.rstrip('/') + '/'):
+            return True
+    return False
+
+
+def _init_worker(scanned, changed, errors, cancel):
+    global _scanned, _changed, _errors, _cancel
+    # The parent takes care of cancellation
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _scanned, _changed, _errors, _cancel = scanned, changed, errors, cancel
+
+
+def _count(counter, n):
+    if n:
+        with counter.get_lock():
+            counter.value += n
+
+
+def _walk(args):
+    """
+    Apply to everything below ``root``, not to ``root`` itself
+    """
+    root, uid, gid, mode, exclude, winacl = args
+    scanned = changed = errors = 0
+    # Entries waiting for their ACL, directories and files
+    acl_dirs = []
+    acl_files = []
+    stack = [root]
+    while stack:
+        if _cancel.is_set():
+            break
+        top = stack.pop()
+        try:
+            names = os.listdir(top)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                log.debug("Failed to list %s: %s", top, e)
+                errors += 1
+            continue
+        for name in names:
+            path = os.path.join(top, name)
+            if exclude and is_excluded(path, exclude):
+                continue
+            try:
+                st = os.lstat(path)
+                # With winacl the entry is counted once its ACL is set
+                if apply_one(path, st, uid, gid, mode) and not winacl:
+                    changed += 1
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    log.debug("Failed to change %s: %s", path, e)
+                    errors += 1
+                continue
+            scanned += 1
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(path)
+            if winacl:
+                if stat.S_ISDIR(st.st_mode):
+                    acl_dirs.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    acl_files.append(path)
+        for batch, directories in ((acl_dirs, True), (acl_files, False)):
+            if len(batch) >= ACL_BATCH or (batch and not stack):
+                failed = reset_winacl(batch, directories)
+                changed += len(batch) - failed
+                errors += failed
+                del batch[:]
+        # Publish every directory so progress keeps moving
+        if scanned > 1000 or not stack:
+            _count(_scanned, scanned)
+            _count(_changed, changed)
+            _count(_errors, errors)
+            scanned = changed = errors = 0
+    # Left over by a cancellation
+    for batch, directories in ((acl_dirs, True), (acl_files, False)):
+        failed = reset_winacl(batch, directories)
+        changed += len(batch) - failed
+        errors += failed
+    _count(_scanned, scanned)
+    _count(_changed, changed)
+    _count(_errors, errors)
+    return root
+
+
+class PermissionJob(object):
+
+    def __init__(self, path, uid, gid, mode=None, exclude=None,
+                 workers=WORKERS, progressfile=PROGRESSFILE, winacl=False):
+        self.path = path
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        self.winacl = winacl
+        self.exclude = [e for e in (exclude or []) if e]
+        self.workers = workers
+        self.progressfile = progressfile
+        self.scanned = multiprocessing.Value('L', 0)
+        self.changed = multiprocessing.Value('L', 0)
+        self.errors = multiprocessing.Value('L', 0)
+        self.cancel = multiprocessing.Event()
+        self.subtrees = 0
+        self.done = 0
+        self.started = None
+        self.state = 'starting'
+
+    def _apply(self, path):
+        try:
+            st = os.lstat(path)
+            if apply_one(
+                path, st, self.uid, self.gid, self.mode, winacl=self.winacl
+            ):
+                self.changed.value += 1
+            self.scanned.value += 1
+            return st
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                log.debug("Failed to change %s: %s", path, e)
+                self.errors.value += 1
+        return None
+
+    def split(self):
+        """
+        Apply to the top levels of the tree, until there are enough
+        subtrees to keep the workers busy
+
+        Returns:
+            list of directories to be walked by the workers
+        """
+        level = []
+        if self._apply(self.path) is not None:
+            level = [self.path]
+        for depth in range(SPLIT_DEPTH):
+            if len(level) >= self.workers * SPLIT_FACTOR:
+                break
+            below = []
+            for top in level:
+                try:
+                    names = os.listdir(top)
+                except OSError, e:
+                    log.debug("Failed to list %s: %s", top, e)
+                    self.errors.value += 1
+                    continue
+                for name in names:
+                    path = os.path.join(top, name)
+                    if is_excluded(path, self.exclude):
+                        continue
+                    st = self._apply(path)
+                    if st is not None and stat.S_ISDIR(st.st_mode):
+                        below.append(path)
+            level = below
+            if not level:
+                break
+        return level
+
+    def progress(self):
+        return {
+            'state': self.state,
+            'path': self.path,
+            'pid': os.getpid(),
+            'started': self.started,
+            'elapsed': time.time() - self.started if self.started else 0,
+            'scanned': self.scanned.value,
+            'changed': self.changed.value,
+            'errors': self.errors.value,
+            'subtrees': self.subtrees,
+            'subtrees_done': self.done,
+        }
+
+    def write_progress(self):
+        if not self.progressfile:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self.progressfile),
+                prefix=os.path.basename(self.progressfile) + '.',
+            )
+        except OSError, e:
+            log.debug("Failed to write %s: %s", self.progressfile, e)
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(self.progress()))
+            # mkstemp creates it 0600, the GUI reads it as www
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.progressfile)
+        except (IOError, OSError), e:
+            log.debug("Failed to write %s: %s", self.progressfile, e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def stop(self, *args):
+        self.cancel.set()
+
+    def run(self):
+        self.started = time.time()
+        self.state = 'running'
+        self.write_progress()
+
+        subtrees = self.split()
+        self.subtrees = len(subtrees)
+        pool = multiprocessing.Pool(
+            processes=self.workers,
+            initializer=_init_worker,
+            initargs=(self.scanned, self.changed, self.errors, self.cancel),
+        )
+        try:
+            results = pool.imap_unordered(_walk, [
+                (
+                    root, self.uid, self.gid, self.mode, self.exclude,
+                    self.winacl,
+                )
+                for root in subtrees
+            ])
+            last = 0
+            while True:
+                try:
+                    # Wait with a timeout so signals are delivered
+                    results.next(1)
+                    self.done += 1
+                except multiprocessing.TimeoutError:
+                    pass
+                except StopIteration:
+                    break
+                if time.time() - last >= 1:
+                    self.write_progress()
+                    last = time.time()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        self.state = 'cancelled' if self.cancel.is_set() else 'done'
+        self.write_progress()
+        log.info(
+            "Permissions of %s: %d scanned, %d changed, %d errors (%s)",
+            self.path, self.scanned.value, self.changed.value,
+            self.errors.value, self.state,
+        )
+        return self.state
+
+
+def get_progress():
+    """
+    Progress of the running or last permission job, None if there is none
+    """
+    try:
+        with open(PROGRESSFILE, 'r') as f:
+            data = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+    if data.get('state') in ('starting', 'running'):
+        try:
+            os.kill(data['pid'], 0)
+        except OSError:
+            data['state'] = 'failed'
+    return data
+
+
+def cancel():
+    """
+    Ask the running permission job to stop
+
+    Returns:
+        bool - whether there was a job to stop
+    """
+    data = get_progress()
+    if not data or data.get('state') not in ('starting', 'running'):
+        return False
+    try:
+        os.kill(data['pid'], signal.SIGTERM)
+    except OSError:
+        return False
+    return True
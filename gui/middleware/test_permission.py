@@ -0,0 +1,110 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from freenasUI.middleware import permission
+
+FAKE_SETFACL = """#!/bin/sh
+for arg in "$@"; do
+    echo "$arg" >> %(log)s
+done
+echo "--end--" >> %(log)s
+"""
+
+
+class WindowsACLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'share')
+        for d in ('a', 'a/b', 'a/b/c', 'x'):
+            os.makedirs(os.path.join(self.root, d))
+        self.files = []
+        for f in ('f1', 'a/f2', 'a/b/f3', 'a/b/c/f4', 'x/f5'):
+            path = os.path.join(self.root, f)
+            open(path, 'w').close()
+            os.chmod(path, 0o600)
+            self.files.append(path)
+        os.symlink('/etc/passwd', os.path.join(self.root, 'a', 'link'))
+
+        self.log = os.path.join(self.tmp, 'setfacl.log')
+        setfacl = os.path.join(self.tmp, 'setfacl')
+        with open(setfacl, 'w') as f:
+            f.write(FAKE_SETFACL % {'log': self.log})
+        os.chmod(setfacl, 0o755)
+        self._setfacl = permission.SETFACL
+        permission.SETFACL = setfacl
+
+    def tearDown(self):
+        permission.SETFACL = self._setfacl
+        shutil.rmtree(self.tmp)
+
+    def acls(self):
+        """
+        ACL entries set on every path, from the setfacl calls
+        """
+        acls = {}
+        if not os.path.exists(self.log):
+            return acls
+        with open(self.log) as f:
+            calls = f.read().split('--end--\n')
+        for call in calls:
+            args = call.splitlines()
+            if not args:
+                continue
+            self.assertEqual(args[:2], ['-b', '-m'])
+            self.assertEqual(args[3], '--')
+            for path in args[4:]:
+                self.assertNotIn(path, acls)
+                acls[path] = args[2]
+        return acls
+
+    def test_apply_one(self):
+        path = os.path.join(self.root, 'a')
+        self.assertTrue(permission.apply_one(
+            path, os.lstat(path), -1, -1, None, winacl=True
+        ))
+        self.assertEqual(self.acls(), {
+            path: (
+                'owner@:rwxpDdaARWcCos:fd:allow,'
+                'group@:rwxpDdaARWcCos:fd:allow,'
+                'everyone@:rxDaRc:fd:allow'
+            ),
+        })
+
+    def test_recursive(self):
+        job = permission.PermissionJob(
+            self.root, os.getuid(), os.getgid(), None,
+            exclude=[os.path.join(self.root, 'x')],
+            workers=2, progressfile=None, winacl=True,
+        )
+        self.assertEqual(job.run(), 'done')
+
+        dirs = [self.root] + [
+            os.path.join(self.root, d) for d in ('a', 'a/b', 'a/b/c')
+        ]
+        files = [f for f in self.files if '/x/' not in f]
+        acls = self.acls()
+        self.assertEqual(sorted(acls), sorted(dirs + files))
+        for d in dirs:
+            self.assertIn('owner@:rwxpDdaARWcCos:fd:allow', acls[d])
+            self.assertIn('everyone@:rxDaRc:fd:allow', acls[d])
+        for f in files:
+            self.assertIn('owner@:rwxpDdaARWcCos::allow', acls[f])
+            self.assertIn('everyone@:rxDaRc::allow', acls[f])
+            # Windows ACLs leave the mode alone
+            self.assertEqual(stat.S_IMODE(os.stat(f).st_mode), 0o600)
+        self.assertEqual(job.errors.value, 0)
+        self.assertEqual(job.changed.value, len(dirs + files))
+
+    def test_unix(self):
+        job = permission.PermissionJob(
+            self.root, os.getuid(), os.getgid(), 0o755,
+            workers=2, progressfile=None,
+        )
+        self.assertEqual(job.run(), 'done')
+        self.assertEqual(self.acls(), {})
+        for f in self.files:
+            self.assertEqual(stat.S_IMODE(os.stat(f).st_mode), 0o755)
@@ -35,6 +35,7 @@ from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common import humanize_size
+from freenasUI.middleware import zfsstate
 
 log = logging.getLogger('middleware.zfs')
 
@@ -76,6 +77,31 @@ def zfs_size_to_bytes(size):
         return size
 
 
+def zfs_nicenum(num):
+    """
+    Format a parsable (-p) zfs number the same way zfs(8) does
+    """
+    try:
+        num = int(num)
+    except (TypeError, ValueError):
+        return num
+    index = 0
+    n = num
+    while n >= 1024 and index < 6:
+        n /= 1024
+        index += 1
+    if index == 0:
+        return '%d' % num
+    unit = ' KMGTPE'[index]
+    if num % (1 << (10 * index)) == 0:
+        return '%d%s' % (n, unit)
+    for precision in (2, 1, 0):
+        buff = '%.*f%s' % (precision, float(num) / (1 << (10 * index)), unit)
+        if len(buff) <= 5:
+            break
+    return buff
+
+
 class Pool(object):
     """
     Class representing a Zpool
@@ -370,23 +396,17 @@ class Dev(Tnode):
                 "Oh noes! This damn thing should be a vdev! %s" % self.parent
             )
 
+        topology = self._doc
         name = self.name
-        search = self._doc.xpathEval("//class[name = 'ELI']"
-                                     "//provider[name = '%s']/../consumer"
-                                     "/provider/@ref" % name)
-        if len(search) > 0:
-            search = self._doc.xpathEval("//provider[@id = '%s']"
-                                         "/name" % search[0].content)
-            name = search[0].content
-
-        search = self._doc.xpathEval("//class[name = 'LABEL']"
-                                     "//provider[name = '%s']/../consumer"
-                                     "/provider/@ref" % name)
-
-        provider = None
-        if len(search) > 0:
-            self.devname = search[0].xpathEval("../../../name")[0].content
-            provider = search[0].content
+        eli = topology.provider_by_name(name, 'ELI')
+        if eli is not None:
+            backing = topology.backing_provider(eli)
+            if backing is not None:
+                name = backing.name
+
+        provider = topology.label_target(name)
+        if provider is not None:
+            self.devname = topology.by_label(name).geom.name
         else:
 
             # Treat .nop as a regular dev (w/o .nop)
@@ -394,15 +414,11 @@ class Dev(Tnode):
                 self.devname = self.name[:-4]
             else:
                 self.devname = self.name
-            search = self._doc.xpathEval("//class[name = 'DEV']"
-                                         "/geom[name = '%s']"
-                                         "//provider/@ref" % self.devname)
-            if len(search) > 0:
-                provider = search[0].content
-            elif self.status == 'ONLINE':
+            provider = topology.dev_target(self.devname)
+            if provider is None and self.status == 'ONLINE':
                 log.warn("It should be a valid device: %s", self.name)
                 self.disk = self.name
-            elif self.name.isdigit():
+            elif provider is None and self.name.isdigit():
                 # Lets check whether it is a guid
                 p1 = subprocess.Popen(
                     ["/usr/sbin/zdb", "-C", self.parent.parent.name],
@@ -418,10 +434,8 @@ class Dev(Tnode):
                     if reg:
                         self.path = reg.group("path")
 
-        if provider:
-            search = self._doc.xpathEval("//provider[@id = '%s']"
-                                         "/../name" % provider)
-            self.disk = search[0].content
+        if provider is not None:
+            self.disk = provider.geom.name
 
 
 class ZFSList(SortedDict):
@@ -555,6 +569,8 @@ class Snapshot(object):
     refer = None
     mostrecent = False
     parent_type = None
+    creation = None
+    state = None
 
     def __init__(
         self,
@@ -563,7 +579,9 @@ class Snapshot(object):
         used,
         refer,
         mostrecent=False,
-        parent_type=None
+        parent_type=None,
+        creation=None,
+        state=None,
     ):
         self.name = name
         self.filesystem = filesystem
@@ -571,20 +589,45 @@ class Snapshot(object):
         self.refer = refer
         self.mostrecent = mostrecent
         self.parent_type = parent_type
+        self.creation = creation
+        self.state = state
 
     def __repr__(self):
         return u"<Snapshot: %s>" % self.fullname
 
+    @classmethod
+    def from_row(cls, row, **kwargs):
+        """
+        Build a Snapshot from a zfsstate.SNAPSHOT_FIELDS row
+        """
+        fs, name = row[0].split('@', 1)
+        snap = cls(
+            name=name,
+            filesystem=fs,
+            used=zfs_nicenum(row[1]),
+            refer=zfs_nicenum(row[2]),
+            creation=int(row[3]),
+            state=row[4],
+            **kwargs
+        )
+        snap._used_bytes = int(row[1])
+        snap._refer_bytes = int(row[2])
+        return snap
+
     @property
     def fullname(self):
         return "%s@%s" % (self.filesystem, self.name)
 
     @property
     def used_bytes(self):
+        if hasattr(self, '_used_bytes'):
+            return self._used_bytes
         return zfs_size_to_bytes(self.used)
 
     @property
     def refer_bytes(self):
+        if hasattr(self, '_refer_bytes'):
+            return self._refer_bytes
         return zfs_size_to_bytes(self.refer)
 
 
@@ -766,42 +809,23 @@ def list_datasets(path="", recursive=False, hierarchical=False,
     Return a dictionary that contains all ZFS dataset list and their
     mountpoints
     """
-    args = [
-        "/sbin/zfs",
-        "list",
-        "-H",
-        "-t", "filesystem",
-        "-s", "name",
-    ]
-    if recursive:
-        args.insert(3, "-r")
-    if path:
-        args.append(path)
-
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
+    rows = zfsstate.dataset_rows(
+        path or None, recursive=recursive or not path, types='filesystem'
+    )
     zfslist = ZFSList()
     last_dataset = None
     last_depth = 2
-    for line in zfs_output:
-        if not line:
-            continue
-        data = line.split('\t')
+    for data in rows:
         depth = len(data[0].split('/'))
         # root filesystem is not treated as dataset by us
         if depth == 1 and not include_root:
             continue
         dataset = ZFSDataset(
             path=data[0],
-            used=data[1],
-            avail=data[2],
-            refer=data[3],
-            mountpoint=data[4],
+            used=zfs_nicenum(data[2]),
+            avail=zfs_nicenum(data[3]),
+            refer=zfs_nicenum(data[4]),
+            mountpoint=data[5],
         )
         if not hierarchical:
             zfslist.append(dataset)
@@ -0,0 +1,838 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+In-memory index of the ZFS dataset/snapshot/property tree
+
+The index is held by the zfsstate daemon (tools/zfsstate.py) and queried
+over /var/run/zfsstate.sock so web and API requests do not have to fork
+/sbin/zfs and parse its whole output every time.
+
+The module level helpers (dataset_rows, snapshot_rows, property_rows)
+ask the daemon first and fall back to running zfs(8) directly when it is
+not available, so callers never depend on the daemon being up.
+Rows are always lists of strings in the column order of DATASET_FIELDS,
+SNAPSHOT_FIELDS and PROPERTY_FIELDS, with numbers in parsable (-p) form.
+"""
+import bisect
+import logging
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+import xmlrpclib
+
+from freenasUI.common.unixrpc import UnixServerProxy
+
+log = logging.getLogger('middleware.zfsstate')
+
+ZFS_PATH = '/sbin/zfs'
+ZPOOL_PATH = '/sbin/zpool'
+SOCKFILE = '/var/run/zfsstate.sock'
+ZFSSTATE_DAEMON = '/usr/local/www/freenasUI/tools/zfsstate.py'
+# Do not try to spawn the daemon more often than that (seconds)
+SPAWN_INTERVAL = 60
+
+DATASET_FIELDS = (
+    'name', 'type', 'used', 'avail', 'refer', 'mountpoint', 'volsize',
+)
+SNAPSHOT_FIELDS = ('name', 'used', 'refer', 'creation', 'freenas:state')
+PROPERTY_FIELDS = ('name', 'property', 'value', 'source')
+# Rows returned by snapshot queries, type is the one of the parent dataset
+SNAPSHOT_QUERY_FIELDS = SNAPSHOT_FIELDS + ('type', 'mostrecent')
+
+# Orders kept pre-sorted by the index, the default being by dataset and
+# then by creation
+SNAPSHOT_ORDERS = {
+    'creation': lambda row: int(row[3]),
+    'used': lambda row: int(row[1]),
+    'refer': lambda row: int(row[2]),
+    'name': lambda row: row[0],
+}
+# Latest snapshot of each dataset last, otherwise in the default order
+ORDER_MOSTRECENT = 'mostrecent'
+
+DATASET_TYPES = 'filesystem,volume'
+
+# Properties changing along with the data, refreshed with the space
+# accounting of the datasets
+VOLATILE_PROPERTIES = (
+    'used', 'available', 'referenced', 'compressratio', 'refcompressratio',
+    'usedbysnapshots', 'usedbydataset', 'usedbychildren',
+    'usedbyrefreservation',
+)
+
+# zfs subcommands whose targets only need a non recursive rescan
+# unless -r/-R has been given
+NONRECURSIVE_VERBS = ('snapshot', 'destroy', 'hold', 'release')
+
+RE_HISTORY_RECORD = re.compile(r'^\d{4}-\d{2}-\d{2}\.\d{2}:\d{2}:\d{2} (.+)$')
+RE_HISTORY_INTERNAL = re.compile(
+    r'^\[txg:\d+\]\s+(?P<op>\S+)\s+(?P<name>\S+)\s+\(\d+\)'
+)
+
+
+class ZFSStateUnavailable(Exception):
+    pass
+
+
+def _run(args):
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+    )
+    output, err = proc.communicate()
+    return proc.returncode, output, err
+
+
+def _rows(output, ncolumns):
+    rows = []
+    for line in output.split('\n'):
+        if not line:
+            continue
+        row = line.split('\t')
+        if len(row) != ncolumns:
+            log.warn("Unexpected zfs output line: %r", line)
+            continue
+        rows.append(row)
+    return rows
+
+
+def _key(name):
+    return tuple(name.split('/'))
+
+
+def zfs_list_datasets(path=None, recursive=True, types=DATASET_TYPES):
+    """
+    Run zfs list for datasets, path may be a single name or a list
+    """
+    args = [
+        ZFS_PATH, 'list', '-H', '-p',
+        '-t', types,
+        '-o', ','.join(DATASET_FIELDS),
+    ]
+    if path and recursive:
+        args.append('-r')
+    if isinstance(path, (list, tuple)):
+        args.extend(path)
+    elif path:
+        args.append(path)
+    rv, output, err = _run(args)
+    if rv != 0 and not output:
+        log.debug("zfs list %s failed: %s", path, err)
+        return []
+    rows = _rows(output, len(DATASET_FIELDS))
+    # Hierarchical order, children always right after their parent
+    rows.sort(key=lambda row: _key(row[0]))
+    return rows
+
+
+def zfs_list_snapshots(path=None, recursive=True):
+    args = [
+        ZFS_PATH, 'list', '-H', '-p',
+        '-t', 'snapshot',
+        '-s', 'creation',
+        '-o', ','.join(SNAPSHOT_FIELDS),
+    ]
+    if path:
+        if recursive:
+            args.append('-r')
+        elif '@' not in path:
+            args.extend(['-r', '-d', '1'])
+        args.append(path)
+    rv, output, err = _run(args)
+    if rv != 0 and not output:
+        log.debug("zfs list snapshots %s failed: %s", path, err)
+        return []
+    return _rows(output, len(SNAPSHOT_FIELDS))
+
+
+def zfs_get_properties(name=None, recursive=False, props=None):
+    args = [
+        ZFS_PATH, 'get', '-H',
+        '-o', ','.join(PROPERTY_FIELDS),
+    ]
+    if recursive:
+        args.append('-r')
+    if name is None or '@' not in name:
+        args.extend(['-t', DATASET_TYPES])
+    args.append(','.join(props) if props else 'all')
+    if name:
+        args.append(name)
+    rv, output, err = _run(args)
+    if rv != 0 and not output:
+        log.debug("zfs get %s failed: %s", name, err)
+        return []
+    return _rows(output, len(PROPERTY_FIELDS))
+
+
+def snapshot_filter(dataset=None, recursive=True, prefix=None, since=None,
+                    until=None, state=None):
+    """
+    Return a predicate for snapshot rows or None if there is nothing
+    to filter
+
+    dataset -- only snapshots of this dataset (and children if recursive)
+    prefix -- snapshot name (after the @) starts with it
+    since, until -- creation time range, in seconds since the epoch
+    state -- value of the freenas:state property (NEW, LATEST or -)
+    """
+    checks = []
+    if dataset:
+        if recursive:
+            child = dataset + '/'
+            checks.append(lambda fs: fs == dataset or fs.startswith(child))
+        else:
+            checks.append(lambda fs: fs == dataset)
+    if not (checks or prefix or since or until or state):
+        return None
+    since = int(since) if since else None
+    until = int(until) if until else None
+
+    def predicate(row):
+        fs, name = row[0].split('@', 1)
+        for check in checks:
+            if not check(fs):
+                return False
+        if prefix and not name.startswith(prefix):
+            return False
+        if since is not None and int(row[3]) < since:
+            return False
+        if until is not None and int(row[3]) > until:
+            return False
+        if state and row[4] != state:
+            return False
+        return True
+    return predicate
+
+
+def _page(rows, predicate, offset, limit, reverse=False):
+    """
+    Walk ordered rows, backwards if ``reverse`` is set, returning the
+    total matching count and the [offset:offset + limit] slice of the
+    matches
+    """
+    if predicate is None:
+        if not reverse:
+            if limit is None:
+                return len(rows), rows[offset:]
+            return len(rows), rows[offset:offset + limit]
+        # Slice from the end rather than copying the whole list
+        end = max(len(rows) - offset, 0)
+        start = 0 if limit is None else max(end - limit, 0)
+        return len(rows), rows[start:end][::-1]
+    if reverse:
+        rows = reversed(rows)
+    total = 0
+    page = []
+    for row in rows:
+        if not predicate(row):
+            continue
+        if total >= offset and (limit is None or len(page) < limit):
+            page.append(row)
+        total += 1
+    return total, page
+
+
+def query_snapshots(rows, volumes, order=None, reverse=False, offset=0,
+                    limit=None, **filters):
+    """
+    Query plain snapshot rows, used when the daemon is not available
+
+    ``rows`` must be ordered by creation within each dataset and
+    ``volumes`` is the set of zvol names.
+    """
+    latest = {}
+    for row in rows:
+        latest[row[0].split('@', 1)[0]] = row[0]
+    if order in SNAPSHOT_ORDERS:
+        rows = sorted(rows, key=SNAPSHOT_ORDERS[order])
+    elif order == ORDER_MOSTRECENT:
+        rows = sorted(
+            rows, key=lambda row: latest[row[0].split('@', 1)[0]] == row[0]
+        )
+    total, page = _page(
+        rows, snapshot_filter(**filters), offset, limit, reverse=reverse
+    )
+    result = []
+    for row in page:
+        fs = row[0].split('@', 1)[0]
+        result.append(row + [
+            'volume' if fs in volumes else 'filesystem',
+            '1' if latest.get(fs) == row[0] else '0',
+        ])
+    return total, result
+
+
+def parse_history(output):
+    """
+    Parse ``zpool history -i`` output
+
+    Returns a list of (record, targets) where targets is a list of
+    (name, recursive) that may need to be rescanned for that record.
+    An empty name means the whole pool.
+    """
+    records = []
+    for line in output.split('\n'):
+        reg = RE_HISTORY_RECORD.search(line)
+        if not reg:
+            continue
+        record = reg.group(1)
+        targets = []
+        internal = RE_HISTORY_INTERNAL.search(record)
+        if internal:
+            targets.append((internal.group('name'), False))
+        elif record.startswith('zfs '):
+            words = record.split()[1:]
+            verb = words[0] if words else ''
+            flagged = '-r' in words or '-R' in words
+            recursive = verb not in NONRECURSIVE_VERBS or flagged
+            for word in words[1:]:
+                if word.startswith('-') or '=' in word:
+                    continue
+                if '@' in word:
+                    # Touching a snapshot never affects its siblings
+                    targets.append((word, flagged))
+                else:
+                    # Words that are not datasets of the pool (e.g. the
+                    # property of zfs inherit) are discarded by the caller
+                    targets.append((word, recursive))
+        elif record.startswith('zpool '):
+            words = record.split()[1:]
+            if words and words[0] in ('create', 'import', 'upgrade'):
+                targets.append(('', True))
+        records.append((line, targets))
+    return records
+
+
+class ZFSIndex(object):
+    """
+    Indexed dataset/snapshot/property tree
+
+    Datasets are kept in a list sorted by path components so a subtree
+    is always a contiguous slice found with bisect; snapshots are kept
+    per dataset ordered by creation and also indexed by full name.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._datasets = {}
+        self._snapshots = {}
+        self._snapnames = {}
+        self._properties = {}
+        self._history = {}
+        self._orders = {}
+        self.generation = 0
+        self.snapshot_generation = 0
+        self.loaded = None
+        self.stats = {
+            'rebuilds': 0,
+            'rescans': 0,
+            'history_records': 0,
+            'last_rebuild_time': 0.0,
+        }
+
+    def _subtree(self, name, recursive=True):
+        """
+        Return the dataset names under ``name``, itself included
+        """
+        if not name:
+            return ['/'.join(k) for k in self._keys]
+        key = _key(name)
+        idx = bisect.bisect_left(self._keys, key)
+        names = []
+        while idx < len(self._keys):
+            k = self._keys[idx]
+            if k[:len(key)] != key:
+                break
+            if k == key:
+                names.append(name)
+            elif recursive:
+                names.append('/'.join(k))
+            else:
+                break
+            idx += 1
+        return names
+
+    def _drop(self, name):
+        key = _key(name)
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            del self._keys[idx]
+        self._datasets.pop(name, None)
+        self._properties.pop(name, None)
+        for snap in self._snapshots.pop(name, []):
+            self._snapnames.pop(snap[0], None)
+        self.snapshot_generation += 1
+
+    def _add_dataset(self, row):
+        name = row[0]
+        if name not in self._datasets:
+            bisect.insort(self._keys, _key(name))
+            self._snapshots.setdefault(name, [])
+        self._datasets[name] = row
+
+    def _set_snapshots(self, name, rows):
+        for snap in self._snapshots.get(name, []):
+            self._snapnames.pop(snap[0], None)
+        rows.sort(key=lambda row: int(row[3]))
+        self._snapshots[name] = rows
+        for row in rows:
+            self._snapnames[row[0]] = row
+        self.snapshot_generation += 1
+
+    def _apply(self, datasets, snapshots, properties, replace=None,
+               recursive=True):
+        """
+        Apply freshly listed rows, dropping everything under ``replace``
+        that no longer exists
+        """
+        with self._lock:
+            if replace is not None:
+                seen = set(row[0] for row in datasets)
+                for name in self._subtree(replace, recursive=recursive):
+                    if name not in seen:
+                        self._drop(name)
+            for row in datasets:
+                self._add_dataset(row)
+            bysnap = {}
+            for row in snapshots:
+                bysnap.setdefault(row[0].split('@', 1)[0], []).append(row)
+            for row in datasets:
+                self._set_snapshots(row[0], bysnap.pop(row[0], []))
+            for name, rows in bysnap.items():
+                if name in self._datasets:
+                    self._set_snapshots(name, rows)
+            byname = {}
+            for row in properties:
+                byname.setdefault(row[0], []).append(tuple(row[1:]))
+            self._properties.update(byname)
+            self.generation += 1
+
+    def rebuild(self):
+        """
+        Load the whole tree from scratch
+        """
+        start = time.time()
+        datasets = zfs_list_datasets()
+        snapshots = zfs_list_snapshots()
+        properties = zfs_get_properties(recursive=True)
+        history = {}
+        for pool in self.pools(datasets):
+            records = self._read_history(pool)
+            history[pool] = records[-1][0] if records else None
+        with self._lock:
+            self._keys = []
+            self._datasets = {}
+            self._snapshots = {}
+            self._snapnames = {}
+            self._properties = {}
+            self._apply(datasets, snapshots, properties)
+            self._history = history
+            self.loaded = time.time()
+            self.stats['rebuilds'] += 1
+            self.stats['last_rebuild_time'] = self.loaded - start
+        log.debug(
+            "Index rebuilt in %.2fs: %d datasets, %d snapshots",
+            self.loaded - start, len(datasets), len(snapshots),
+        )
+
+    def rescan(self, name, recursive=False):
+        """
+        Rescan a dataset (or snapshot) after it has been changed
+        """
+        self.stats['rescans'] += 1
+        if not name:
+            self.rebuild()
+            return
+        if '@' in name:
+            fs = name.split('@', 1)[0]
+            if fs not in self._datasets:
+                self.rescan(fs, recursive=recursive)
+                return
+            if recursive:
+                self._apply(
+                    zfs_list_datasets(fs, recursive=True),
+                    zfs_list_snapshots(fs, recursive=True),
+                    [],
+                )
+                return
+            rows = zfs_list_snapshots(name, recursive=False)
+            with self._lock:
+                snaps = [
+                    s for s in self._snapshots.get(fs, []) if s[0] != name
+                ]
+                self._set_snapshots(fs, snaps + rows)
+                self.generation += 1
+            return
+
+        self._apply(
+            zfs_list_datasets(name, recursive=recursive),
+            zfs_list_snapshots(name, recursive=recursive),
+            zfs_get_properties(name, recursive=recursive),
+            replace=name,
+            recursive=recursive,
+        )
+        # Space accounting of the ancestors changes along with the dataset
+        parents = []
+        parent = name
+        while '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            parents.append(parent)
+        if parents:
+            self._update(zfs_list_datasets(parents, recursive=False))
+
+    def _update(self, rows):
+        """
+        Update the rows of already known datasets
+        """
+        with self._lock:
+            for row in rows:
+                if row[0] in self._datasets:
+                    self._datasets[row[0]] = row
+            self.generation += 1
+
+    def _update_properties(self, rows):
+        """
+        Replace the values of the given properties of already known
+        datasets, keeping the others
+        """
+        byname = {}
+        for row in rows:
+            byname.setdefault(row[0], {})[row[1]] = tuple(row[1:])
+        with self._lock:
+            for name, fresh in byname.items():
+                if name not in self._datasets:
+                    continue
+                props = []
+                for prop in self._properties.get(name, []):
+                    props.append(fresh.pop(prop[0], prop))
+                props.extend(fresh.values())
+                self._properties[name] = props
+            self.generation += 1
+
+    def refresh_datasets(self):
+        """
+        Refresh space accounting of filesystems and volumes, which
+        changes without leaving any trace in the pool history
+        """
+        rows = zfs_list_datasets()
+        with self._lock:
+            known = set(self._datasets)
+        current = set(row[0] for row in rows)
+        self._update(rows)
+        self._update_properties(
+            zfs_get_properties(recursive=True, props=VOLATILE_PROPERTIES)
+        )
+        # Someone created or destroyed datasets behind our back
+        for name in sorted(current - known, key=_key):
+            self.rescan(name, recursive=True)
+        with self._lock:
+            for name in known - current:
+                self._drop(name)
+
+    def _read_history(self, pool):
+        rv, output, err = _run([ZPOOL_PATH, 'history', '-i', pool])
+        if rv != 0:
+            log.debug("zpool history %s failed: %s", pool, err)
+            return []
+        return parse_history(output)
+
+    def pools(self, datasets=None):
+        if datasets is None:
+            with self._lock:
+                return [k[0] for k in self._keys if len(k) == 1]
+        return [row[0] for row in datasets if '/' not in row[0]]
+
+    def poll_history(self):
+        """
+        Rescan the datasets named in the pool history records
+        written since the last poll
+        """
+        rv, output, err = _run([ZPOOL_PATH, 'list', '-H', '-o', 'name'])
+        if rv != 0:
+            return
+        pools = filter(None, output.split('\n'))
+        with self._lock:
+            known = set(self._history)
+        for pool in known - set(pools):
+            with self._lock:
+                for name in self._subtree(pool):
+                    self._drop(name)
+                self._history.pop(pool, None)
+                self.generation += 1
+
+        for pool in pools:
+            records = self._read_history(pool)
+            if not records:
+                continue
+            last = self._history.get(pool)
+            lines = [r[0] for r in records]
+            if pool not in known or last not in lines:
+                # New pool or the history ring buffer wrapped around
+                targets = [(pool, True)]
+                new = records
+            else:
+                # The same command may be logged twice within a second
+                idx = len(lines) - lines[::-1].index(last)
+                new = records[idx:]
+                targets = []
+                for record, rtargets in new:
+                    for name, recursive in rtargets:
+                        targets.append((name or pool, recursive))
+            with self._lock:
+                self._history[pool] = records[-1][0]
+            self.stats['history_records'] += len(new)
+            done = set()
+            for name, recursive in targets:
+                if (name, recursive) in done:
+                    continue
+                done.add((name, recursive))
+                if name.split('/')[0].split('@')[0] != pool:
+                    continue
+                self.rescan(name, recursive=recursive)
+
+    def datasets(self, path=None, recursive=True, types=DATASET_TYPES):
+        types = types.split(',')
+        with self._lock:
+            return [
+                self._datasets[name]
+                for name in self._subtree(path, recursive=recursive)
+                if self._datasets[name][1] in types
+            ]
+
+    def snapshots(self, path=None, recursive=True):
+        with self._lock:
+            if path and '@' in path:
+                row = self._snapnames.get(path)
+                return [row] if row else []
+            rows = []
+            for name in self._subtree(path, recursive=recursive):
+                rows.extend(self._snapshots.get(name, []))
+            return rows
+
+    def properties(self, name=None, recursive=False, props=None):
+        with self._lock:
+            rows = []
+            for dsname in self._subtree(name, recursive=recursive):
+                for prop in self._properties.get(dsname, []):
+                    if props and prop[0] not in props:
+                        continue
+                    rows.append([dsname] + list(prop))
+            return rows
+
+    def _ordered(self, order):
+        """
+        All snapshots in the given order, sorted once per change
+        of the snapshot list
+        """
+        cached = self._orders.get(order)
+        if cached and cached[0] == self.snapshot_generation:
+            return cached[1]
+        rows = []
+        for key in self._keys:
+            rows.extend(self._snapshots.get('/'.join(key), []))
+        self._sort(rows, order)
+        self._orders[order] = (self.snapshot_generation, rows)
+        return rows
+
+    def _is_latest(self, row):
+        snaps = self._snapshots.get(row[0].split('@', 1)[0])
+        return bool(snaps) and snaps[-1][0] == row[0]
+
+    def _sort(self, rows, order):
+        if order in SNAPSHOT_ORDERS:
+            rows.sort(key=SNAPSHOT_ORDERS[order])
+        elif order == ORDER_MOSTRECENT:
+            rows.sort(key=self._is_latest)
+
+    def query_snapshots(self, order=None, reverse=False, offset=0,
+                        limit=None, **filters):
+        """
+        Filtered, ordered and paginated snapshot listing
+
+        Returns the total number of matches and the requested page as
+        SNAPSHOT_QUERY_FIELDS rows.
+        """
+        if order not in SNAPSHOT_ORDERS and order != ORDER_MOSTRECENT:
+            order = None
+        with self._lock:
+            dataset = filters.get('dataset')
+            if dataset:
+                # A dataset subtree is usually small, sort it on demand
+                rows = []
+                for name in self._subtree(
+                    dataset, recursive=filters.get('recursive', True)
+                ):
+                    rows.extend(self._snapshots.get(name, []))
+                self._sort(rows, order)
+                filters.pop('dataset')
+                filters.pop('recursive', None)
+            else:
+                rows = self._ordered(order)
+            total, page = _page(
+                rows, snapshot_filter(**filters), offset, limit,
+                reverse=reverse,
+            )
+            result = []
+            for row in page:
+                fs = row[0].split('@', 1)[0]
+                result.append(row + [
+                    self._datasets[fs][1] if fs in self._datasets else '',
+                    '1' if self._is_latest(row) else '0',
+                ])
+            return total, result
+
+    def summary(self):
+        with self._lock:
+            data = dict(self.stats)
+            data.update({
+                'generation': self.generation,
+                'loaded': self.loaded or 0,
+                'datasets': len(self._datasets),
+                'snapshots': len(self._snapnames),
+            })
+            return data
+
+
+class ZFSState(object):
+    """
+    Client for the zfsstate daemon
+    """
+
+    def __init__(self, sockfile=SOCKFILE, timeout=30):
+        self.sockfile = sockfile
+        self.timeout = timeout
+        self._spawned = 0
+        self._lock = threading.Lock()
+
+    def spawn(self):
+        """
+        Start the daemon in case it is not running (ix-zfsstate starts
+        it at boot), this is rate limited and the daemon itself refuses
+        to run twice thanks to its pid file lock
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._spawned < SPAWN_INTERVAL:
+                return
+            self._spawned = now
+        if not os.path.exists(ZFSSTATE_DAEMON):
+            return
+        try:
+            # The daemon detaches itself and keeps its stdio, so do not
+            # hand it pipes and only wait for the first process
+            with open(os.devnull, 'r+') as null:
+                subprocess.Popen(
+                    ['/usr/local/bin/python', ZFSSTATE_DAEMON],
+                    stdin=null,
+                    stdout=null,
+                    stderr=null,
+                    close_fds=True,
+                ).wait()
+        except (OSError, IOError), e:
+            log.warn("Failed to start zfsstate: %s", e)
+
+    def call(self, method, *args):
+        if not os.path.exists(self.sockfile):
+            self.spawn()
+            raise ZFSStateUnavailable("%s does not exist" % self.sockfile)
+        server = UnixServerProxy(self.sockfile, timeout=self.timeout)
+        try:
+            return getattr(server, method)(*args)
+        except socket.error, e:
+            # Stale socket left behind by a daemon that went away
+            log.debug("zfsstate %s failed: %s", method, e)
+            self.spawn()
+            raise ZFSStateUnavailable(str(e))
+        except xmlrpclib.Error, e:
+            log.debug("zfsstate %s failed: %s", method, e)
+            raise ZFSStateUnavailable(str(e))
+
+
+_client = ZFSState()
+
+
+def dataset_rows(path=None, recursive=True, types=DATASET_TYPES):
+    try:
+        return _client.call('datasets', path or '', recursive, types)
+    except ZFSStateUnavailable:
+        return zfs_list_datasets(path, recursive=recursive, types=types)
+
+
+def snapshot_rows(path=None, recursive=True):
+    try:
+        return _client.call('snapshots', path or '', recursive)
+    except ZFSStateUnavailable:
+        return zfs_list_snapshots(path, recursive=recursive)
+
+
+def property_rows(name=None, recursive=False, props=None):
+    if name and '@' in name:
+        # Snapshot properties are not indexed
+        return zfs_get_properties(name, recursive=recursive, props=props)
+    try:
+        return _client.call(
+            'properties', name or '', recursive, list(props or [])
+        )
+    except ZFSStateUnavailable:
+        return zfs_get_properties(name, recursive=recursive, props=props)
+
+
+def snapshot_query(**query):
+    """
+    Run a snapshot query (see ZFSIndex.query_snapshots) returning
+    the total number of matches and the requested page
+    """
+    query = dict((k, v) for k, v in query.items() if v is not None)
+    try:
+        data = _client.call('query_snapshots', query)
+        return data['total'], data['rows']
+    except ZFSStateUnavailable:
+        pass
+    dataset = query.pop('dataset', None)
+    recursive = query.pop('recursive', True)
+    rows = zfs_list_snapshots(dataset, recursive=recursive)
+    volumes = set(
+        row[0] for row in zfs_list_datasets(dataset, types='volume')
+    )
+    return query_snapshots(rows, volumes, **query)
+
+
+def invalidate(name, recursive=False):
+    """
+    Tell the daemon ``name`` has been changed by us so the next
+    query reflects it
+    """
+    try:
+        _client.call('invalidate', name, recursive)
+    except ZFSStateUnavailable:
+        pass
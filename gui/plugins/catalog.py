@@ -0,0 +1,330 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+In-memory catalog of the PBI repositories known to pbid
+
+The repository list, mirrors, <sha256>-index and <sha256>-meta files
+under /var/db/pbi are parsed once into dictionaries. Index entries are
+keyed by (application, arch, version). The files are stat'ed at most
+every STAT_INTERVAL seconds and the catalog is parsed again when any
+of them changed (e.g. after a pbid refresh).
+
+The parsed catalog is also saved as JSON to CATALOG_FILE, in a
+directory only root can access, with the state of the files it was
+built from, so another process (or a restart) can load it without
+parsing the index files again.
+"""
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from freenasUI.common import pbi
+
+log = logging.getLogger('plugins.catalog')
+
+CATALOG_DIR = '/var/db/pbicatalog'
+CATALOG_FILE = os.path.join(CATALOG_DIR, 'catalog.json')
+STAT_INTERVAL = 1
+
+
+def _mtime(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _tostr(obj):
+    """
+    JSON gives back unicode, the catalog is built from str
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_tostr(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((_tostr(k), _tostr(v)) for k, v in obj.items())
+    return obj
+
+
+class RepoCatalog(object):
+
+    def __init__(self, cachefile=CATALOG_FILE):
+        self.cachefile = cachefile
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._signature = None
+        self._checked = 0
+        self._repos = {}
+        self._mirrors = {}
+        self._index = {}
+        self._meta_count = 0
+        self._icon_count = 0
+
+    def _listrepos(self):
+        """
+        (repo id, sha256) of the configured repositories
+        """
+        try:
+            names = sorted(os.listdir(pbi.PBID_REPOSDIR))
+        except OSError:
+            return []
+        repos = []
+        for name in names:
+            parts = name.split('.')
+            if len(parts) < 2:
+                continue
+            repos.append((parts[0], parts[-1]))
+        return repos
+
+    def _files(self, sha256):
+        return (
+            "%s/%s" % (pbi.PBID_MIRRORSDIR, sha256),
+            "%s/%s-index" % (pbi.PBID_INDEXDIR, sha256),
+            "%s/%s-meta" % (pbi.PBID_INDEXDIR, sha256),
+        )
+
+    def _get_signature(self):
+        repos = self._listrepos()
+        files = []
+        for repo_id, sha256 in repos:
+            for path in self._files(sha256):
+                files.append(_mtime(path))
+        return (
+            tuple(repos),
+            tuple(files),
+            # pbid fetches the icons after the index
+            _mtime(pbi.PBID_ICONSDIR),
+        )
+
+    def _load(self, signature):
+        repos = {}
+        mirrors = {}
+        index = {}
+        meta_count = 0
+        icon_count = 0
+
+        for repo_id, sha256 in signature[0]:
+            repos.setdefault(repo_id, sha256)
+            mirrorsfile, indexfile, metafile = self._files(sha256)
+
+            urls = mirrors.setdefault(repo_id, [])
+            try:
+                with open(mirrorsfile, 'r') as f:
+                    for line in f:
+                        urls.append(line.strip())
+            except IOError:
+                pass
+
+            entries = index.setdefault(repo_id, {})
+            try:
+                with open(indexfile, 'r') as f:
+                    for line in f:
+                        parts = line.rstrip('\n').split(':')
+                        if len(parts) < 3:
+                            continue
+                        entries.setdefault(
+                            (parts[0], parts[1], parts[2]), parts
+                        )
+            except IOError:
+                log.debug("Unable to open up repo with sha256: %s", sha256)
+
+            try:
+                with open(metafile, 'r') as f:
+                    lines = [l.strip() for l in f]
+            except IOError:
+                continue
+            meta_count += len(lines)
+            for line in lines:
+                parts = line.split(';')
+                if len(parts) < 3:
+                    continue
+                app = parts[0].replace("App=", "")
+                ext = parts[2].split('.')[-1]
+                if os.path.exists("%s/%s-%s.%s" % (
+                    pbi.PBID_ICONSDIR, sha256, app, ext
+                )):
+                    icon_count += 1
+
+        return {
+            'repos': repos,
+            'mirrors': mirrors,
+            'index': index,
+            'meta_count': meta_count,
+            'icon_count': icon_count,
+        }
+
+    def _cachedir(self):
+        """
+        Directory of the cache file, created if needed, or None unless
+        it is private to us
+        """
+        cachedir = os.path.dirname(self.cachefile)
+        try:
+            os.mkdir(cachedir, 0o700)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(cachedir)
+        except OSError, e:
+            log.debug("Unable to use %s: %s", cachedir, e)
+            return None
+        if (
+            not stat.S_ISDIR(st.st_mode) or
+            st.st_uid != os.geteuid() or
+            st.st_mode & 0o077
+        ):
+            log.warn("Not using %s, it is not a private directory", cachedir)
+            return None
+        return cachedir
+
+    def _read_cachefile(self, signature):
+        if self._cachedir() is None:
+            return None
+        try:
+            with open(self.cachefile, 'r') as f:
+                saved = _tostr(json.load(f))
+            # Tuples are saved as lists
+            if saved.get('signature') != _tostr(
+                json.loads(json.dumps(signature))
+            ):
+                return None
+            catalog = saved['catalog']
+            # JSON has no tuple keys, the index is saved as lists of
+            # entries which start with their key
+            catalog['index'] = dict(
+                (repo_id, dict((tuple(entry[:3]), entry) for entry in entries))
+                for repo_id, entries in catalog['index'].items()
+            )
+        except IOError:
+            return None
+        except Exception, e:
+            log.debug("Unable to load %s: %s", self.cachefile, e)
+            return None
+        return catalog
+
+    def _write_cachefile(self, signature, catalog):
+        cachedir = self._cachedir()
+        if cachedir is None:
+            return
+        catalog = dict(catalog)
+        catalog['index'] = dict(
+            (repo_id, entries.values())
+            for repo_id, entries in catalog['index'].items()
+        )
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=cachedir,
+                prefix=os.path.basename(self.cachefile) + '.',
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'signature': signature,
+                    'catalog': catalog,
+                }, f)
+            os.rename(tmp, self.cachefile)
+        except (IOError, OSError), e:
+            log.debug("Unable to save %s: %s", self.cachefile, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _check(self):
+        now = time.time()
+        with self._lock:
+            if self._signature is not None and (
+                now - self._checked < STAT_INTERVAL
+            ):
+                return
+            self._checked = now
+            signature = self._get_signature()
+            if signature == self._signature:
+                return
+
+            catalog = None
+            if self.cachefile:
+                catalog = self._read_cachefile(signature)
+            if catalog is None:
+                log.debug("Parsing PBI repositories index")
+                catalog = self._load(signature)
+                if self.cachefile:
+                    self._write_cachefile(signature, catalog)
+
+            self._repos = catalog['repos']
+            self._mirrors = catalog['mirrors']
+            self._index = catalog['index']
+            self._meta_count = catalog['meta_count']
+            self._icon_count = catalog['icon_count']
+            self._signature = signature
+            self.generation += 1
+
+    def invalidate(self):
+        """
+        Check the files again on the next lookup, e.g. after pbid has
+        been told to refresh
+        """
+        with self._lock:
+            self._checked = 0
+
+    def get_generation(self):
+        self._check()
+        return self.generation
+
+    def repo_ids(self):
+        self._check()
+        return self._repos.keys()
+
+    def mirrors(self, repo_id):
+        self._check()
+        return list(self._mirrors.get(repo_id, []))
+
+    def index_entry(self, repo_id, application, arch, version):
+        self._check()
+        entries = self._index.get(repo_id)
+        if not entries:
+            return None
+        return entries.get((
+            application.lower(),
+            (arch or '').lower(),
+            version.lower(),
+        ))
+
+    def meta_count(self):
+        self._check()
+        return self._meta_count
+
+    def icon_count(self):
+        self._check()
+        return self._icon_count
+
+
+repoCatalog = RepoCatalog()
@@ -0,0 +1,455 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Download of PBIs from the repository mirrors
+
+A PBI is fetched in SEGMENT_SIZE ranges. Each worker thread is bound
+to a mirror and takes the next pending range, so a faster mirror ends
+up serving more of the file. The fastest MAX_MIRRORS mirrors are used,
+ranked by the throughput measured on previous downloads. If a
+transfer fails, the range goes back to the queue with what was already
+written kept, and another request resumes it from there. A mirror
+that keeps failing is swapped for the next one.
+
+The SHA256 is computed while downloading. Data arriving in file order
+is hashed from memory. Ranges completed ahead of that point are read
+back from disk once the hash reaches them.
+
+Verified PBIs are kept by hash in a cache next to the download, so
+installing the same PBI into another jail does not download it again.
+"""
+import hashlib
+import logging
+import os
+import Queue
+import shutil
+import threading
+import time
+
+import requests
+
+log = logging.getLogger('plugins.download')
+
+# Timeout for connecting and for every read from a mirror
+MIRROR_TIMEOUT = 30
+MAX_MIRRORS = 3
+# Failed requests in a row before a worker gives up on its mirror
+MIRROR_FAILURES = 2
+SEGMENT_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 65536
+CACHE_DIRNAME = '.pbicache'
+# Verified PBIs kept in the cache
+CACHE_MAX = 8
+
+
+class MirrorStats(object):
+    """
+    Throughput of the mirrors in bytes per second, averaged over the
+    latest transfers
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._speed = {}
+
+    def record(self, url, size, elapsed):
+        if size <= 0 or elapsed <= 0:
+            return
+        speed = size / elapsed
+        with self._lock:
+            old = self._speed.get(url)
+            if old is None:
+                self._speed[url] = speed
+            else:
+                self._speed[url] = 0.7 * old + 0.3 * speed
+
+    def failed(self, url):
+        with self._lock:
+            if url in self._speed:
+                self._speed[url] /= 2
+
+    def rank(self, urls):
+        """
+        ``urls`` fastest first; mirrors never measured come first so
+        they get measured
+        """
+        with self._lock:
+            speed = dict(self._speed)
+        return sorted(
+            urls,
+            key=lambda url: -speed.get(url, float('inf')),
+        )
+
+    def stats(self):
+        with self._lock:
+            return dict(self._speed)
+
+
+mirror_stats = MirrorStats()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Segment(object):
+
+    def __init__(self, start, end):
+        self.start = start
+        # Exclusive, None if the size is unknown
+        self.end = end
+        # Bytes already written
+        self.done = 0
+
+    @property
+    def offset(self):
+        return self.start + self.done
+
+    @property
+    def complete(self):
+        return self.end is not None and self.offset >= self.end
+
+    def __repr__(self):
+        return "<Segment: %s-%s (%d)>" % (self.start, self.end, self.done)
+
+
+class PBIDownload(object):
+
+    def __init__(
+        self, urls, path, sha256=None, progress=None, cachedir=None,
+        stats=mirror_stats
+    ):
+        self.urls = list(urls)
+        self.path = path
+        self.sha256 = sha256.lower() if sha256 else None
+        self.progress = progress
+        if cachedir is None:
+            cachedir = os.path.join(
+                os.path.dirname(os.path.realpath(path)), CACHE_DIRNAME
+            )
+        self.cachedir = cachedir
+        self.stats = stats
+
+        self._lock = threading.Lock()
+        self._hash = hashlib.sha256()
+        self._hashed = 0
+        self._segments = []
+        self._queue = Queue.Queue()
+        self._mirrors = []
+        self._size = None
+        self._downloaded = 0
+        self._remaining = 0
+        self._percent = None
+        self._progress_fd = None
+        self._fd = None
+
+    def run(self):
+        """
+        Download the PBI to ``path``
+
+        Returns:
+            bool: whether the file is complete and matches the SHA256
+        """
+        if self.sha256 and self._from_cache():
+            self._write_progress(100)
+            return True
+
+        try:
+            self._download()
+        except DownloadError, e:
+            log.debug("Failed to download %s: %s", self.path, e)
+            return False
+        finally:
+            if self._progress_fd is not None:
+                self._progress_fd.close()
+                self._progress_fd = None
+
+        if not self.sha256:
+            log.debug("No hash provided to validate download (%s)", self.path)
+            return True
+        if self._hash.hexdigest() != self.sha256:
+            log.debug("SHA256 failed for %s", self.path)
+            return False
+        self._to_cache()
+        return True
+
+    def _cached(self):
+        return os.path.join(self.cachedir, "%s.pbi" % self.sha256)
+
+    def _from_cache(self):
+        cached = self._cached()
+        if not os.path.exists(cached):
+            return False
+        with open(cached, 'rb') as f:
+            dohash = hashlib.sha256()
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dohash.update(chunk)
+        if dohash.hexdigest() != self.sha256:
+            log.warn("Removing corrupted cached PBI %s", cached)
+            os.unlink(cached)
+            return False
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        try:
+            os.link(cached, self.path)
+        except OSError:
+            shutil.copyfile(cached, self.path)
+        os.utime(cached, None)
+        log.debug("Using cached PBI %s", cached)
+        return True
+
+    def _to_cache(self):
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            cached = self._cached()
+            tmp = "%s.%d" % (cached, os.getpid())
+            try:
+                os.link(self.path, tmp)
+            except OSError:
+                shutil.copyfile(self.path, tmp)
+            os.rename(tmp, cached)
+
+            entries = []
+            for name in os.listdir(self.cachedir):
+                if not name.endswith('.pbi'):
+                    continue
+                entry = os.path.join(self.cachedir, name)
+                entries.append((os.stat(entry).st_mtime, entry))
+            entries.sort(reverse=True)
+            for mtime, entry in entries[CACHE_MAX:]:
+                os.unlink(entry)
+        except (IOError, OSError), e:
+            log.debug("Failed to cache %s: %s", self.path, e)
+
+    def _write_progress(self, percent):
+        if not self.progress:
+            return
+        if self._progress_fd is None:
+            self._progress_fd = open(self.progress, 'w')
+        self._progress_fd.write("%d\n" % percent)
+        self._progress_fd.flush()
+        if percent == 100:
+            self._progress_fd.close()
+            self._progress_fd = None
+
+    def _probe(self, url):
+        """
+        Size of the file and whether ``url`` serves ranges
+        """
+        r = requests.get(
+            url, headers={'Range': 'bytes=0-0'}, stream=True,
+            timeout=MIRROR_TIMEOUT,
+        )
+        try:
+            if r.status_code == requests.codes.partial_content:
+                # Content-Range: bytes 0-0/<size>
+                total = r.headers.get('content-range', '').rsplit('/', 1)[-1]
+                if total.strip().isdigit():
+                    return int(total), True
+                return None, False
+            if r.status_code != requests.codes.ok:
+                raise DownloadError("HTTP %d" % r.status_code)
+            try:
+                size = int(r.headers.get('content-length', '').strip())
+            except ValueError:
+                size = None
+            return size, False
+        finally:
+            r.close()
+
+    def _download(self):
+        mirrors = self.stats.rank(self.urls)
+        size = ranges = None
+        while mirrors:
+            url = mirrors[0]
+            try:
+                size, ranges = self._probe(url)
+                break
+            except (requests.RequestException, DownloadError), e:
+                log.debug("Mirror %s unavailable: %s", url, e)
+                self.stats.failed(url)
+                mirrors.pop(0)
+        if not mirrors:
+            raise DownloadError("No mirror available")
+
+        self._size = size
+        if size and ranges:
+            self._segments = [
+                Segment(start, min(start + SEGMENT_SIZE, size))
+                for start in xrange(0, size, SEGMENT_SIZE)
+            ]
+        else:
+            self._segments = [Segment(0, size)]
+        for segment in self._segments:
+            self._queue.put(segment)
+        self._remaining = len(self._segments)
+
+        self._mirrors = mirrors
+        nworkers = min(len(self._segments), MAX_MIRRORS, len(mirrors))
+
+        self._write_progress(0)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            if size:
+                os.ftruncate(self._fd, size)
+            workers = []
+            for i in range(nworkers):
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+        for segment in self._segments:
+            if segment.end is None or not segment.complete:
+                raise DownloadError("Incomplete download")
+        self._write_progress(100)
+
+    def _next_mirror(self):
+        with self._lock:
+            if self._mirrors:
+                return self._mirrors.pop(0)
+        return None
+
+    def _worker(self):
+        url = self._next_mirror()
+        failures = 0
+        while url is not None:
+            try:
+                segment = self._queue.get(timeout=0.5)
+            except Queue.Empty:
+                # Ranges still being fetched elsewhere may come back
+                with self._lock:
+                    if self._remaining == 0:
+                        return
+                continue
+            done = segment.done
+            try:
+                self._fetch(url, segment)
+                with self._lock:
+                    self._remaining -= 1
+            except (requests.RequestException, DownloadError, IOError), e:
+                log.debug("Failed to fetch %r from %s: %s", segment, url, e)
+                self.stats.failed(url)
+                self._queue.put(segment)
+                # Only count the failures that got nothing, a transfer
+                # cut short is resumed where it stopped
+                if segment.done == done:
+                    failures += 1
+                if failures >= MIRROR_FAILURES:
+                    url = self._next_mirror()
+                    failures = 0
+
+    def _fetch(self, url, segment):
+        headers = {}
+        if segment.end is not None and (
+            segment.start > 0 or segment.end != self._size or segment.done
+        ):
+            headers['Range'] = 'bytes=%d-%d' % (
+                segment.offset, segment.end - 1
+            )
+        elif segment.done:
+            headers['Range'] = 'bytes=%d-' % segment.offset
+
+        start = time.time()
+        fetched = 0
+        r = requests.get(
+            url, headers=headers, stream=True, timeout=MIRROR_TIMEOUT
+        )
+        try:
+            if headers and r.status_code != requests.codes.partial_content:
+                raise DownloadError("Range not honoured (HTTP %d)" % (
+                    r.status_code,
+                ))
+            if not headers and r.status_code != requests.codes.ok:
+                raise DownloadError("HTTP %d" % r.status_code)
+
+            for chunk in r.iter_content(CHUNK_SIZE):
+                if segment.end is not None:
+                    chunk = chunk[:segment.end - segment.offset]
+                if not chunk:
+                    break
+                self._write(segment, chunk)
+                fetched += len(chunk)
+                if segment.complete:
+                    break
+        finally:
+            r.close()
+            self.stats.record(url, fetched, time.time() - start)
+
+        if segment.end is None:
+            segment.end = segment.offset
+        elif not segment.complete:
+            raise DownloadError("Connection closed at %d" % segment.offset)
+
+    def _write(self, segment, chunk):
+        offset = segment.offset
+        with self._lock:
+            # os.write from several threads on one descriptor, the lock
+            # keeps lseek and write together
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            os.write(self._fd, chunk)
+            segment.done += len(chunk)
+            self._downloaded += len(chunk)
+            if offset == self._hashed:
+                self._hash.update(chunk)
+                self._hashed += len(chunk)
+            self._catch_up()
+            if self._size:
+                percent = int(self._downloaded * 100 / self._size)
+                if percent != self._percent and percent < 100:
+                    self._percent = percent
+                    self._write_progress(percent)
+
+    def _catch_up(self):
+        """
+        Hash the data already on disk following the hashed part
+        """
+        for segment in self._segments:
+            if segment.end is not None and segment.end <= self._hashed:
+                continue
+            if segment.start > self._hashed:
+                break
+            while self._hashed < segment.offset:
+                os.lseek(self._fd, self._hashed, os.SEEK_SET)
+                data = os.read(
+                    self._fd, min(CHUNK_SIZE, segment.offset - self._hashed)
+                )
+                if not data:
+                    return
+                self._hash.update(data)
+                self._hashed += len(data)
+            if not segment.complete:
+                break
@@ -1,15 +1,11 @@
-import hashlib
 import logging
-import os
 import platform
 import requests
 import re
-import urllib2
-
-from django.utils.translation import ugettext as _
 
 from freenasUI.common import pbi
-from freenasUI.middleware.exceptions import MiddlewareError
+from freenasUI.plugins.catalog import repoCatalog
+from freenasUI.plugins.download import PBIDownload
 
 import platform as p
 if p.machine() == 'amd64':
@@ -100,99 +96,25 @@ class Plugin(object):
         if not self.urls:
             raise ValueError("No mirrors available")
 
-        rv = False
-        for url in self.urls:
-            rpath = "%s/%s" % (url, self.file)
-            try:
-                rv = self.__download(rpath, path)
-                if rv:
-                    break
-            except Exception, e:
-                log.debug(
-                    "Failed to download %s (%s): %s",
-                    url,
-                    type(e).__class__,
-                    e,
-                )
-                #FIXME: try to download from multiple urls
-                raise MiddlewareError(
-                    _("Failed to download %(url)s: %(error)s" % {
-                        url,
-                        e,
-                    })
-                )
-
-        return rv
-
-    def __download(self, url, path):
-        response = urllib2.urlopen(url)
-        try:
-            total_size = int(
-                response.info().getheader('Content-Length').strip()
-            )
-        except Exception, e:
-            log.debug(
-                "Error getting Content-Length header (%s): %s",
-                type(e).__class__,
-                e,
-            )
-            total_size = None
-
-        rv = True
-        csize = 20480
-        downloaded = 0
-        last_percent = 0
-
-        with open(path, 'wb+') as f, open(PROGRESS_FILE, 'w') as f2:
-
-            if total_size:
-                f2.write("0\n")
-                f2.flush()
-
-            while True:
-                chunk = response.read(csize)
-                if not chunk:
-                    break
-
-                f.write(chunk)
-
-                if total_size:
-                    downloaded += len(chunk)
-                    percent = float(downloaded) / total_size
-                    percent = round(percent * 100, 2)
-                    if int(percent) != last_percent:
-                        f2.write("%d\n" % percent)
-                        f2.flush()
-                    last_percent = int(percent)
-
-            if total_size and downloaded != total_size:
-                return False
-
-            if self.hash:
-                log.debug("No hash provided to validate download (%r)", self)
-                f.seek(0)
-                dohash = hashlib.sha256()
-                while True:
-                    chunk = f.read(csize)
-                    if not chunk:
-                        break
-                    dohash.update(chunk)
-                if dohash.hexdigest() != self.hash:
-                    log.debug("SHA256 failed for %s", url)
-                    return False
-
-        return rv
+        return PBIDownload(
+            ["%s/%s" % (url, self.file) for url in self.urls],
+            path,
+            sha256=self.hash,
+            progress=PROGRESS_FILE,
+        ).run()
 
 
 class Available(object):
 
     __cache = None
+    __by = None
     __repo_id = None
     __repo_desc = None
     __def_repo = None
 
     def __init__(self):
         self.__cache = dict()
+        self.__by = dict()
 
     def _def_repo_id(self, repo_id=None):
         """
@@ -281,36 +203,16 @@ class Available(object):
         return None
 
     def get_mirror_urls(self, repo_id):
-        reposdir = "/var/db/pbi/repos"
-        mirrorsdir = "/var/db/pbi/mirrors"
-
         if not repo_id:
             repo_id = self._def_repo_id()
             if not repo_id:
                 return None
 
-        urls = []
-        for f in os.listdir(reposdir):
-            parts = f.split('.')
-            if not parts:
-                continue
-            id = parts[0]
-            if id == repo_id:
-                fp = "%s/%s" % (mirrorsdir, parts[1])
-                with open(fp, "r") as mirrors:
-                    for line in mirrors:
-                        mirror = line.strip()
-                        urls.append(mirror)
-                    mirrors.close()
-
-        return urls
+        return repoCatalog.mirrors(repo_id)
 
     def get_index_entry(
         self, repo_id=None, application=None, arch=None, version=None
     ):
-        reposdir = "/var/db/pbi/repos"
-        indexdir = "/var/db/pbi/index"
-
         if not application or not version:
             return None
 
@@ -319,35 +221,7 @@ class Available(object):
             if not repo_id:
                 return None
 
-        sha256 = None
-        for f in os.listdir(reposdir):
-            parts = f.split('.')
-            if not parts:
-                continue
-            id = parts[0]
-            if id == repo_id:
-                sha256 = parts[1]
-                break
-
-        if sha256:
-            try:
-                indexfile = "%s/%s-index" % (indexdir, sha256)
-                with open(indexfile, "r") as f:
-                    for line in f:
-                        parts = line.split(':')
-                        if (
-                            parts[0] == application.lower() and
-                            parts[1] == arch.lower() and
-                            parts[2] == version.lower()
-                        ):
-                            return parts
-                    f.close()
-
-            except Exception:
-                log.debug("Unable to open up repo with sha256: %s", sha256)
-                return None
-
-        return None
+        return repoCatalog.index_entry(repo_id, application, arch, version)
 
     #
     # get_icon_count()
@@ -358,42 +232,7 @@ class Available(object):
     # available (A newly installed machine on which pbid is first run).
     #
     def get_icon_count(self):
-        icon_count = 0
-
-        repo_hashes = [] 
-        for f in os.listdir(pbi.PBID_REPOSDIR):
-            parts = f.split('.')
-            repo_hashes.append(parts[-1])
-
-        meta_files = {}
-        for h in repo_hashes:
-            meta_path = "%s/%s-meta" % (pbi.PBID_INDEXDIR, h)
-            if os.path.exists(meta_path):
-                meta_files[h] = meta_path
-
-        meta = {}
-        total_count = 0
-        for h in meta_files:
-            m = meta_files[h]
-            with open(m, 'r') as f:
-                lines = []
-                for l in f.readlines():
-                    lines.append(l.strip())
-                total_count += len(lines)  
-                meta[h] = lines
-                f.close()
-
-        for h in meta:
-            m = meta[h]
-            for line in m:
-                parts = line.split(';')  
-                app = parts[0].replace("App=", "")
-                ext = parts[2].split('.')[-1]
-                icon_path = "%s/%s-%s.%s" % (pbi.PBID_ICONSDIR, h, app, ext)
-                if os.path.exists(icon_path):
-                    icon_count += 1
-
-        return icon_count
+        return repoCatalog.icon_count()
 
     #
     # get_total_icon_count()
@@ -403,40 +242,14 @@ class Available(object):
     # used when pbi_browser is not yet initialized.
     #
     def get_total_icon_count(self):
-        total_count = 0
-
-        repo_hashes = [] 
-        for f in os.listdir(pbi.PBID_REPOSDIR):
-            parts = f.split('.')
-            repo_hashes.append(parts[-1])
-
-        meta_files = {}
-        for h in repo_hashes:
-            meta_path = "%s/%s-meta" % (pbi.PBID_INDEXDIR, h)
-            if os.path.exists(meta_path):
-                meta_files[h] = meta_path
-
-        meta = {}
-        for h in meta_files:
-            m = meta_files[h]
-            with open(m, 'r') as f:
-                lines = []
-                for l in f.readlines():
-                    lines.append(l.strip())
-                total_count += len(lines)  
-                meta[h] = lines
-                f.close()
-
-        return total_count
+        return repoCatalog.meta_count()
 
     def get_icon(self, repo_id=None, oid=None):
 
         icon_path = None
-        available = self.get_remote(repo_id=None, cache=True)
-        for p in available:
-            if p.id == oid:
-                icon_path = p.icon
-                break
+        p = self._get_remote_by('id', oid)
+        if p is not None:
+            icon_path = p.icon
 
         icon = None
         if icon_path:
@@ -460,10 +273,8 @@ class Available(object):
             iplugin = iplugin[0]
 
         rplugin = None
-        for rp in self.get_remote(cache=True):
-            if rp.name == iplugin.plugin_name:
-                rplugin = rp
-                break
+        if iplugin:
+            rplugin = self._get_remote_by('name', iplugin.plugin_name)
 
         if rplugin and iplugin:
             if str(iplugin.plugin_version).lower() != str(rplugin.version).lower():
@@ -480,13 +291,16 @@ class Available(object):
         if not repo_id:
             repo_id = self._def_repo_id()
         if cache and repo_id in self.__cache:
-            log.debug("Using cached results for %s", repo_id)
-            return self.__cache.get(repo_id)
+            generation, plugins = self.__cache[repo_id]
+            if generation == repoCatalog.get_generation():
+                log.debug("Using cached results for %s", repo_id)
+                return plugins
 
         log.debug("Retrieving available plugins from repo %s", repo_id)
 
         p = pbi.PBI()
         p.pbid(flags=pbi.PBID_FLAGS_REFRESH, sync=True)
+        repoCatalog.invalidate()
 
         results = p.browser(repo_id=repo_id, flags=pbi.PBI_BROWSER_FLAGS_VIEWALL)
         if not results:
@@ -495,6 +309,7 @@ class Available(object):
             )
             return results
 
+        urls = self.get_mirror_urls(repo_id)
         plugins = []
         for p in results:
             try:
@@ -508,8 +323,6 @@ class Available(object):
                     log.debug("not index entry found for %s", p['Application'])
                     continue
 
-                urls = self.get_mirror_urls(repo_id)
-
                 item = self._get_remote_item(repo_id, p, index_entry, urls)
                 if item is False:
                     log.debug("unable to create plugin for %s", p['Application'])
@@ -519,9 +332,21 @@ class Available(object):
             except Exception as e:
                 log.debug("Failed to get remote item: %s", e)
 
-        self.__cache[repo_id] = plugins
+        self.__cache[repo_id] = (repoCatalog.get_generation(), plugins)
+        self.__by[repo_id] = {
+            'id': dict((item.id, item) for item in reversed(plugins)),
+            'name': dict((item.name, item) for item in reversed(plugins)),
+        }
         return plugins
 
+    def _get_remote_by(self, key, value):
+        """
+        Remote plugin (cached) whose ``key`` is ``value``
+        """
+        repo_id = self._def_repo_id()
+        self.get_remote(repo_id=repo_id, cache=True)
+        return self.__by.get(repo_id, {}).get(key, {}).get(value)
+
     def _get_remote_item(self, repo_id, p, ie, urls):
         arch = p['Arch']
         if arch != platform.machine():
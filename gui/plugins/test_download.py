@@ -0,0 +1,179 @@
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+from freenasUI.plugins import download
+
+
+class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves the files of the current directory honouring single
+    "bytes=start-[end]" ranges, misbehaving as told by the server
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        rng = self.headers.getheader('Range')
+        with server.lock:
+            server.ranges.append(rng)
+            probe = rng == 'bytes=0-0'
+            if server.fail or (server.fail_ranges and not probe):
+                self.send_error(500)
+                return
+            cut = None
+            if server.cut is not None and not probe:
+                cut, server.cut = server.cut, None
+
+        path = self.translate_path(self.path)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.send_error(404)
+            return
+
+        if rng:
+            start, end = rng.split('=', 1)[1].split('-')
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, len(data)
+            ))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if cut is not None:
+            # Drop the connection in the middle of the transfer
+            self.wfile.write(body[:cut])
+            return
+        self.wfile.write(body)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), RangeHandler
+        )
+        self.lock = threading.Lock()
+        self.ranges = []
+        # Fail every request
+        self.fail = False
+        # Fail every request but the size probe
+        self.fail_ranges = False
+        # Bytes sent before closing the next transfer
+        self.cut = None
+
+
+class PBIDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'mirror')
+        os.mkdir(self.root)
+        self.data = os.urandom(5 * 8192 + 1234)
+        with open(os.path.join(self.root, 'test.pbi'), 'wb') as f:
+            f.write(self.data)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.path = os.path.join(self.tmp, 'test.pbi')
+        self.cachedir = os.path.join(self.tmp, 'cache')
+
+        self._cwd = os.getcwd()
+        os.chdir(self.root)
+        self.servers = []
+
+        self._settings = (
+            download.SEGMENT_SIZE,
+            download.CHUNK_SIZE,
+            download.MAX_MIRRORS,
+            download.MIRROR_TIMEOUT,
+        )
+        download.SEGMENT_SIZE = 8192
+        download.CHUNK_SIZE = 1024
+        download.MIRROR_TIMEOUT = 5
+
+    def tearDown(self):
+        (
+            download.SEGMENT_SIZE,
+            download.CHUNK_SIZE,
+            download.MAX_MIRRORS,
+            download.MIRROR_TIMEOUT,
+        ) = self._settings
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        os.chdir(self._cwd)
+        shutil.rmtree(self.tmp)
+
+    def mirror(self):
+        server = MirrorServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server, 'http://127.0.0.1:%d/test.pbi' % (
+            server.server_address[1],
+        )
+
+    def run_download(self, urls, sha256):
+        return download.PBIDownload(
+            urls, self.path, sha256=sha256, cachedir=self.cachedir,
+            stats=download.MirrorStats(),
+        ).run()
+
+    def downloaded(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        server, url = self.mirror()
+        server.cut = 3000
+        self.assertTrue(self.run_download([url], self.sha256))
+        self.assertEqual(self.downloaded(), self.data)
+        # The first range was cut short and asked again from there
+        self.assertEqual(server.ranges[:2], ['bytes=0-0', 'bytes=0-8191'])
+        self.assertEqual(server.ranges.count('bytes=0-8191'), 1)
+        self.assertIn('bytes=3000-8191', server.ranges)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cachedir, '%s.pbi' % self.sha256)
+        ))
+
+    def test_failover(self):
+        download.MAX_MIRRORS = 1
+        bad, bad_url = self.mirror()
+        bad.fail_ranges = True
+        good, good_url = self.mirror()
+        self.assertTrue(self.run_download([bad_url, good_url], self.sha256))
+        self.assertEqual(self.downloaded(), self.data)
+        # Size probe and then MIRROR_FAILURES failed ranges
+        self.assertEqual(len(bad.ranges), 1 + download.MIRROR_FAILURES)
+        self.assertTrue(good.ranges)
+
+    def test_unavailable_mirror(self):
+        bad, bad_url = self.mirror()
+        bad.fail = True
+        good, good_url = self.mirror()
+        self.assertTrue(self.run_download([bad_url, good_url], self.sha256))
+        self.assertEqual(self.downloaded(), self.data)
+        self.assertEqual(bad.ranges, ['bytes=0-0'])
+
+    def test_hash_mismatch(self):
+        server, url = self.mirror()
+        self.assertFalse(self.run_download([url], '0' * 64))
+        self.assertFalse(os.path.exists(self.cachedir))
@@ -26,11 +26,13 @@
 #####################################################################
 import json
 import logging
-import re
 
 from django.utils.translation import ugettext as _
 
 from freenasUI.middleware.notifier import notifier
+from freenasUI.plugins.utils.health import (
+    PLUGIN_ACTION_TIMEOUT, plugin_health
+)
 
 from ipaddr import IPv6Address
 
@@ -59,106 +61,46 @@ def get_base_url(request=None):
     return "%s://%s" % (proto, addr)
 
 
-def get_plugin_status(args):
-    plugin, host, request = args
-    if re.match('^.+\[.+\]', host, re.I):
-        import urllib2
-    else:
-        from eventlet.green import urllib2
-
-    url = "%s/plugins/%s/%d/_s/status" % (
-        host,
-        plugin.plugin_name,
-        plugin.id)
+def _plugin_call(plugin, host, request, endpoint, **kwargs):
     data = None
 
     jail_status = notifier().pluginjail_running(pjail=plugin.plugin_jail)
     if not jail_status:
         return plugin, data, jail_status
 
-    try:
-        opener = urllib2.build_opener()
-        opener.addheaders = [
-            ('Cookie', 'sessionid=%s' % (
-                request.COOKIES.get("sessionid", ''),
-            ))
-        ]
-        #TODO: Increase timeout based on number of plugins
-        response = opener.open(url, None).read()
-        data = json.loads(response)
-    except Exception, e:
-        log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
-            'url': url,
-            'error': e,
-        })
+    url, response = plugin_health.fetch(
+        plugin, host, request, endpoint, **kwargs
+    )
+    if response is not None:
+        try:
+            data = json.loads(response)
+        except ValueError, e:
+            log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
+                'url': url,
+                'error': e,
+            })
     return plugin, data, jail_status
 
 
-def get_plugin_start(args):
+def get_plugin_status(args):
     plugin, host, request = args
-    if re.match('^.+\[.+\]', host, re.I):
-        import urllib2
-    else:
-        from eventlet.green import urllib2
+    return _plugin_call(plugin, host, request, 'status')
 
-    url = "%s/plugins/%s/%d/_s/start" % (
-        host,
-        plugin.plugin_name,
-        plugin.id)
-    data = None
 
-    jail_status = notifier().pluginjail_running(pjail=plugin.plugin_jail)
-    if not jail_status:
-        return plugin, data, jail_status
-
-    try:
-        opener = urllib2.build_opener()
-        opener.addheaders = [
-            ('Cookie', 'sessionid=%s' % (
-                request.COOKIES.get("sessionid", ''),
-            ))
-        ]
-        #TODO: Increase timeout based on number of plugins
-        response = opener.open(url, None).read()
-        data = json.loads(response)
-    except Exception, e:
-        log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
-            'url': url,
-            'error': e,
-        })
-    return plugin, data, jail_status
+def get_plugin_start(args):
+    plugin, host, request = args
+    # Asked for explicitly, give it another chance
+    plugin_health.reset(plugin)
+    return _plugin_call(
+        plugin, host, request, 'start',
+        timeout=PLUGIN_ACTION_TIMEOUT, breaker=False,
+    )
 
 
 def get_plugin_stop(args):
     plugin, host, request = args
-    if re.match('^.+\[.+\]', host, re.I):
-        import urllib2
-    else:
-        from eventlet.green import urllib2
-
-    url = "%s/plugins/%s/%d/_s/stop" % (
-        host,
-        plugin.plugin_name,
-        plugin.id)
-    data = None
-
-    jail_status = notifier().pluginjail_running(pjail=plugin.plugin_jail)
-    if not jail_status:
-        return plugin, data, jail_status
-
-    try:
-        opener = urllib2.build_opener()
-        opener.addheaders = [
-            ('Cookie', 'sessionid=%s' % (
-                request.COOKIES.get("sessionid", ''),
-            ))
-        ]
-        #TODO: Increase timeout based on number of plugins
-        response = opener.open(url, None).read()
-        data = json.loads(response)
-    except Exception, e:
-        log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
-            'url': url,
-            'error': e,
-        })
-    return plugin, data, jail_status
+    plugin_health.reset(plugin)
+    return _plugin_call(
+        plugin, host, request, 'stop',
+        timeout=PLUGIN_ACTION_TIMEOUT, breaker=False,
+    )
@@ -7,9 +7,14 @@ import select
 import struct
 import socket
 import errno
+import logging
+import threading
+import time
 import types
 import urllib
 
+log = logging.getLogger('plugins.utils.fcgi_client')
+
 # Constants from the spec.
 FCGI_LISTENSOCK_FILENO = 0
 
@@ -52,6 +57,11 @@ FCGI_BeginRequestBody = '!HB5x'
 FCGI_EndRequestBody = '!LB3x'
 FCGI_UnknownTypeBody = '!B7x'
 
+# Largest content of a single record
+FCGI_MAX_CONTENT = 65535
+# Size of the chunks of request body sent as FCGI_STDIN
+FCGI_STDIN_CHUNK = 32768
+
 FCGI_BeginRequestBody_LEN = struct.calcsize(FCGI_BeginRequestBody)
 FCGI_EndRequestBody_LEN = struct.calcsize(FCGI_EndRequestBody)
 FCGI_UnknownTypeBody_LEN = struct.calcsize(FCGI_UnknownTypeBody)
@@ -203,101 +213,223 @@ class Record(object):
         if self.paddingLength:
             self._sendall(sock, '\x00'*self.paddingLength)
 
+class FCGIConnectionPool(object):
+    """
+    Idle connections to FastCGI applications, kept open with
+    FCGI_KEEP_CONN and reused by the following requests
+    """
+
+    def __init__(self, maxIdle=4, idleTimeout=30):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._maxConns = {}
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+
+    def get(self, address):
+        """
+        An idle connection to ``address``, None if there is none
+        """
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(address)
+                if not idle:
+                    return None
+                sock, since = idle.pop()
+            # An idle connection has nothing to read unless the
+            # application closed it
+            if (
+                now - since < self.idleTimeout and
+                not select.select([sock], [], [], 0)[0]
+            ):
+                return sock
+            sock.close()
+
+    def put(self, address, sock):
+        with self._lock:
+            idle = self._idle.setdefault(address, [])
+            limit = min(self.maxIdle, self._maxConns.get(address, self.maxIdle))
+            if len(idle) < limit:
+                idle.append((sock, time.time()))
+                return
+        sock.close()
+
+    def knows(self, address):
+        with self._lock:
+            return address in self._maxConns
+
+    def setMaxConns(self, address, maxConns):
+        with self._lock:
+            self._maxConns[address] = maxConns
+
+
+fcgiPool = FCGIConnectionPool()
+
+
 class FCGIApp(object):
 
-    def __init__(self, connect=None, host=None, port=None, filterEnviron=True):
+    def __init__(self, connect=None, host=None, port=None, filterEnviron=True,
+                 pool=fcgiPool):
         if host is not None:
             assert port is not None
             connect=(host, port)
 
         self._connect = connect
         self._filterEnviron = filterEnviron
+        self._pool = pool
 
     def __call__(self, environ, start_response=None, args={}):
-        # For sanity's sake, we don't care about FCGI_MPXS_CONN
-        # (connection multiplexing). For every request, we obtain a new
-        # transport socket, perform the request, then discard the socket.
-        # This is, I believe, how mod_fastcgi does things...
+        """
+        Perform a request and return the whole response
 
-        sock = self._getConnection()
+        Returns:
+            (status, headers, body, stderr)
+        """
+        err = []
+        status, headers, body = self.stream(
+            environ, [urllib.urlencode(args)], errors=err
+        )
+        result = ''.join(body)
+        return status, headers, result, ''.join(err)
+
+    def stream(self, environ, body=None, errors=None):
+        """
+        Perform a request sending ``body``, an iterable of strings, as it
+        is produced
 
-        # Since this is going to be the only request on this connection,
-        # set the request ID to 1.
-        requestId = 1
+        The response body is returned as a generator reading it from the
+        application as it is consumed. The connection goes back to the
+        pool once all of it has been read, or is closed if the body is
+        left unread.
 
-        # Begin the request
-        rec = Record(FCGI_BEGIN_REQUEST, requestId)
-        rec.contentData = struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER, 0)
-        rec.contentLength = FCGI_BeginRequestBody_LEN
-        rec.write(sock)
+        Returns:
+            (status, headers, body)
+        """
+        # One request at a time on a connection, so the ID is always 1
+        requestId = 1
+        if errors is None:
+            errors = []
 
-        # Filter WSGI environ and send it as FCGI_PARAMS
-        if self._filterEnviron:
-            params = self._defaultFilterEnviron(environ)
-        else:
-            params = self._lightFilterEnviron(environ)
+        sock = None
+        if self._pool is not None:
+            sock = self._pool.get(self._connect)
+        if sock is None:
+            sock = self._getConnection()
 
-        self._fcgiParams(sock, requestId, params)
-        self._fcgiParams(sock, requestId, {})
+        try:
+            # Begin the request
+            rec = Record(FCGI_BEGIN_REQUEST, requestId)
+            rec.contentData = struct.pack(
+                FCGI_BeginRequestBody,
+                FCGI_RESPONDER,
+                FCGI_KEEP_CONN if self._pool is not None else 0,
+            )
+            rec.contentLength = FCGI_BeginRequestBody_LEN
+            rec.write(sock)
 
-        data = urllib.urlencode(args)
-        while True:
+            # Filter WSGI environ and send it as FCGI_PARAMS
+            if self._filterEnviron:
+                params = self._defaultFilterEnviron(environ)
+            else:
+                params = self._lightFilterEnviron(environ)
+
+            self._fcgiParams(sock, requestId, params)
+            self._fcgiParams(sock, requestId, {})
+
+            for data in body or []:
+                while data:
+                    rec = Record(FCGI_STDIN, requestId)
+                    rec.contentData = data[:FCGI_STDIN_CHUNK]
+                    rec.contentLength = len(rec.contentData)
+                    rec.write(sock)
+                    data = data[FCGI_STDIN_CHUNK:]
             rec = Record(FCGI_STDIN, requestId)
-            length = min(4096, len(data))
-            rec.contentData = data[:length]
-            rec.contentLength = length
             rec.write(sock)
-            data = data[length:]
 
-            if not data:
-                rec = Record(FCGI_STDIN, requestId)
-                rec.contentData = ''
-                rec.contentLength = 0
-                rec.write(sock)
-                break
+            # Empty FCGI_DATA stream
+            rec = Record(FCGI_DATA, requestId)
+            rec.write(sock)
 
+            # Read FCGI_STDOUT up to the end of the headers
+            result = ''
+            ended = False
+            while True:
+                inrec = Record()
+                inrec.read(sock)
+                if inrec.type == FCGI_STDOUT:
+                    result += inrec.contentData
+                    if '\r\n\r\n' in result or '\n\n' in result:
+                        break
+                elif inrec.type == FCGI_STDERR:
+                    errors.append(inrec.contentData)
+                elif inrec.type == FCGI_END_REQUEST:
+                    ended = True
+                    break
+        except:
+            sock.close()
+            raise
 
-        # Empty FCGI_DATA stream
-        rec = Record(FCGI_DATA, requestId)
-        rec.write(sock)
+        status, headers, pos = self._parseHeaders(result)
+        return status, headers, self._body(
+            sock, result[pos:], ended, errors
+        )
 
-        # Main loop. Process FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST
-        # records from the application.
-        result = []
-        err = ''
-        while True:
-            inrec = Record()
-            inrec.read(sock)
-            if inrec.type == FCGI_STDOUT:
-                if inrec.contentData:
-                    result.append(inrec.contentData)
-                else:
-                    # TODO: Should probably be pedantic and no longer
-                    # accept FCGI_STDOUT records?"
-                    pass
-            elif inrec.type == FCGI_STDERR:
-                # Simply forward to wsgi.errors
-                err += inrec.contentData
-                #environ['wsgi.errors'].write(inrec.contentData)
-            elif inrec.type == FCGI_END_REQUEST:
-                # TODO: Process appStatus/protocolStatus fields?
-                break
+    def _body(self, sock, data, ended, errors):
+        done = False
+        try:
+            if data:
+                yield data
+            while not ended:
+                inrec = Record()
+                inrec.read(sock)
+                if inrec.type == FCGI_STDOUT:
+                    if inrec.contentData:
+                        yield inrec.contentData
+                elif inrec.type == FCGI_STDERR:
+                    errors.append(inrec.contentData)
+                elif inrec.type == FCGI_END_REQUEST:
+                    ended = True
+            done = True
+        finally:
+            if errors:
+                log.debug("FastCGI stderr of %r: %s", self._connect, ''.join(errors))
+            if done and self._pool is not None:
+                self._release(sock)
+            else:
+                sock.close()
 
-        # Done with this transport socket, close it. (FCGI_KEEP_CONN was not
-        # set in the FCGI_BEGIN_REQUEST record we sent above. So the
-        # application is expected to do the same.)
-        sock.close()
+    def _release(self, sock):
+        if not self._pool.knows(self._connect):
+            # Do not keep more connections than the application takes
+            sock.settimeout(2)
+            try:
+                values = self._fcgiGetValues(sock, [FCGI_MAX_CONNS])
+                maxConns = int(values.get(FCGI_MAX_CONNS) or 0)
+            except (EOFError, ValueError, socket.error):
+                sock.close()
+                return
+            sock.settimeout(None)
+            if maxConns > 0:
+                self._pool.setMaxConns(self._connect, maxConns)
+            else:
+                self._pool.setMaxConns(self._connect, self._pool.maxIdle)
+        self._pool.put(self._connect, sock)
 
-        result = ''.join(result)
+    def _parseHeaders(self, result):
+        """
+        Parse response headers from FCGI_STDOUT
 
-        # Parse response headers from FCGI_STDOUT
+        Returns:
+            (status, headers, position of the body)
+        """
         status = '200 OK'
         headers = []
         pos = 0
         while True:
             eolpos = result.find('\n', pos)
             if eolpos < 0: break
-            line = result[pos:eolpos-1]
+            line = result[pos:eolpos]
             pos = eolpos + 1
 
             # strip in case of CR. NB: This will also strip other
@@ -321,13 +453,7 @@ class FCGIApp(object):
             else:
                 headers.append((header, value))
 
-        result = result[pos:]
-
-        # Set WSGI status, headers, and return result.
-        #start_response(status, headers)
-        #return [result]
-
-        return status, headers, result, err
+        return status, headers, pos
 
     def _getConnection(self):
         if self._connect is not None:
@@ -352,7 +478,7 @@ class FCGIApp(object):
         data = []
         for name in vars:
             data.append(encode_pair(name, ''))
-        data = ''.join(data)
+        data = bytearray('').join(data)
         outrec.contentData = data
         outrec.contentLength = len(data)
         outrec.write(sock)
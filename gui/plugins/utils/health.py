@@ -0,0 +1,231 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Health of the plugins, as seen through their HTTP endpoints
+
+Every request to a plugin goes through a per-plugin circuit breaker.
+After FAILURE_THRESHOLD consecutive failures the plugin is not asked
+again until its backoff expires, doubling from BACKOFF_MIN up to
+BACKOFF_MAX while it keeps failing, so a dead plugin jail costs one
+timeout now and then instead of one on every page load.
+
+The last successful payload of each endpoint is kept to be served
+while the circuit is open, and response times are recorded per plugin.
+"""
+import logging
+import re
+import threading
+import time
+
+from django.utils.translation import ugettext as _
+
+log = logging.getLogger('plugins.utils.health')
+
+# Seconds to wait for a plugin to answer
+PLUGIN_TIMEOUT = 5
+# Starting or stopping a plugin may legitimately take much longer
+PLUGIN_ACTION_TIMEOUT = 600
+FAILURE_THRESHOLD = 3
+BACKOFF_MIN = 30
+BACKOFF_MAX = 600
+
+
+class PluginCircuit(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.backoff = BACKOFF_MIN
+        self.open_until = None
+        self.requests = 0
+        self.errors = 0
+        self.skipped = 0
+        self.last_time = None
+        self.avg_time = None
+        self.last_error = None
+        self.last_success = None
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return 'closed'
+        if time.time() < self.open_until:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """
+        Whether the plugin may be asked now
+
+        Once the backoff expires a single request is let through; its
+        outcome closes the circuit or opens it again for longer.
+        """
+        if self.open_until is None:
+            return True
+        now = time.time()
+        if now < self.open_until:
+            self.skipped += 1
+            return False
+        # Hold the others off while the trial request is running
+        self.open_until = now + PLUGIN_TIMEOUT
+        return True
+
+    def _timing(self, elapsed):
+        self.requests += 1
+        self.last_time = elapsed
+        if self.avg_time is None:
+            self.avg_time = elapsed
+        else:
+            self.avg_time = 0.8 * self.avg_time + 0.2 * elapsed
+
+    def success(self, elapsed):
+        self._timing(elapsed)
+        self.failures = 0
+        self.backoff = BACKOFF_MIN
+        self.open_until = None
+        self.last_success = time.time()
+
+    def failure(self, elapsed, error):
+        self._timing(elapsed)
+        self.errors += 1
+        self.failures += 1
+        self.last_error = str(error)
+        if self.failures >= FAILURE_THRESHOLD:
+            if self.open_until is not None:
+                self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+            self.open_until = time.time() + self.backoff
+            log.warn(
+                "Plugin %s failed %d times, not asking it again for %ds",
+                self.name, self.failures, self.backoff,
+            )
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'requests': self.requests,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'last_time': self.last_time,
+            'avg_time': self.avg_time,
+            'last_error': self.last_error,
+            'last_success': self.last_success,
+        }
+
+
+class PluginHealth(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._circuits = {}
+        self._payloads = {}
+
+    def circuit(self, plugin):
+        with self._lock:
+            circuit = self._circuits.get(plugin.id)
+            if circuit is None:
+                circuit = PluginCircuit(plugin.plugin_name)
+                self._circuits[plugin.id] = circuit
+            return circuit
+
+    def fetch(self, plugin, host, request, endpoint, keep=False,
+              timeout=PLUGIN_TIMEOUT, breaker=True):
+        """
+        Request /plugins/<name>/<id>/_s/<endpoint> of ``plugin``
+
+        Requests made with ``breaker`` unset are neither refused by an
+        open circuit nor counted in its failures.
+
+        Returns:
+            (url, data) - data is None if the plugin did not answer, or
+            the last successful answer if ``keep`` is set
+        """
+        if re.match('^.+\[.+\]', host, re.I):
+            import urllib2
+        else:
+            from eventlet.green import urllib2
+
+        url = "%s/plugins/%s/%d/_s/%s" % (
+            host,
+            plugin.plugin_name,
+            plugin.id,
+            endpoint,
+        )
+        key = (plugin.id, endpoint)
+        circuit = self.circuit(plugin)
+        if breaker:
+            with self._lock:
+                allowed = circuit.allow()
+            if not allowed:
+                log.debug("Circuit of %s is open, skipping %s", plugin, url)
+                return url, self._payloads.get(key) if keep else None
+
+        start = time.time()
+        try:
+            opener = urllib2.build_opener()
+            opener.addheaders = [(
+                'Cookie', 'sessionid=%s' % (
+                    request.COOKIES.get("sessionid", ''),
+                )
+            )]
+            data = opener.open(url, None, timeout).read()
+            if not data:
+                raise ValueError("empty response")
+        except Exception, e:
+            if breaker:
+                with self._lock:
+                    circuit.failure(time.time() - start, e)
+            log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
+                'url': url,
+                'error': e,
+            })
+            return url, self._payloads.get(key) if keep else None
+
+        with self._lock:
+            if breaker:
+                circuit.success(time.time() - start)
+            if keep:
+                self._payloads[key] = data
+        return url, data
+
+    def reset(self, plugin):
+        """
+        Forget the failures of ``plugin``, e.g. after it was (re)started
+        """
+        with self._lock:
+            self._circuits.pop(plugin.id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                (oid, circuit.summary())
+                for oid, circuit in self._circuits.items()
+            )
+
+
+plugin_health = PluginHealth()
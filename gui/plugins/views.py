@@ -29,10 +29,12 @@ from collections import namedtuple
 import json
 import logging
 import os
+import urllib
 import urllib2
 
 from django.shortcuts import render
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.http.request import RawPostDataException
 from django.utils.translation import ugettext as _
 
 import eventlet
@@ -62,6 +64,7 @@ from freenasUI.plugins.utils import (
     get_plugin_stop
 )
 from freenasUI.plugins.utils.fcgi_client import FCGIApp
+from freenasUI.plugins.utils.health import plugin_health
 
 import freenasUI.plugins.api_calls
 
@@ -123,6 +126,16 @@ def plugins(request):
     })
 
 
+def plugins_health(request):
+    """
+    Circuit state and response times of every plugin asked so far
+    """
+    return HttpResponse(
+        json.dumps(plugin_health.stats()),
+        content_type='application/json',
+    )
+
+
 def plugin_edit(request, plugin_id):
     plugin = models.Plugins.objects.filter(id=plugin_id)[0]
 
@@ -510,10 +523,34 @@ def plugin_fcgi_client(request, name, oid, path):
     env.pop('wsgi.multiprocess', None)
     env.pop('wsgi.run_once', None)
     env['SCRIPT_NAME'] = env['PATH_INFO']
-    args = request.POST if request.method == "POST" else request.GET
-    status, headers, body, raw = app(env, args=args)
 
-    resp = HttpResponse(body)
+    if not getattr(request, '_read_started', False):
+        # Upload the request body as it is read from the browser
+        length = int(env.get('CONTENT_LENGTH') or 0)
+        body = _read_request(request, length)
+    else:
+        # The body has already been consumed (e.g. request.POST read by
+        # the CSRF middleware)
+        try:
+            data = request.body
+        except RawPostDataException:
+            data = urllib.urlencode(request.POST)
+            env['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        env['CONTENT_LENGTH'] = str(len(data))
+        body = [data]
+
+    status, headers, content = app.stream(env, body=body)
+
+    resp = StreamingHttpResponse(content, status=int(status.split(' ', 1)[0]))
     for header, value in headers:
         resp[header] = value
     return resp
+
+
+def _read_request(request, length, chunk=65536):
+    while length > 0:
+        data = request.read(min(chunk, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
@@ -0,0 +1,269 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Cache of rendered RRD graphs
+
+A graph is identified by its plugin, identifier, unit and step plus the
+mtime of every RRD file it is drawn from, so a cached image is served
+until collectd flushes new data into one of those files. The digest of
+all that is the ETag of the image.
+
+Graphs requested in the last PRERENDER_IDLE seconds are rendered again
+in a background thread as soon as collectd flushes, in their hourly and
+daily views, so most page loads never wait for rrdtool.
+
+The web UI runs as a threaded FastCGI process (runfcgi method=threaded),
+so requests render concurrently with each other and with the refresher.
+The in-memory state is guarded by a lock and cached images are only
+ever replaced by a rename, never written in place.
+"""
+import glob
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from freenasUI.reporting import rrd
+
+log = logging.getLogger('reporting.cache')
+
+CACHE_DIR = '/var/tmp/rrdgraphs'
+
+# Views rendered ahead of time for recently viewed graphs
+PRERENDER_UNITS = ('hourly', 'daily')
+# Seconds a graph keeps being pre-rendered after it was last requested
+PRERENDER_IDLE = 600
+# Seconds between checks for new data in the RRD files
+POLL_INTERVAL = 10
+
+RE_DEF = re.compile(r'^DEF:[^=]+=(?P<path>.+?\.rrd):')
+
+
+class GraphCache(object):
+
+    def __init__(self, base_path, cachedir=CACHE_DIR):
+        self.base_path = base_path
+        self.cachedir = cachedir
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'not_modified': 0,
+            'prerendered': 0,
+            'errors': 0,
+        }
+        self._lock = threading.Lock()
+        self._requested = {}
+        self._refresher = None
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def not_modified(self, plugin):
+        """
+        The client already has the current graph of ``plugin``
+        """
+        self._watch(plugin)
+        self._count('not_modified')
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['watched'] = len(self._requested)
+        return stats
+
+    def _slug(self, plugin):
+        m = hashlib.sha1()
+        m.update(repr((
+            plugin.plugin, plugin.identifier, plugin.unit, plugin.step,
+        )))
+        return m.hexdigest()[:16]
+
+    def sources(self, plugin):
+        """
+        RRD files the graph of ``plugin`` is drawn from
+        """
+        paths = set()
+        for arg in plugin.graph():
+            reg = RE_DEF.search(arg)
+            if reg:
+                paths.add(reg.group("path"))
+        return sorted(paths)
+
+    def key(self, plugin):
+        """
+        Returns:
+            (etag, last_modified) of the graph of ``plugin``
+        """
+        m = hashlib.sha1(self._slug(plugin))
+        last_modified = 0
+        for path in self.sources(plugin):
+            try:
+                mtime = int(os.stat(path).st_mtime)
+            except OSError:
+                mtime = 0
+            m.update("%s:%d\n" % (path, mtime))
+            last_modified = max(last_modified, mtime)
+        return m.hexdigest(), last_modified
+
+    def _path(self, plugin, etag):
+        return os.path.join(
+            self.cachedir, "%s-%s.png" % (self._slug(plugin), etag)
+        )
+
+    def _render(self, plugin, etag):
+        fd, path = plugin.generate()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            try:
+                os.unlink(path)
+                os.close(fd)
+            except OSError, e:
+                log.warn("Failed to remove reporting temp file: %s", e)
+        if not data:
+            self._count('errors')
+            return data
+
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            tfd, tmp = tempfile.mkstemp(dir=self.cachedir)
+            with os.fdopen(tfd, 'wb') as f:
+                f.write(data)
+            cached = self._path(plugin, etag)
+            os.rename(tmp, cached)
+            # Older renders of the same graph
+            for old in glob.glob(os.path.join(
+                self.cachedir, "%s-*.png" % self._slug(plugin)
+            )):
+                if old == cached:
+                    continue
+                try:
+                    os.unlink(old)
+                except OSError:
+                    # Removed by another thread rendering the same graph
+                    pass
+        except (IOError, OSError), e:
+            log.warn("Failed to cache graph: %s", e)
+        return data
+
+    def get(self, plugin, etag=None, prerender=False):
+        """
+        Rendered graph of ``plugin``, from the cache if the RRD files
+        have not changed since it was rendered
+        """
+        if etag is None:
+            etag = self.key(plugin)[0]
+        if not prerender:
+            self._watch(plugin)
+        try:
+            with open(self._path(plugin, etag), 'rb') as f:
+                data = f.read()
+            if not prerender:
+                self._count('hits')
+            return data
+        except IOError:
+            pass
+        self._count('prerendered' if prerender else 'misses')
+        return self._render(plugin, etag)
+
+    def _watch(self, plugin):
+        if plugin.step != 0:
+            return
+        with self._lock:
+            self._requested[(plugin.plugin, plugin.identifier)] = time.time()
+            if self._refresher is None:
+                self._refresher = Refresher(self)
+                self._refresher.start()
+
+    def prerender(self):
+        """
+        Render the default views of the recently requested graphs
+        """
+        now = time.time()
+        with self._lock:
+            for key, last in self._requested.items():
+                if now - last > PRERENDER_IDLE:
+                    del self._requested[key]
+            requested = self._requested.keys()
+
+        for name, identifier in requested:
+            klass = rrd.name2plugin.get(name)
+            if klass is None:
+                continue
+            for unit in PRERENDER_UNITS:
+                plugin = klass(
+                    base_path=self.base_path,
+                    unit=unit,
+                    step=0,
+                    identifier=identifier,
+                )
+                try:
+                    self.get(plugin, prerender=True)
+                except Exception, e:
+                    self._count('errors')
+                    log.debug("Failed to pre-render %r: %s", plugin, e)
+
+    def newest(self):
+        """
+        Most recent mtime of the RRD files, changes on every collectd flush
+        """
+        newest = 0
+        for root, dirs, files in os.walk(self.base_path):
+            for name in files:
+                try:
+                    newest = max(
+                        newest, os.stat(os.path.join(root, name)).st_mtime
+                    )
+                except OSError:
+                    pass
+        return newest
+
+
+class Refresher(threading.Thread):
+
+    def __init__(self, cache, *args, **kwargs):
+        self.cache = cache
+        super(Refresher, self).__init__(*args, **kwargs)
+        self.daemon = True
+
+    def run(self):
+        last = self.cache.newest()
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                newest = self.cache.newest()
+                if newest != last:
+                    last = newest
+                    self.cache.prerender()
+            except Exception, e:
+                log.error("Failed to refresh graph cache: %s", e)
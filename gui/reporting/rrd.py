@@ -25,18 +25,36 @@
 #
 #####################################################################
 import glob
+import json
 import logging
 import os
 import re
 import tempfile
 import subprocess
 
+from xml.etree import cElementTree as ElementTree
+
 from freenasUI.common.pipesubr import pipeopen
 
 log = logging.getLogger('reporting.rrd')
 
 name2plugin = dict()
 
+RRD_BASE_PATH = "/var/db/collectd/rrd/localhost"
+
+RE_LINE = re.compile(
+    r'^LINE\d*(?:\.\d+)?:(?P<vname>[^#:]+)(?:#[0-9A-Fa-f]+)?'
+    r'(?::(?P<legend>(?:\\:|[^:])*))?'
+)
+# Layer of a stacked graph, the running total of its value (unknown
+# possibly being 0) and the layer below it
+RE_STACK = re.compile(
+    r'^CDEF:(?P<vname>[^=]+)=(?P<value>[^,]+)'
+    r'(?:,UN,0,(?P=value),IF)?(?:,[^,]+,\+)?$'
+)
+# Default row limit for rrdtool xport, which would otherwise use 400
+XPORT_MAXROWS = 1000000
+
 
 class RRDMeta(type):
 
@@ -98,6 +116,93 @@ class RRDBase(object):
     def get_identifiers(self):
         return None
 
+    def _timespan(self):
+        starttime = '1%s' % (self.unit[0], )
+        if self.step == 0:
+            endtime = 'now'
+        else:
+            endtime = 'now-%d%s' % (self.step, self.unit[0], )
+        return 'end-%s' % starttime, endtime
+
+    def series(self):
+        """
+        Values of the lines drawn by the graph, for stacked graphs
+        the value of each layer rather than the height of the stack
+
+        Returns:
+            list of (vname, legend)
+        """
+        series = []
+        stacks = {}
+        for arg in self.graph():
+            reg = RE_STACK.search(arg)
+            if reg:
+                stacks[reg.group("vname")] = reg.group("value")
+                continue
+            reg = RE_LINE.search(arg)
+            if not reg:
+                continue
+            legend = (reg.group("legend") or '').replace('\\:', ':')
+            legend = legend.strip().rstrip(':') or reg.group("vname")
+            vname = reg.group("vname")
+            series.append((stacks.get(vname, vname), legend))
+        return series
+
+    def xport(self, maxpoints=None, start=None, end=None):
+        """
+        Call rrdtool xport for the lines of the graph and parse its output
+        as it is produced
+
+        Returns:
+            generator of the meta data dict (start, end, step, legend)
+            followed by a (timestamp, [values]) tuple per row
+        """
+        starttime, endtime = self._timespan()
+        args = [
+            "/usr/local/bin/rrdtool",
+            "xport",
+            '--start', str(start) if start is not None else starttime,
+            '--end', str(end) if end is not None else endtime,
+            '--maxrows', str(maxpoints or XPORT_MAXROWS),
+        ]
+        args.extend([
+            arg for arg in self.graph()
+            if arg.split(':', 1)[0] in ('DEF', 'CDEF', 'VDEF')
+        ])
+        for vname, legend in self.series():
+            args.append('XPORT:%s:%s' % (vname, legend.replace(':', '\\:')))
+
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        try:
+            for event, elem in ElementTree.iterparse(proc.stdout):
+                if elem.tag == 'meta':
+                    yield {
+                        'start': int(elem.findtext('start')),
+                        'end': int(elem.findtext('end')),
+                        'step': int(elem.findtext('step')),
+                        'legend': [
+                            e.text or '' for e in elem.findall('legend/entry')
+                        ],
+                    }
+                elif elem.tag == 'row':
+                    values = []
+                    for v in elem.findall('v'):
+                        v = float(v.text)
+                        # NaN for unknown data
+                        values.append(None if v != v else v)
+                    yield int(elem.findtext('t')), values
+                    elem.clear()
+        except SyntaxError:
+            err = proc.stderr.read()
+            proc.wait()
+            raise ValueError(err.strip() or "Invalid rrdtool xport output")
+        finally:
+            if proc.poll() is None:
+                proc.stdout.close()
+                proc.wait()
+
     def generate(self):
         """
         Call rrdgraph to generate the graph on a temp file
@@ -106,12 +211,7 @@ class RRDBase(object):
             str - path to the image
         """
 
-        starttime = '1%s' % (self.unit[0], )
-        if self.step == 0:
-            endtime = 'now'
-        else:
-            endtime = 'now-%d%s' % (self.step, self.unit[0], )
-
+        starttime, endtime = self._timespan()
         fh, path = tempfile.mkstemp()
         args = [
             "/usr/local/bin/rrdtool",
@@ -122,7 +222,7 @@ class RRDBase(object):
             '--title', str(self.get_title()),
             '--lower-limit', '0',
             '--end', endtime,
-            '--start', 'end-%s' % starttime, '-b', '1024',
+            '--start', starttime, '-b', '1024',
         ]
         args.extend(self.graph())
         # rrdtool python is suffering from some sort of threading locking issue
@@ -768,3 +868,49 @@ class DiskPlugin(RRDBase):
         ]
 
         return args
+
+
+def xport_json(plugins, maxpoints=None, start=None, end=None):
+    """
+    Export the lines of several graphs as one JSON document, a chunk at a
+    time so large ranges are never held in memory:
+
+        {"metrics": [{"plugin": ..., "identifier": ..., "start": ...,
+          "end": ..., "step": ..., "columns": ["time", <legend>, ...],
+          "values": [[<time>, <value>, ...], ...]}, ...]}
+
+    A metric rrdtool fails for gets an "error" member instead.
+    """
+    yield '{"metrics": ['
+    for i, plugin in enumerate(plugins):
+        header = {
+            'plugin': plugin.plugin,
+            'identifier': plugin.identifier,
+        }
+        if i > 0:
+            yield ', '
+        rows = plugin.xport(maxpoints=maxpoints, start=start, end=end)
+        try:
+            meta = next(rows)
+        except (StopIteration, ValueError, OSError), e:
+            log.debug("Failed to export %r: %s", plugin, e)
+            header['error'] = str(e) or 'No data'
+            yield json.dumps(header)
+            continue
+        header.update({
+            'start': meta['start'],
+            'end': meta['end'],
+            'step': meta['step'],
+            'columns': ['time'] + meta['legend'],
+        })
+        # Drop the closing brace to append the values
+        yield json.dumps(header)[:-1] + ', "values": ['
+        sep = ''
+        try:
+            for t, values in rows:
+                yield sep + json.dumps([t] + values)
+                sep = ', '
+        except ValueError, e:
+            log.debug("Failed to export %r: %s", plugin, e)
+        yield ']}'
+    yield ']}'
@@ -39,4 +39,5 @@ urlpatterns = patterns('freenasUI.reporting.views',
     url(r'^partition/$', 'generic_graphs', {'names': ['df']}, name="reporting_partition"),
     url(r'^system/$', 'generic_graphs', {'names': ['processes', 'uptime']}, name="reporting_system"),
     url(r'^generate/$', 'generate', name="reporting_generate"),
+    url(r'^generate/stats/$', 'cache_stats', name="reporting_cache_stats"),
 )
@@ -24,24 +24,26 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+import json
 import logging
-import os
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import render
+from django.utils.http import http_date, parse_http_date_safe
 
 from freenasUI.reporting import rrd
-
-RRD_BASE_PATH = "/var/db/collectd/rrd/localhost"
+from freenasUI.reporting.cache import GraphCache
 
 log = logging.getLogger('reporting.views')
 
+graph_cache = GraphCache(rrd.RRD_BASE_PATH)
+
 
 def plugin2graphs(name):
 
     graphs = []
     if name in rrd.name2plugin:
-        ins = rrd.name2plugin[name](RRD_BASE_PATH)
+        ins = rrd.name2plugin[name](rrd.RRD_BASE_PATH)
         ids = ins.get_identifiers()
         if ids is not None:
             if len(ids) > 0:
@@ -86,23 +88,40 @@ def generate(request):
         identifier = request.GET.get("identifier")
 
         plugin = plugin(
-            base_path=RRD_BASE_PATH,
+            base_path=rrd.RRD_BASE_PATH,
             unit=unit,
             step=step,
             identifier=identifier
             )
-        fd, path = plugin.generate()
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        try:
-            os.unlink(path)
-            os.close(fd)
-        except OSError, e:
-            log.warn("Failed to remove reporting temp file: %s", e)
-
-        response = HttpResponse(data)
-        response['Content-type'] = 'image/png'
+        etag, last_modified = graph_cache.key(plugin)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+        )
+        if (
+            (if_none_match and if_none_match.strip('"') == etag) or
+            (
+                not if_none_match and if_modified_since and
+                if_modified_since >= last_modified
+            )
+        ):
+            graph_cache.not_modified(plugin)
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(graph_cache.get(plugin, etag=etag))
+            response['Content-type'] = 'image/png'
+        response['ETag'] = '"%s"' % etag
+        response['Last-Modified'] = http_date(last_modified)
+        # Browsers have to check back, the graph changes on every flush
+        response['Cache-Control'] = 'no-cache'
         return response
     except Exception, e:
         log.debug("Failed to generate rrd graph: %s", e)
+
+
+def cache_stats(request):
+    return HttpResponse(
+        json.dumps(graph_cache.get_stats()),
+        content_type='application/json',
+    )
@@ -43,6 +43,7 @@ from freenasUI.freeadmin.models import Model, UserField
 
 log = logging.getLogger('storage.models')
 REPL_RESULTFILE = '/tmp/.repl-result'
+REPL_STATSFILE = '/tmp/.repl-stats'
 
 
 class Volume(Model):
@@ -922,6 +923,22 @@ class Replication(Model):
         except:
             return None
 
+    @property
+    def repl_laststats(self):
+        """
+        Transfer statistics of the last (or running) send: snapshot,
+        bytes, elapsed seconds, rate in bytes/s, started and finished
+        """
+        if not os.path.exists(REPL_STATSFILE):
+            return None
+        with open(REPL_STATSFILE, 'rb') as f:
+            data = f.read()
+        try:
+            stats = cPickle.loads(data)
+            return stats[self.id]
+        except:
+            return None
+
     @property
     def status(self):
         progressfile = '/tmp/.repl_progress_%d' % self.id
@@ -52,6 +52,8 @@ urlpatterns = patterns('freenasUI.storage.views',
     url(r'^snapshot/rollback/(?P<dataset>[\-a-zA-Z0-9_/\.:]+)@(?P<snapname>[\-a-zA-Z0-9_\.:]+)/$', 'snapshot_rollback', name="storage_snapshot_rollback"),
     url(r'^snapshot/create/(?P<fs>[\-a-zA-Z0-9_/\.:]+)/$', 'manualsnap', name="storage_manualsnap"),
     url(r'^snapshot/clone/(?P<snapshot>[\-a-zA-Z0-9_/\.:]+@[\-a-zA-Z0-9_\.:]+)/$', 'clonesnap', name="storage_clonesnap"),
+    url(r'^mountpoint/permission/progress/$', 'mp_permission_progress', name="storage_mp_permission_progress"),
+    url(r'^mountpoint/permission/cancel/$', 'mp_permission_cancel', name="storage_mp_permission_cancel"),
     url(r'^mountpoint/permission/(?P<path>.+)/$', 'mp_permission', name="storage_mp_permission"),
     url(r'^volumemanager/$', 'volumemanager', name="storage_volumemanager"),
     url(r'^volomemanager/progress/$', 'volumemanager_progress', name="storage_volumemanager_progress"),
@@ -43,7 +43,7 @@ from freenasUI.common import humanize_size
 from freenasUI.common.system import is_mounted
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.freeadmin.views import JsonResp
-from freenasUI.middleware import zfs
+from freenasUI.middleware import permission, zfs
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.notifier import notifier
 from freenasUI.system.models import Advanced
@@ -539,9 +539,14 @@ def mp_permission(request, path):
         form = forms.MountPointAccessForm(request.POST)
         if form.is_valid():
             form.commit(path=path)
-            return JsonResp(
-                request,
-                message=_("Mount Point permissions successfully updated."))
+            if form.cleaned_data.get('mp_recursive'):
+                message = _(
+                    "Mount Point permissions are being updated in the "
+                    "background."
+                )
+            else:
+                message = _("Mount Point permissions successfully updated.")
+            return JsonResp(request, message=message)
     else:
         form = forms.MountPointAccessForm(initial={'path': path})
     return render(request, 'storage/permission.html', {
@@ -550,6 +555,22 @@ def mp_permission(request, path):
     })
 
 
+def mp_permission_progress(request):
+    data = permission.get_progress() or {'state': 'idle'}
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def mp_permission_cancel(request):
+    if request.method == 'POST' and permission.cancel():
+        return JsonResp(
+            request,
+            message=_("Changing permissions is being cancelled."))
+    return JsonResp(
+        request,
+        error=True,
+        message=_("Permissions are not being changed."))
+
+
 def dataset_delete(request, name):
 
     datasets = zfs.list_datasets(path=name, recursive=True)
@@ -867,7 +888,7 @@ def disk_wipe(request, devname):
         if form.is_valid():
             mounted = []
             for geom in notifier().disk_get_consumers(devname):
-                gname = geom.xpathEval("./name")[0].content
+                gname = geom.name
                 dev = "/dev/%s" % (gname, )
                 if dev not in mounted and is_mounted(device=dev):
                     mounted.append(dev)
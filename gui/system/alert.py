@@ -2,9 +2,14 @@ import cPickle
 import hashlib
 import imp
 import logging
+import multiprocessing
 import os
 import time
 
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common.system import send_mail
@@ -29,6 +34,13 @@ class BaseAlert(object):
     alert = None
     name = None
 
+    # Seconds the results of a run are reused before the module is run
+    # again, 0 runs it every time
+    interval = 0
+
+    # Seconds to wait for run() before reporting the module as hung
+    timeout = 30
+
     def __init__(self, alert):
         self.alert = alert
 
@@ -85,6 +97,7 @@ class AlertPlugins(object):
         )
         self.modspath = os.path.join(self.basepath, 'alertmods/')
         self.mods = []
+        self._running = {}
 
     def rescan(self):
         self.mods = []
@@ -117,6 +130,15 @@ class AlertPlugins(object):
         send_mail(subject=_("Critical Alerts"),
                   text='\n'.join(msgs))
 
+    def _run_module(self, instance, language):
+        translation.activate(language)
+        try:
+            start = time.time()
+            rv = instance.run()
+            return filter(None, rv or []), time.time() - start
+        finally:
+            connection.close()
+
     def run(self):
 
         obj = None
@@ -127,14 +149,94 @@ class AlertPlugins(object):
                 except:
                     pass
 
+        cached = (obj or {}).get('mods', {})
+        mods = {}
+        stats = {}
+
+        now = time.time()
+        due = []
+        for instance in self.mods:
+            name = instance.name
+            last = cached.get(name)
+            if last and now - last['last'] < instance.interval:
+                mods[name] = last
+                stats[name] = {
+                    'status': 'cached',
+                    'last': last['last'],
+                    'duration': last['duration'],
+                }
+            elif name in self._running:
+                # Timed out in an earlier run, pick up its result if it is
+                # done by now rather than piling up threads
+                due.append((instance, self._running[name]))
+            else:
+                due.append((instance, None))
+
+        new = [instance for instance, result in due if result is None]
+        if new:
+            # One worker per module so every module gets its whole timeout
+            language = translation.get_language()
+            pool = ThreadPool(len(new))
+            for instance in new:
+                self._running[instance.name] = pool.apply_async(
+                    self._run_module, (instance, language)
+                )
+            # Do not join, a hung module must not hold up the others
+            pool.close()
+
+        if due:
+            for instance, result in due:
+                name = instance.name
+                if result is None:
+                    result = self._running[name]
+                    remaining = max(now + instance.timeout - time.time(), 0)
+                else:
+                    remaining = 0
+                try:
+                    alerts, duration = result.get(remaining)
+                    status = 'ok'
+                except multiprocessing.TimeoutError:
+                    log.warn(
+                        "Alert module '%s' timed out after %d seconds",
+                        name,
+                        instance.timeout,
+                    )
+                    alerts = [Alert(
+                        Alert.WARN,
+                        _('The alert module %(name)s did not finish within '
+                          '%(timeout)d seconds') % {
+                            'name': name,
+                            'timeout': instance.timeout,
+                        },
+                        id='alert-timeout-%s' % name,
+                    )]
+                    duration = time.time() - now
+                    status = 'timeout'
+                except Exception, e:
+                    log.error("Alert module '%s' failed: %s", instance, e)
+                    alerts = []
+                    duration = time.time() - now
+                    status = 'error'
+
+                if status != 'timeout':
+                    self._running.pop(name, None)
+
+                mods[name] = {
+                    # Only cache successful runs
+                    'last': now if status == 'ok' else 0,
+                    'duration': duration,
+                    'alerts': alerts,
+                }
+                stats[name] = {
+                    'status': status,
+                    'last': now,
+                    'duration': duration,
+                }
+
         rvs = []
         for instance in self.mods:
-            try:
-                rv = instance.run()
-                if rv:
-                    rvs.extend(filter(None, rv))
-            except Exception, e:
-                log.error("Alert module '%s' failed: %s", instance, e)
+            if instance.name in mods:
+                rvs.extend(mods[instance.name]['alerts'])
 
         crits = sorted([a for a in rvs if a and a.getLevel() == Alert.CRIT])
         if obj and crits:
@@ -147,11 +249,15 @@ class AlertPlugins(object):
         if crits:
             self.email(crits)
 
-        with open(self.ALERT_FILE, 'w') as f:
+        tmp = '%s.%d' % (self.ALERT_FILE, os.getpid())
+        with open(tmp, 'w') as f:
             cPickle.dump({
                 'last': time.time(),
                 'alerts': rvs,
+                'mods': mods,
+                'stats': stats,
             }, f)
+        os.rename(tmp, self.ALERT_FILE)
         return rvs
 
 
@@ -6,6 +6,8 @@ from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
 
 class MultipathAlert(BaseAlert):
 
+    interval = 60
+
     def run(self):
         not_optimal = []
         for mp in notifier().multipath_all():
@@ -1,6 +1,9 @@
+import hashlib
+
 from django.db.models import Q
 from django.utils.translation import ugettext as _
 
+from freenasUI.common import humanize_size
 from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
 from freenasUI.storage.models import Replication
 
@@ -13,9 +16,20 @@ class ReplicationStatusAlert(BaseAlert):
         for repl in qs:
             if repl.repl_lastresult in ('Succeeded', ''):
                 continue
+            msg = _('Replication %s failed: %s') % (repl, repl.repl_lastresult)
+            # Keep the id of the alert stable as the statistics change
+            id = hashlib.md5(msg.encode('utf8')).hexdigest()
+            stats = repl.repl_laststats
+            if stats and stats['finished']:
+                msg += _(' (sent %(bytes)s in %(elapsed)ds, %(rate)s/s)') % {
+                    'bytes': humanize_size(stats['bytes']),
+                    'elapsed': stats['elapsed'],
+                    'rate': humanize_size(stats['rate']),
+                }
             alerts.append(Alert(
                 Alert.CRIT,
-                _('Replication %s failed: %s') % (repl, repl.repl_lastresult),
+                msg,
+                id=id,
             ))
         return alerts
 
@@ -7,6 +7,8 @@ from freenasUI.system.models import Advanced
 
 class Samba4Alert(BaseAlert):
 
+    interval = 300
+
     def run(self):
         if not Volume.objects.all().exists():
             return None
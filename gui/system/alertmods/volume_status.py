@@ -13,6 +13,8 @@ class VolumeStatusAlert(BaseAlert):
     __metaclass__ = HookMetaclass
     __hook_reverse_order__ = False
     name = 'VolumeStatus'
+    interval = 60
+    timeout = 60
 
     def on_volume_status_not_healthy(self, vol, status, message):
         if message:
@@ -0,0 +1,208 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Firmware update pipeline
+
+FirmwareUploadHandler runs as the firmware upload is read from the
+request. Each chunk is written to the upload file, fed to SHA256, and
+piped into ``tar -xSJpf -`` in the update directory, all in one pass.
+The image is not read back afterwards to be checksummed and then
+extracted.
+
+Nothing from the extracted tree is run until FirmwareWizard has checked
+the SHA256 against the one given in the form (see
+notifier.validate_update).
+
+Progress is kept in memory (updateProgress) down to the byte and served
+by the firmware progress view.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+log = logging.getLogger('system.firmware')
+
+# Steps shown by the firmware wizard progress bar
+STEP_UPLOAD = 1
+STEP_EXTRACT = 2
+STEP_INSTALL = 3
+
+
+class UpdateProgress(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.step = None
+            self.received = 0
+            self.total = None
+
+    def start(self, total):
+        with self._lock:
+            self.step = STEP_EXTRACT
+            self.received = 0
+            self.total = total
+
+    def add(self, size):
+        with self._lock:
+            self.received += size
+
+    def set_step(self, step):
+        with self._lock:
+            self.step = step
+
+    def get(self):
+        """
+        Progress as expected by the wizard progress bar, None if no
+        update is being staged
+        """
+        with self._lock:
+            if self.step is None:
+                return None
+            data = {
+                'step': self.step,
+                'received': self.received,
+            }
+            if self.step == STEP_EXTRACT and self.total:
+                data['total'] = self.total
+                data['percent'] = min(
+                    int(self.received * 100 / self.total), 99
+                )
+            else:
+                data['indeterminate'] = True
+            return data
+
+
+updateProgress = UpdateProgress()
+
+
+class FirmwareUploadHandler(TemporaryFileUploadHandler):
+    """
+    Stream the ``field`` upload into SHA256 and tar as it is received
+
+    After the upload:
+        sha256: hex digest of the whole upload
+        error: why the image could not be extracted, None if it was
+    """
+
+    def __init__(self, request=None, field='firmware', path=None):
+        super(FirmwareUploadHandler, self).__init__(request)
+        self.field = field
+        self.path = path
+        self.active = False
+        self.sha256 = None
+        self.error = None
+        self.request_length = None
+        self._hash = None
+        self._proc = None
+        self._stderr = None
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        self.request_length = content_length
+
+    def new_file(self, field_name, *args, **kwargs):
+        if field_name != self.field:
+            self.active = False
+            return
+        super(FirmwareUploadHandler, self).new_file(
+            field_name, *args, **kwargs
+        )
+        self.active = True
+        self._hash = hashlib.sha256()
+        self.sha256 = None
+        self.error = None
+        updateProgress.start(self.request_length)
+
+        # Leftovers of a previous update, dot directories belong to
+        # other users of the upload location
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if not name.startswith('.') and os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen([
+            "/usr/bin/tar",
+            "-xSJpf",  # -S for sparse
+            "-",
+        ], stdin=subprocess.PIPE, stderr=self._stderr, cwd=self.path,
+            close_fds=True)
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.file.write(raw_data)
+        self._hash.update(raw_data)
+        if self.error is None:
+            try:
+                self._proc.stdin.write(raw_data)
+            except IOError, e:
+                # tar gave up on the image, keep reading the upload
+                self.error = str(e)
+        updateProgress.add(len(raw_data))
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        self.sha256 = self._hash.hexdigest()
+        self._finish()
+        updateProgress.set_step(STEP_INSTALL)
+        return super(FirmwareUploadHandler, self).file_complete(file_size)
+
+    def upload_complete(self):
+        # The upload was cut short
+        if self._proc is not None:
+            self.error = self.error or 'Upload interrupted'
+            self._finish()
+
+    def _finish(self):
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+        self._stderr.seek(0)
+        err = self._stderr.read()
+        self._stderr.close()
+        if proc.returncode != 0:
+            self.error = err.strip() or self.error or (
+                'tar exited with %d' % proc.returncode
+            )
@@ -41,7 +41,9 @@ from django.core.files.storage import FileSystemStorage
 from django.forms import FileField
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
+from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
 from dojango import forms
 from freenasUI import choices
@@ -51,6 +53,7 @@ from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.notifier import notifier
 from freenasUI.storage.models import MountPoint, Volume
 from freenasUI.system import models
+from freenasUI.system.firmware import FirmwareUploadHandler, updateProgress
 
 log = logging.getLogger('system.forms')
 
@@ -147,17 +150,46 @@ class FirmwareWizard(FileWizard):
             'system/firmware_wizard_%s.html' % self.get_step_index(),
         ]
 
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        # The upload handler has to be in place before the CSRF check
+        # reads request.POST
+        self.upload = FirmwareUploadHandler(
+            request, path=self.file_storage.location
+        )
+        request.upload_handlers.insert(0, self.upload)
+        return self._dispatch(request, *args, **kwargs)
+
+    @method_decorator(csrf_protect)
+    def _dispatch(self, request, *args, **kwargs):
+        try:
+            return super(FirmwareWizard, self).dispatch(
+                request, *args, **kwargs
+            )
+        finally:
+            if request.method == 'POST':
+                updateProgress.reset()
+
     def done(self, form_list, **kwargs):
         cleaned_data = self.get_all_cleaned_data()
         firmware = cleaned_data.get('firmware')
         path = self.file_storage.path(firmware.file.name)
 
         # Verify integrity of uploaded image.
+        # The image has been hashed and extracted while it was uploaded.
         assert ('sha256' in cleaned_data)
-        checksum = notifier().checksum(path)
-        if checksum != str(cleaned_data['sha256']).strip():
+        checksum = self.upload.sha256
+        if checksum is None:
+            checksum = notifier().checksum(path)
+        if checksum != str(cleaned_data['sha256']).strip().lower():
             self.file_storage.delete(firmware.name)
             raise MiddlewareError("Invalid firmware, wrong checksum")
+        if self.upload.error:
+            self.file_storage.delete(firmware.name)
+            raise MiddlewareError(
+                'The firmware image is invalid, make sure to use .txz '
+                'file: %s' % self.upload.error
+            )
 
         # Validate that the image would pass all pre-install
         # requirements.
@@ -166,7 +198,9 @@ class FirmwareWizard(FileWizard):
         # from the upload, so the integrity has to be verified
         # before we proceed with this step.
         try:
-            retval = notifier().validate_update(path)
+            retval = notifier().validate_update(
+                path, extracted=self.upload.sha256 is not None
+            )
         except:
             self.file_storage.delete(firmware.name)
             raise
@@ -0,0 +1,270 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+System facts for the status pages, without forking
+
+Static facts (hw.model, hw.physmem, the build) are read once. The
+dynamic ones (date, uptime from kern.boottime, load) are read with
+direct sysctl calls and kept in a snapshot shared by every request for
+SNAPSHOT_TTL seconds, however many admins are polling.
+
+LogTail follows a log file by offset instead of running tail(1) on
+every poll, and top(1) output is shared the same way for TOP_TTL
+seconds.
+"""
+import collections
+import ctypes
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import sysctl
+
+log = logging.getLogger('system.sysinfo')
+
+VERSION_FILE = '/etc/version'
+SNAPSHOT_TTL = 5
+TOP_TTL = 2
+# Lines kept by LogTail, the log dialog asks for up to 500
+TAIL_LINES = 1000
+# Bytes read back from the end of a log to fill an empty LogTail
+TAIL_BYTES = 256 * 1024
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_usec', ctypes.c_long),
+    ]
+
+
+_libc = None
+
+
+def _sysctlbyname(name, ctype):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.7', use_errno=True)
+    value = ctype()
+    size = ctypes.c_size_t(ctypes.sizeof(value))
+    if _libc.sysctlbyname(
+        name, ctypes.byref(value), ctypes.byref(size), None, 0
+    ) != 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return value
+
+
+def _sysctl(name):
+    sysc = sysctl.filter(unicode(name))
+    if not sysc:
+        raise ValueError(name)
+    return sysc[0].value
+
+
+def _plural(count, word):
+    return "%d %s%s" % (count, word, '' if count == 1 else 's')
+
+
+def format_uptime(now, boottime):
+    """
+    Same as the first part of uptime(1), without the users
+    e.g. "10:15AM  up 3 days, 22:09"
+    """
+    up = int(now - boottime)
+    if up > 60:
+        up += 30
+    days, up = divmod(up, 86400)
+    hrs, up = divmod(up, 3600)
+    mins, secs = divmod(up, 60)
+
+    parts = []
+    if days > 0:
+        parts.append(_plural(days, 'day'))
+    if hrs > 0 and mins > 0:
+        parts.append("%2d:%02d" % (hrs, mins))
+    elif hrs > 0:
+        parts.append(_plural(hrs, 'hr'))
+    elif mins > 0:
+        parts.append(_plural(mins, 'min'))
+    elif days == 0:
+        parts.append(_plural(secs, 'sec'))
+
+    clock = time.strftime('%I:%M%p', time.localtime(now))
+    if clock.startswith('0'):
+        clock = ' ' + clock[1:]
+    return "%s  up %s\n" % (clock, ', '.join(parts))
+
+
+class SystemInfo(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._static = None
+        self._snapshot = None
+        self._taken = 0
+
+    def _load_static(self):
+        try:
+            platform = str(_sysctl('hw.model'))
+        except Exception, e:
+            log.debug("Failed to get hw.model: %s", e)
+            platform = ''
+        try:
+            physmem = str(int(_sysctl('hw.physmem')) / 1048576) + 'MB'
+        except Exception, e:
+            log.debug("Failed to get hw.physmem: %s", e)
+            physmem = ''
+
+        freenas_build = "Unrecognized build (%s        missing?)" % (
+            VERSION_FILE,
+        )
+        try:
+            with open(VERSION_FILE) as d:
+                freenas_build = d.read()
+        except:
+            pass
+
+        try:
+            boottime = _sysctlbyname('kern.boottime', timeval).tv_sec
+        except Exception, e:
+            log.debug("Failed to get kern.boottime: %s", e)
+            boottime = None
+
+        return {
+            'platform': platform,
+            'physmem': physmem,
+            'freenas_build': freenas_build,
+            'boottime': boottime,
+        }
+
+    def _take(self):
+        now = time.time()
+        info = dict(self._static)
+        boottime = info.pop('boottime')
+        info.update({
+            'hostname': os.uname()[1],
+            # All this for a timezone, because time.asctime() doesn't
+            # add it in.
+            'date': time.strftime('%a %b %d %H:%M:%S %Z %Y') + '\n',
+            'uptime': format_uptime(now, boottime) if boottime else '',
+            'loadavg': "%.2f, %.2f, %.2f" % os.getloadavg(),
+        })
+        return info
+
+    def get(self):
+        with self._lock:
+            if self._static is None:
+                self._static = self._load_static()
+            now = time.time()
+            if self._snapshot is None or now - self._taken > SNAPSHOT_TTL:
+                self._snapshot = self._take()
+                self._taken = now
+            return dict(self._snapshot)
+
+
+systemInfo = SystemInfo()
+
+
+class LogTail(object):
+    """
+    Last lines of a log file, reading only what was appended since the
+    previous call; a rotated or truncated file is read again from its
+    end
+    """
+
+    def __init__(self, path, maxlines=TAIL_LINES):
+        self.path = path
+        self._lock = threading.Lock()
+        self._lines = collections.deque(maxlen=maxlines)
+        self._partial = ''
+        self._inode = None
+        self._offset = 0
+
+    def _update(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            self._lines.clear()
+            self._inode = None
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._lines.clear()
+                self._partial = ''
+                self._inode = st.st_ino
+                self._offset = max(0, st.st_size - TAIL_BYTES)
+                if self._offset:
+                    # Skip to the first complete line
+                    f.seek(self._offset - 1)
+                    self._offset += len(f.readline()) - 1
+            if st.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read(st.st_size - self._offset)
+        self._offset += len(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+
+    def tail(self, lines):
+        with self._lock:
+            self._update()
+            if lines <= 0:
+                return ''
+            return '\n'.join(list(self._lines)[-lines:])
+
+
+class CommandSnapshot(object):
+    """
+    Output of a command shared by the requests made within ``ttl``
+    seconds of each other
+    """
+
+    def __init__(self, args, ttl):
+        self.args = args
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._output = None
+        self._taken = 0
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._output is None or now - self._taken > self.ttl:
+                proc = subprocess.Popen(
+                    self.args, stdout=subprocess.PIPE, close_fds=True
+                )
+                self._output = proc.communicate()[0]
+                self._taken = now
+            return self._output
+
+
+messagesTail = LogTail('/var/log/messages')
+topSnapshot = CommandSnapshot(['top'], TOP_TTL)
@@ -31,9 +31,8 @@ import os
 import re
 import shutil
 import signal
-import socket
 import string
-import subprocess
+import threading
 import time
 import urllib
 import xmlrpclib
@@ -51,53 +50,46 @@ from django.views.decorators.cache import never_cache
 from freenasUI.account.models import bsdUsers
 from freenasUI.common.system import get_sw_name, get_sw_version, send_mail
 from freenasUI.common.pipesubr import pipeopen
+from freenasUI.common.unixrpc import (
+    PersistentUnixTransport, UnixServerProxy
+)
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.freeadmin.views import JsonResp
 from freenasUI.middleware.notifier import notifier
 from freenasUI.network.models import GlobalConfiguration
 from freenasUI.storage.models import MountPoint
 from freenasUI.system import forms, models
+from freenasUI.system.firmware import STEP_INSTALL, updateProgress
+from freenasUI.system.sysinfo import messagesTail, systemInfo, topSnapshot
 
 GRAPHS_DIR = '/var/db/graphs'
 VERSION_FILE = '/etc/version'
 PGFILE = '/tmp/.extract_progress'
 DDFILE = '/tmp/.upgrade_dd'
 RE_DD = re.compile(r"^(\d+) bytes", re.M | re.S)
+WEBSHELL_SOCK = '/var/run/webshell.sock'
+# How long to wait for the echo of the keys just sent
+WEBSHELL_ECHO_WAIT = 0.05
 
 log = logging.getLogger('system.views')
 
+# One persistent connection to webshelld per thread
+_webshell = threading.local()
 
-def _system_info(request=None):
-    # OS, hostname, release
-    __, hostname, __ = os.uname()[0:3]
-    platform = subprocess.check_output(['sysctl', '-n', 'hw.model'])
-    physmem = str(int(int(
-        subprocess.check_output(['sysctl', '-n', 'hw.physmem'])
-    ) / 1048576)) + 'MB'
-    # All this for a timezone, because time.asctime() doesn't add it in.
-    date = time.strftime('%a %b %d %H:%M:%S %Z %Y') + '\n'
-    uptime = subprocess.check_output(
-        "env -u TZ uptime | awk -F', load averages:' '{ print $1 }'",
-        shell=True
-    )
-    loadavg = "%.2f, %.2f, %.2f" % os.getloadavg()
-
-    freenas_build = "Unrecognized build (%s        missing?)" % VERSION_FILE
-    try:
-        with open(VERSION_FILE) as d:
-            freenas_build = d.read()
-    except:
-        pass
 
-    return {
-        'hostname': hostname,
-        'platform': platform,
-        'physmem': physmem,
-        'date': date,
-        'uptime': uptime,
-        'loadavg': loadavg,
-        'freenas_build': freenas_build,
-    }
+def _webshell_proxy():
+    proxy = getattr(_webshell, 'proxy', None)
+    if proxy is None:
+        proxy = UnixServerProxy(
+            WEBSHELL_SOCK,
+            transport=PersistentUnixTransport(),
+        )
+        _webshell.proxy = proxy
+    return proxy
+
+
+def _system_info(request=None):
+    return systemInfo.get()
 
 
 def system_info(request):
@@ -226,18 +218,14 @@ def settings(request):
 def varlogmessages(request, lines):
     if lines is None:
         lines = 3
-    msg = os.popen('tail -n %s /var/log/messages' % int(lines)).read().strip()
+    msg = messagesTail.tail(int(lines)).strip()
     return render(request, 'system/status/msg.xml', {
         'msg': msg,
     }, content_type='text/xml')
 
 
 def top(request):
-    top_pipe = os.popen('top')
-    try:
-        top_output = top_pipe.read()
-    finally:
-        top_pipe.close()
+    top_output = topSnapshot.get()
     return render(request, 'system/status/top.xml', {
         'focused_tab': 'system',
         'top': top_output,
@@ -479,6 +467,12 @@ def file_browser(request, path='/'):
 
 def firmware_progress(request):
 
+    data = updateProgress.get()
+    if data is not None and not (
+        data['step'] == STEP_INSTALL and os.path.exists(DDFILE)
+    ):
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
     data = {}
     if os.path.exists(PGFILE):
         with open(PGFILE, 'r') as f:
@@ -554,119 +548,49 @@ def debug(request):
     return response
 
 
-class UnixTransport(xmlrpclib.Transport):
-    def make_connection(self, addr):
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(addr)
-        self.sock.settimeout(5)
-        return self.sock
-
-    def single_request(self, host, handler, request_body, verbose=0):
-        # issue XML-RPC request
-
-        self.make_connection(host)
-
-        try:
-            self.sock.send(request_body + "\n")
-            p, u = self.getparser()
-
-            while 1:
-                data = self.sock.recv(1024)
-                if not data:
-                    break
-                p.feed(data)
-
-            self.sock.close()
-            p.close()
-
-            return u.close()
-        except xmlrpclib.Fault:
-            raise
-        except Exception:
-            # All unexpected errors leave connection in
-            # a strange state, so we clear it.
-            self.close()
-            raise
-
-
-class MyServer(xmlrpclib.ServerProxy):
-
-    def __init__(self, addr):
-
-        self.__handler = "/"
-        self.__host = addr
-        self.__transport = UnixTransport()
-        self.__encoding = None
-        self.__verbose = 0
-        self.__allow_none = 0
-
-    def __request(self, methodname, params):
-        # call a method on the remote server
-
-        request = xmlrpclib.dumps(
-            params,
-            methodname,
-            encoding=self.__encoding,
-            allow_none=self.__allow_none,
-        )
-
-        response = self.__transport.request(
-            self.__host,
-            self.__handler,
-            request,
-            verbose=self.__verbose
-        )
-
-        if len(response) == 1:
-            response = response[0]
-
-        return response
-
-    def __getattr__(self, name):
-        # magic method dispatcher
-        return xmlrpclib._Method(self.__request, name)
-
-
 @never_cache
 def terminal(request):
 
-    sid = int(request.POST.get("s", 0))
-    jid = request.POST.get("jid", 0)
-    shell = request.POST.get("shell", "")
-    k = request.POST.get("k")
-    w = int(request.POST.get("w", 80))
-    h = int(request.POST.get("h", 24))
+    try:
+        sid = int(request.POST.get("s", 0))
+        jid = request.POST.get("jid", 0)
+        shell = request.POST.get("shell", "")
+        k = request.POST.get("k", "")
+        w = int(request.POST.get("w", 80))
+        h = int(request.POST.get("h", 24))
+        rev = int(request.POST.get("r", 0))
+    except ValueError, e:
+        response = HttpResponse('Invalid parameters: %s' % e)
+        response.status_code = 400
+        return response
+
+    keys = xmlrpclib.Binary(k.encode('utf-8'))
+    if k:
+        wait = WEBSHELL_ECHO_WAIT
+    else:
+        wait = 0
 
-    multiplex = MyServer("/var/run/webshell.sock")
-    alive = False
+    multiplex = _webshell_proxy()
+    dump = False
     for i in range(3):
         try:
-            alive = multiplex.proc_keepalive(sid, jid, shell, w, h)
+            dump = multiplex.proc_session(
+                sid, jid, shell, w, h, keys, rev, wait
+            )
             break
+        except xmlrpclib.Fault, e:
+            response = HttpResponse('Invalid parameters: %s' % e)
+            response.status_code = 400
+            return response
         except Exception, e:
             notifier().restart("webshell")
             time.sleep(0.5)
 
-    try:
-        if alive:
-            if k:
-                multiplex.proc_write(
-                    sid,
-                    xmlrpclib.Binary(bytearray(k.encode('utf-8')))
-                )
-            time.sleep(0.002)
-            content_data = '<?xml version="1.0" encoding="UTF-8"?>' + \
-                multiplex.proc_dump(sid)
-            response = HttpResponse(content_data, content_type='text/xml')
-            return response
-        else:
-            response = HttpResponse('Disconnected')
-            response.status_code = 400
-            return response
-    except (KeyError, ValueError, IndexError, xmlrpclib.Fault), e:
-        response = HttpResponse('Invalid parameters: %s' % e)
+    if not dump:
+        response = HttpResponse('Disconnected')
         response.status_code = 400
         return response
+    return HttpResponse(json.dumps(dump), content_type='application/json')
 
 
 def terminal_paste(request):
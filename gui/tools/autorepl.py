@@ -29,8 +29,11 @@ import cPickle
 import datetime
 import logging
 import os
+import shlex
 import subprocess
 import sys
+import threading
+import time
 
 sys.path.extend([
     '/usr/local/www',
@@ -40,15 +43,18 @@ sys.path.extend([
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
 
 # Make sure to load all modules
+from django.db import connection
 from django.db.models.loading import cache
 cache.get_apps()
 
 from freenasUI.freeadmin.apppool import appPool
-from freenasUI.storage.models import Replication, REPL_RESULTFILE
+from freenasUI.storage.models import (
+    Replication, REPL_RESULTFILE, REPL_STATSFILE
+)
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.pipesubr import pipeopen, system
 from freenasUI.common.locks import mntlock
-from freenasUI.common.system import send_mail
+from freenasUI.common.system import get_freenas_var, send_mail
 
 # DESIGN NOTES
 #
@@ -63,6 +69,15 @@ log = logging.getLogger('tools.autorepl')
 # Set to True if verbose log desired
 debug = False
 
+# Replication tasks running at the same time, in total and per remote host
+AUTOREPL_WORKERS = int(get_freenas_var("FREENAS_AUTOREPL_WORKERS", 4))
+AUTOREPL_WORKERS_PER_REMOTE = int(
+    get_freenas_var("FREENAS_AUTOREPL_WORKERS_PER_REMOTE", 2)
+)
+
+# Seconds between two writes of the transfer statistics
+STATS_INTERVAL = 5
+
 # Detect if another instance is running
 def exit_if_running(pid):
     log.debug("Checking if process %d is still alive" % (pid, ))
@@ -79,7 +94,6 @@ appPool.hook_tool_run('autorepl')
 MNTLOCK = mntlock()
 
 mypid = os.getpid()
-templog = '/tmp/repl-%d' % (mypid)
 
 now = datetime.datetime.now().replace(microsecond=0)
 if now.second < 30 or now.minute == 59:
@@ -114,8 +128,41 @@ MNTLOCK.unlock()
 
 # At this point, we are sure that only one autorepl instance is running.
 
+
+class ThreadedMountLock(object):
+    """
+    flock(2) does not exclude threads of the same process, serialize
+    them before taking the mount lock itself.
+    """
+
+    def __init__(self, mntlock):
+        self._mntlock = mntlock
+        self._lock = threading.Lock()
+
+    def lock(self):
+        self._lock.acquire()
+        try:
+            self._mntlock.lock()
+        except:
+            self._lock.release()
+            raise
+
+    def unlock(self):
+        try:
+            self._mntlock.unlock()
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, *args):
+        self.unlock()
+
+MNTLOCK = ThreadedMountLock(MNTLOCK)
+
 log.debug("Autosnap replication started")
-log.debug("temp log file: %s" % (templog, ))
 
 try:
     with open(REPL_RESULTFILE, 'rb') as f:
@@ -124,16 +171,134 @@ try:
 except:
     results = {}
 
-# Traverse all replication tasks
-replication_tasks = Replication.objects.all()
-for replication in replication_tasks:
-    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
-        continue
+try:
+    with open(REPL_STATSFILE, 'rb') as f:
+        data = f.read()
+    stats = cPickle.loads(data)
+except:
+    stats = {}
 
-    if not replication.repl_enabled:
-        log.warn("%s replication not enabled" % replication)
-        continue
+results_lock = threading.Lock()
+
+
+def _write_pickle(path, obj):
+    tmp = '%s.%d' % (path, mypid)
+    with open(tmp, 'w') as f:
+        f.write(cPickle.dumps(obj))
+    os.rename(tmp, path)
+
+
+def write_results():
+    with results_lock:
+        _write_pickle(REPL_RESULTFILE, results)
+        _write_pickle(REPL_STATSFILE, stats)
+
+
+def set_result(replication, msg):
+    with results_lock:
+        results[replication.id] = msg
+    write_results()
+
+
+class Progress(object):
+    """
+    Bytes sent by the running zfs send of a replication task, kept in
+    REPL_STATSFILE as the transfer goes
+    """
+
+    def __init__(self, replication, snapshot):
+        self.id = replication.id
+        self.started = time.time()
+        self.flushed = self.started
+        self.stats = {
+            'snapshot': snapshot,
+            'bytes': 0,
+            'elapsed': 0,
+            'rate': 0,
+            'started': self.started,
+            'finished': None,
+        }
+        with results_lock:
+            stats[self.id] = self.stats
+
+    def _refresh(self, now):
+        with results_lock:
+            self.stats['elapsed'] = now - self.started
+            if self.stats['elapsed'] > 0:
+                self.stats['rate'] = int(
+                    self.stats['bytes'] / self.stats['elapsed']
+                )
+
+    def update(self, nbytes):
+        self.stats['bytes'] += nbytes
+        now = time.time()
+        if now - self.flushed >= STATS_INTERVAL:
+            self._refresh(now)
+            self.flushed = now
+            write_results()
+
+    def done(self):
+        now = time.time()
+        self._refresh(now)
+        self.stats['finished'] = now
+        write_results()
+        log.debug("Sent %s: %d bytes in %.1fs (%d bytes/s)" % (
+            self.stats['snapshot'],
+            self.stats['bytes'],
+            self.stats['elapsed'],
+            self.stats['rate'],
+        ))
+
+
+ssh_masters = {}
+ssh_masters_lock = threading.Lock()
+
+
+def ssh_master(remote, sshcmd, remote_port, hostname):
+    """
+    Start (once) a ControlMaster connection to the remote and return
+    sshcmd set up to go through it.  ssh falls back to a connection of
+    its own if the master could not be started.
+    """
+    controlpath = '/var/run/autorepl-%d.ssh' % remote.id
+    sshcmd = '%s -o ControlPath=%s' % (sshcmd, controlpath)
+    with ssh_masters_lock:
+        if remote.id not in ssh_masters:
+            with open(os.devnull, 'r+') as devnull:
+                rv = subprocess.call(
+                    shlex.split(sshcmd) + [
+                        '-o', 'ControlMaster=yes',
+                        '-o', 'ControlPersist=yes',
+                        '-f', '-N',
+                        '-p', str(remote_port),
+                        hostname,
+                    ],
+                    stdin=devnull,
+                    stdout=devnull,
+                    stderr=devnull,
+                    close_fds=True,
+                )
+            if rv != 0:
+                log.debug("Could not start ssh master for %s" % (hostname, ))
+            ssh_masters[remote.id] = (sshcmd, remote_port, hostname)
+    return sshcmd
+
+
+def ssh_masters_close():
+    for sshcmd, remote_port, hostname in ssh_masters.values():
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.call(
+                shlex.split(sshcmd) + [
+                    '-O', 'exit', '-p', str(remote_port), hostname,
+                ],
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True,
+            )
 
+
+def replicate(replication):
     remote = replication.repl_remote.ssh_remote_hostname.__str__()
     remote_port = replication.repl_remote.ssh_remote_port
     dedicateduser = replication.repl_remote.ssh_remote_dedicateduser
@@ -163,10 +328,8 @@ for replication in replication_tasks:
             dedicateduser.encode('utf-8'),
             )
 
-    if replication.repl_userepl:
-        Rflag = '-R '
-    else:
-        Rflag = ''
+    # Share one connection per remote host between all its tasks
+    sshcmd = ssh_master(replication.repl_remote, sshcmd, remote_port, remote)
 
     wanted_list = []
     known_latest_snapshot = ''
@@ -176,69 +339,61 @@ for replication in replication_tasks:
 
     if len(localfs_split) > 1:
         remotefs_final = "%s/%s" % (remotefs, "/".join(localfs_split[1:]))
-        if len(localfs_split) > 2:
-            remotefs_parent = "%s/%s" % (remotefs, "/".join(localfs_split[1:-1]))
-        else:
-            remotefs_parent = "%s/%s" % (remotefs, localfs_split[1])
     else:
         remotefs_final = remotefs
-        remotefs_parent = remotefs
 
     # Test if there is work to do, if so, own them
-    MNTLOCK.lock()
-    log.debug("Checking dataset %s" % (localfs))
-    zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state -r -d 1 %s' % (localfs), debug)
-    output, error = zfsproc.communicate()
-    if zfsproc.returncode:
-        log.warn('Could not determine last available snapshot for dataset %s: %s' % (
-            localfs,
-            error,
-            ))
-        MNTLOCK.unlock()
-        continue
-    if output != '':
-        snapshots_list = output.split('\n')
-        snapshots_list.reverse()
-        found_latest = False
-        for snapshot_item in snapshots_list:
-            if snapshot_item != '':
-                snapshot, state = snapshot_item.split('\t')
-                if found_latest:
-                    # assert (known_latest_snapshot != '') because found_latest
-                    if state != '-':
-                        system('/sbin/zfs set freenas:state=NEW %s' % (known_latest_snapshot))
-                        system('/sbin/zfs set freenas:state=LATEST %s' % (snapshot))
-                        wanted_list.insert(0, known_latest_snapshot)
-                        log.debug("Snapshot %s added to wanted list (was LATEST)" % (snapshot))
-                        known_latest_snapshot = snapshot
-                        log.warn("Snapshot %s became latest snapshot" % (snapshot))
-                else:
-                    log.debug("Snapshot: %s State: %s" % (snapshot, state))
-                    if state == 'LATEST' and not resetonce:
-                        found_latest = True
-                        known_latest_snapshot = snapshot
-                        log.debug("Snapshot %s is the recorded latest snapshot" % (snapshot))
-                    elif state == 'NEW' or resetonce:
-                        wanted_list.insert(0, snapshot)
-                        log.debug("Snapshot %s added to wanted list" % (snapshot))
-                    elif state.startswith('INPROGRESS'):
-                        # For compatibility with older versions
-                        wanted_list.insert(0, snapshot)
-                        system('/sbin/zfs set freenas:state=NEW %s' % (snapshot))
-                        log.debug("Snapshot %s added to wanted list (stale)" % (snapshot))
-                    elif state == '-':
-                        # The snapshot is already replicated, or is not
-                        # an automated snapshot.
-                        log.debug("Snapshot %s unwanted" % (snapshot))
+    with MNTLOCK:
+        log.debug("Checking dataset %s" % (localfs))
+        zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state -r -d 1 %s' % (localfs), debug)
+        output, error = zfsproc.communicate()
+        if zfsproc.returncode:
+            log.warn('Could not determine last available snapshot for dataset %s: %s' % (
+                localfs,
+                error,
+                ))
+            return
+        if output != '':
+            snapshots_list = output.split('\n')
+            snapshots_list.reverse()
+            found_latest = False
+            for snapshot_item in snapshots_list:
+                if snapshot_item != '':
+                    snapshot, state = snapshot_item.split('\t')
+                    if found_latest:
+                        # assert (known_latest_snapshot != '') because found_latest
+                        if state != '-':
+                            system('/sbin/zfs set freenas:state=NEW %s' % (known_latest_snapshot))
+                            system('/sbin/zfs set freenas:state=LATEST %s' % (snapshot))
+                            wanted_list.insert(0, known_latest_snapshot)
+                            log.debug("Snapshot %s added to wanted list (was LATEST)" % (snapshot))
+                            known_latest_snapshot = snapshot
+                            log.warn("Snapshot %s became latest snapshot" % (snapshot))
                     else:
-                        # This should be exception but skip for now.
-                        MNTLOCK.unlock()
-                        continue
-    MNTLOCK.unlock()
+                        log.debug("Snapshot: %s State: %s" % (snapshot, state))
+                        if state == 'LATEST' and not resetonce:
+                            found_latest = True
+                            known_latest_snapshot = snapshot
+                            log.debug("Snapshot %s is the recorded latest snapshot" % (snapshot))
+                        elif state == 'NEW' or resetonce:
+                            wanted_list.insert(0, snapshot)
+                            log.debug("Snapshot %s added to wanted list" % (snapshot))
+                        elif state.startswith('INPROGRESS'):
+                            # For compatibility with older versions
+                            wanted_list.insert(0, snapshot)
+                            system('/sbin/zfs set freenas:state=NEW %s' % (snapshot))
+                            log.debug("Snapshot %s added to wanted list (stale)" % (snapshot))
+                        elif state == '-':
+                            # The snapshot is already replicated, or is not
+                            # an automated snapshot.
+                            log.debug("Snapshot %s unwanted" % (snapshot))
+                        else:
+                            # This should be exception but skip for now.
+                            continue
 
     # If there is nothing to do, go through next replication entry
     if len(wanted_list) == 0:
-        continue
+        return
 
     if known_latest_snapshot != '' and not resetonce:
         # Check if it matches remote snapshot
@@ -257,17 +412,17 @@ for replication in replication_tasks:
             else:
                 # Do we have it locally? if yes then mark it immediately
                 log.info("Can not locate expected snapshot %s, looking more carefully" % (expected_local_snapshot))
-                MNTLOCK.lock()
-                zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state %s' % (expected_local_snapshot), debug)
-                output = zfsproc.communicate()[0]
-                if output != '':
-                    last_snapshot, state = output.split('\n')[0].split('\t')
-                    log.info("Marking %s as latest snapshot" % (last_snapshot))
-                    if state == '-':
-                        system('/sbin/zfs inherit freenas:state %s' % (known_latest_snapshot))
-                        system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
-                        known_latest_snapshot = last_snapshot
-                else:
+                with MNTLOCK:
+                    zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state %s' % (expected_local_snapshot), debug)
+                    output = zfsproc.communicate()[0]
+                    if output != '':
+                        last_snapshot, state = output.split('\n')[0].split('\t')
+                        log.info("Marking %s as latest snapshot" % (last_snapshot))
+                        if state == '-':
+                            system('/sbin/zfs inherit freenas:state %s' % (known_latest_snapshot))
+                            system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
+                            known_latest_snapshot = last_snapshot
+                if output == '':
                     log.warn("Can not locate a proper local snapshot for %s" % (localfs))
                     # Can NOT proceed any further.  Report this situation.
                     error, errmsg = send_mail(subject="Replication failed!", text=\
@@ -276,10 +431,8 @@ Hello,
     The replication failed for the local ZFS %s because the remote system
     have diverged snapshot with us.
                         """ % (localfs), interval=datetime.timedelta(hours=2), channel='autorepl')
-                    MNTLOCK.unlock()
-                    results[replication.id] = 'Remote system have diverged snapshot with us'
-                    continue
-                MNTLOCK.unlock()
+                    set_result(replication, 'Remote system have diverged snapshot with us')
+                    return
         else:
             log.log(logging.NOTICE, "Can not locate %s on remote system, starting from there" % (known_latest_snapshot))
             # Reset the "latest" snapshot to a new one.
@@ -295,6 +448,7 @@ Hello,
 
     last_snapshot = known_latest_snapshot
 
+    templog = '/tmp/repl-%d-%d' % (mypid, replication.id)
     for snapname in wanted_list:
         local_fs, local_snap = snapname.split('@')
         if replication.repl_limit != 0:
@@ -310,6 +464,7 @@ Hello,
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
+                close_fds=True,
             )
             replcmd = '%s%s -p %d %s "/sbin/zfs receive -F -d %s && echo Succeeded"' % (limit, sshcmd, remote_port, remote, remotefs)
         else:
@@ -333,20 +488,26 @@ Hello,
             progressfile = '/tmp/.repl_progress_%d' % replication.id
             with open(progressfile, 'w') as f2:
                 f2.write(str(zfssend.pid))
+            progress = Progress(replication, snapname)
             # subprocess.Popen does not handle large stream of data between
             # processes very well, do it on our own
-            while zfssend.poll() is None:
+            while True:
                 read = zfssend.stdout.read(1048576)
+                if not read:
+                    break
                 proc.stdin.write(read)
+                progress.update(len(read))
             zfssend.stdout.close()
+            zfssend.wait()
             proc.stdin.close()
             proc.wait()
+            progress.done()
             os.remove(progressfile)
             f.seek(0)
             msg = f.read().strip('\n').strip('\r')
         os.remove(templog)
         log.debug("Replication result: %s" % (msg))
-        results[replication.id] = msg
+        set_result(replication, msg)
 
         # Determine if the remote side have the snapshot we have now.
         rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
@@ -357,12 +518,11 @@ Hello,
             if local_snap == remote_snap:
                 system('%s -p %d %s "/sbin/zfs inherit freenas:state %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
                 # Replication was successful, mark as such
-                MNTLOCK.lock()
-                if last_snapshot != '':
-                    system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
-                last_snapshot = snapname
-                system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
-                MNTLOCK.unlock()
+                with MNTLOCK:
+                    if last_snapshot != '':
+                        system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
+                    last_snapshot = snapname
+                    system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
                 replication.repl_lastsnapshot = last_snapshot
                 if resetonce:
                     replication.repl_resetonce = False
@@ -379,9 +539,8 @@ Hello,
                         log.warn("Snapshot %s already exist on remote, marking as such" % (snapname))
                         system('%s -p %d %s "/sbin/zfs inherit -r freenas:state %s"' % (sshcmd, remote_port, remote, remotefs_final))
                         # Replication was successful, mark as such
-                        MNTLOCK.lock()
-                        system('/sbin/zfs inherit freenas:state %s' % (snapname))
-                        MNTLOCK.unlock()
+                        with MNTLOCK:
+                            system('/sbin/zfs inherit freenas:state %s' % (snapname))
                         continue
 
         # Something wrong, report.
@@ -395,7 +554,76 @@ Hello,
             """ % (localfs, remote, msg), interval=datetime.timedelta(hours=2), channel='autorepl')
         break
 
-with open(REPL_RESULTFILE, 'w') as f:
-    f.write(cPickle.dumps(results))
+
+class Scheduler(object):
+    """
+    Run replication tasks in parallel, AUTOREPL_WORKERS at most and no
+    more than AUTOREPL_WORKERS_PER_REMOTE against the same remote host.
+    Tasks of the same local dataset share snapshot state and always run
+    one after the other.
+    """
+
+    def __init__(self):
+        self.workers = threading.BoundedSemaphore(AUTOREPL_WORKERS)
+        self.remotes = {}
+        self.datasets = {}
+
+    def _run(self, replication, remote, dataset):
+        # Always in this order, a task waiting for its dataset or remote
+        # does not hold one of the global slots
+        with dataset:
+            with remote:
+                with self.workers:
+                    try:
+                        replicate(replication)
+                    except Exception, e:
+                        log.error("Replication %s failed: %s" % (
+                            replication, e,
+                        ))
+                        set_result(replication, 'Failed: %s' % (e, ))
+                    finally:
+                        connection.close()
+
+    def run(self, tasks):
+        threads = []
+        for replication in tasks:
+            hostname = replication.repl_remote.ssh_remote_hostname.lower()
+            if hostname not in self.remotes:
+                self.remotes[hostname] = threading.BoundedSemaphore(
+                    AUTOREPL_WORKERS_PER_REMOTE
+                )
+            if replication.repl_filesystem not in self.datasets:
+                self.datasets[replication.repl_filesystem] = threading.Lock()
+
+            thread = threading.Thread(target=self._run, args=(
+                replication,
+                self.remotes[hostname],
+                self.datasets[replication.repl_filesystem],
+            ))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+
+# Traverse all replication tasks
+replication_tasks = []
+for replication in Replication.objects.all():
+    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
+        continue
+
+    if not replication.repl_enabled:
+        log.warn("%s replication not enabled" % replication)
+        continue
+
+    replication_tasks.append(replication)
+
+try:
+    Scheduler().run(replication_tasks)
+finally:
+    ssh_masters_close()
+
+write_results()
 os.remove('/var/run/autorepl.pid')
 log.debug("Autosnap replication finished")
@@ -27,6 +27,7 @@
 
 import logging
 import os
+import pipes
 import re
 import sys
 sys.path.append('/usr/local/www')
@@ -39,8 +40,10 @@ from django.db.models.loading import cache
 cache.get_apps()
 
 from freenasUI.freeadmin.apppool import appPool
+from freenasUI.middleware import zfsstate
 from freenasUI.storage.models import Task, Replication
 from datetime import datetime, time, timedelta
+from time import time as walltime
 
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.timesubr import isTimeBetween
@@ -61,6 +64,12 @@ MNTLOCK=mntlock()
 # Set to True if verbose log desired
 debug = False
 
+# With -n only print what would be created and destroyed
+dryrun = '-n' in sys.argv[1:]
+
+# Snapshots of one dataset destroyed by a single zfs destroy
+DESTROY_BATCH = 64
+
 def snapinfodict2datetime(snapinfo):
     year = int(snapinfo['year'])
     month = int(snapinfo['month'])
@@ -87,6 +96,70 @@ def snap_expired(snapinfo, snaptime):
 
     return snapinfo_expirationtime <= snaptime
 
+def destroy_batches(snapshots):
+    """
+    Group snapshot names into 'pool/ds@a,b,c' arguments for zfs destroy,
+    DESTROY_BATCH snapshots of the same dataset at most
+
+    zfs destroy -r also takes the snapshots of the same name of the
+    children, those are left out so their batches do not fail.
+    """
+    pending = set(snapshots)
+    byfs = {}
+    for snapshot in snapshots:
+        fs, snapname = snapshot.split('@')
+        parts = fs.split('/')
+        if any(
+            '%s@%s' % ('/'.join(parts[:i]), snapname) in pending
+            for i in range(1, len(parts))
+        ):
+            continue
+        byfs.setdefault(fs, []).append(snapname)
+
+    batches = []
+    for fs in sorted(byfs.keys()):
+        snapnames = byfs[fs]
+        for i in range(0, len(snapnames), DESTROY_BATCH):
+            batches.append('%s@%s' % (
+                fs, ','.join(snapnames[i:i + DESTROY_BATCH])
+            ))
+    return batches
+
+def snapshot_states(snapshots):
+    """
+    freenas:state of the given snapshots, one zfs get per DESTROY_BATCH
+    """
+    states = {}
+    snapshots = list(snapshots)
+    for i in range(0, len(snapshots), DESTROY_BATCH):
+        zfsproc = pipeopen('/sbin/zfs get -H -o name,value freenas:state %s' % (
+            ' '.join([pipes.quote(s) for s in snapshots[i:i + DESTROY_BATCH]]),
+        ), logger=log)
+        output = zfsproc.communicate()[0]
+        for line in output.split('\n'):
+            if line:
+                name, value = line.split('\t')
+                states[name] = value
+    return states
+
+def destroy_snapshots(batch):
+    # snapshots with clones will have destruction deferred
+    snapcmd = '/sbin/zfs destroy -r -d %s' % (pipes.quote(batch), )
+    proc = pipeopen(snapcmd, logger=log)
+    err = proc.communicate()[1]
+    if proc.returncode == 0:
+        return
+
+    fs, snapnames = batch.split('@')
+    snapnames = snapnames.split(',')
+    if len(snapnames) == 1:
+        log.error("Failed to destroy snapshot '%s': %s", batch, err)
+        return
+
+    # Do not let one bad snapshot keep the rest of the batch around
+    for snapname in snapnames:
+        destroy_snapshots('%s@%s' % (fs, snapname))
+
 def isMatchingTime(task, snaptime):
     curtime = time(snaptime.hour, snaptime.minute)
     repeat_type = task.task_repeat_unit
@@ -119,29 +192,30 @@ appPool.hook_tool_run('autosnap')
 
 mypid = os.getpid()
 
-# (mis)use MNTLOCK as PIDFILE lock.
-locked = True
-try:
-    MNTLOCK.lock_try()
-except IOError:
-    locked = False
-if not locked:
-    sys.exit(0)
+if not dryrun:
+    # (mis)use MNTLOCK as PIDFILE lock.
+    locked = True
+    try:
+        MNTLOCK.lock_try()
+    except IOError:
+        locked = False
+    if not locked:
+        sys.exit(0)
 
-AUTOSNAP_PID = -1
-try:
-    with open('/var/run/autosnap.pid') as pidfile:
-        AUTOSNAP_PID = int(pidfile.read())
-except:
-    pass
+    AUTOSNAP_PID = -1
+    try:
+        with open('/var/run/autosnap.pid') as pidfile:
+            AUTOSNAP_PID = int(pidfile.read())
+    except:
+        pass
 
-if AUTOSNAP_PID != -1:
-    exit_if_running(AUTOSNAP_PID)
+    if AUTOSNAP_PID != -1:
+        exit_if_running(AUTOSNAP_PID)
 
-with open('/var/run/autosnap.pid', 'w') as pidfile:
-    pidfile.write('%d' % mypid)
+    with open('/var/run/autosnap.pid', 'w') as pidfile:
+        pidfile.write('%d' % mypid)
 
-MNTLOCK.unlock()
+    MNTLOCK.unlock()
 
 now = datetime.now().replace(microsecond=0)
 if now.second < 30 or now.minute == 59:
@@ -170,30 +244,37 @@ for task in TaskObjects:
 # Only proceed further if we are  going to generate any snapshots for this run
 if len(mp_to_task_map) > 0:
 
-    # Grab all existing snapshot and filter out the expiring ones
+    timings = []
+    started = walltime()
+
+    # Grab all existing snapshot and filter out the expiring ones, the
+    # replication state comes in the same listing so expiry does not
+    # need one zfs get per snapshot.
     snapshots = {}
-    snapshots_pending_delete = set()
-    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H", debug, logger=log)
-    lines = zfsproc.communicate()[0].split('\n')
+    snapshots_pending_delete = []
+    rows = zfsstate.zfs_list_snapshots()
+    timings.append(('list', walltime() - started))
+
     reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)(?P<retunit>[hdwmy])$')
-    for line in lines:
-        if line != '':
-            snapshot_name = line.split('\t')[0]
-            fs, snapname = snapshot_name.split('@')
-            snapname_match = reg_autosnap.match(snapname)
-            if snapname_match != None:
-                snap_infodict = snapname_match.groupdict()
-                snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
-                if snap_expired(snap_infodict, snaptime):
-                    snapshots_pending_delete.add(snapshot_name)
-                else:
-                    if mp_to_task_map.has_key((fs, snap_ret_policy)):
-                        if snapshots.has_key((fs, snap_ret_policy)):
-                            last_snapinfo = snapshots[(fs, snap_ret_policy)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy)] = snap_infodict
-                        else:
+    # Rows come sorted by creation, so are the destroy batches
+    for snapshot_name, used, refer, creation, state in rows:
+        fs, snapname = snapshot_name.split('@')
+        snapname_match = reg_autosnap.match(snapname)
+        if snapname_match != None:
+            snap_infodict = snapname_match.groupdict()
+            snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
+            if snap_expired(snap_infodict, snaptime):
+                # Snapshots still to be replicated are kept
+                if state == '-':
+                    snapshots_pending_delete.append(snapshot_name)
+            else:
+                if mp_to_task_map.has_key((fs, snap_ret_policy)):
+                    if snapshots.has_key((fs, snap_ret_policy)):
+                        last_snapinfo = snapshots[(fs, snap_ret_policy)]
+                        if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
                             snapshots[(fs, snap_ret_policy)] = snap_infodict
+                    else:
+                        snapshots[(fs, snap_ret_policy)] = snap_infodict
 
     list_mp = mp_to_task_map.keys()
 
@@ -210,21 +291,50 @@ if len(mp_to_task_map) > 0:
 
     snaptime_str = snaptime.strftime('%Y%m%d.%H%M')
 
+    # The whole plan is known before anything is touched
+    snapshots_pending_create = []
     for mpkey, tasklist in mp_to_task_map.items():
         fs, expire = mpkey
         recursive = False
         for task in tasklist:
             if task.task_recursive == True:
                 recursive = True
+
+        snapname = '%s@auto-%s-%s' % (fs, snaptime_str, expire)
+
+        # If there is associated replication task, mark the snapshots as 'NEW'.
+        replicated = Replication.objects.filter(repl_filesystem=fs, repl_enabled=True).count() > 0
+
+        snapshots_pending_create.append((snapname, recursive, replicated))
+
+    destroy_plan = destroy_batches(snapshots_pending_delete)
+    timings.append(('plan', walltime() - started))
+
+    if dryrun:
+        for snapname, recursive, replicated in snapshots_pending_create:
+            print "create  %s%s%s" % (
+                snapname,
+                ' (recursive)' if recursive else '',
+                ' (NEW)' if replicated else '',
+            )
+        for batch in destroy_plan:
+            print "destroy %s" % (batch, )
+        print "%d to create, %d to destroy in %d batches" % (
+            len(snapshots_pending_create),
+            len(snapshots_pending_delete),
+            len(destroy_plan),
+        )
+        for phase, elapsed in timings:
+            print "%-7s %.3fs" % (phase, elapsed)
+        sys.exit(0)
+
+    for snapname, recursive, replicated in snapshots_pending_create:
         if recursive == True:
             rflag = ' -r'
         else:
             rflag = ''
 
-        snapname = '%s@auto-%s-%s' % (fs, snaptime_str, expire)
-
-        # If there is associated replication task, mark the snapshots as 'NEW'.
-        if Replication.objects.filter(repl_filesystem=fs, repl_enabled=True).count() > 0:
+        if replicated:
             MNTLOCK.lock()
             snapcmd = '/sbin/zfs snapshot%s -o freenas:state=NEW %s' % (rflag, snapname)
             proc = pipeopen(snapcmd, logger=log)
@@ -238,24 +348,37 @@ if len(mp_to_task_map) > 0:
             err = proc.communicate()[1]
             if proc.returncode != 0:
                 log.error("Failed to create snapshot '%s': %s", snapname, err)
-
-    MNTLOCK.lock()
-    for snapshot in snapshots_pending_delete:
-        zfsproc = pipeopen('/sbin/zfs get -H freenas:state %s' % (snapshot, ), logger=log)
-        output = zfsproc.communicate()[0]
-        if output != '':
-            fsname, attrname, value, source = output.split('\n')[0].split('\t')
-            if value == '-':
-                snapcmd = '/sbin/zfs destroy -r -d %s' % (snapshot) #snapshots with clones will have destruction deferred
-                proc = pipeopen(snapcmd, logger=log)
-                err = proc.communicate()[1]
-                if proc.returncode != 0:
-                    log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
-    MNTLOCK.unlock()
-
-
-os.unlink('/var/run/autosnap.pid')
-
-os.execl('/usr/local/bin/python',
-         'python',
-         '/usr/local/www/freenasUI/tools/autorepl.py')
+        zfsstate.invalidate(snapname.split('@')[0], recursive)
+    timings.append(('create', walltime() - started))
+
+    if snapshots_pending_delete:
+        MNTLOCK.lock()
+        # Replication may have claimed some since the listing
+        states = snapshot_states(snapshots_pending_delete)
+        snapshots_pending_delete = [
+            snapshot for snapshot in snapshots_pending_delete
+            if states.get(snapshot) == '-'
+        ]
+        destroy_plan = destroy_batches(snapshots_pending_delete)
+        for batch in destroy_plan:
+            destroy_snapshots(batch)
+        MNTLOCK.unlock()
+
+        for fs in set([batch.split('@')[0] for batch in destroy_plan]):
+            zfsstate.invalidate(fs, True)
+    timings.append(('destroy', walltime() - started))
+
+    log.debug("autosnap: %d created, %d destroyed in %d batches, %s",
+        len(snapshots_pending_create),
+        len(snapshots_pending_delete),
+        len(destroy_plan),
+        ', '.join(['%s %.3fs' % t for t in timings]),
+    )
+
+
+if not dryrun:
+    os.unlink('/var/run/autosnap.pid')
+
+    os.execl('/usr/local/bin/python',
+             'python',
+             '/usr/local/www/freenasUI/tools/autorepl.py')
@@ -527,6 +527,39 @@ def cache_count(**kwargs):
         _cache_count_default(**kwargs)
 
 
+def _cache_sync_print(kind, counts):
+    print "%s: %ld added, %ld changed, %ld deleted" % (
+        kind, counts['added'], counts['changed'], counts['deleted'])
+
+def _cache_sync_ActiveDirectory(full=False, **kwargs):
+    ad = FreeNAS_ActiveDirectory_Sync(flags=FLAGS_DBINIT)
+    results = ad.sync(full=full)
+    for workgroup in sorted(results.keys()):
+        print "w: %s" % workgroup
+        _cache_sync_print("u", results[workgroup]['users'])
+        _cache_sync_print("g", results[workgroup]['groups'])
+        print "\n"
+
+def _cache_sync_LDAP(full=False, **kwargs):
+    results = FreeNAS_LDAP_Sync(flags=FLAGS_DBINIT).sync(full=full)
+    _cache_sync_print("u", results['users'])
+    _cache_sync_print("g", results['groups'])
+    print "\n"
+
+def cache_sync(**kwargs):
+    """Incrementally update the directory caches, -f forces a full pass"""
+    full = '-f' in kwargs.get('args', [])
+
+    if activedirectory_enabled():
+        _cache_sync_ActiveDirectory(full=full, **kwargs)
+
+    elif ldap_enabled():
+        _cache_sync_LDAP(full=full, **kwargs)
+
+    else:
+        print >> sys.stderr, "sync: only LDAP and Active Directory are supported"
+
+
 def main():
     cache_funcs = {}
     cache_funcs['fill'] = cache_fill
@@ -536,6 +569,7 @@ def main():
     cache_funcs['rawdump'] = cache_rawdump
     cache_funcs['check'] = cache_check
     cache_funcs['count'] = cache_count
+    cache_funcs['sync'] = cache_sync
 
     if len(sys.argv) < 2:
         usage(cache_funcs.keys())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Change owner and mode of a tree in the background
+
+    permission.py [-f] [-a] [-w workers] [-m mode] [-x exclude ...] uid gid path
+
+uid or gid -1 leaves it alone, without -m the mode is left alone.
+-a resets the Windows ACL of every file and directory.
+Progress is written to middleware.permission.PROGRESSFILE and SIGTERM
+stops the walk.
+"""
+import fcntl
+import getopt
+import logging
+import logging.config
+import os
+import signal
+import sys
+
+import daemon
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+from freenasUI.settings import LOGGING
+from freenasUI.middleware.permission import PIDFILE, WORKERS, PermissionJob
+
+log = logging.getLogger('tools.permission')
+logging.config.dictConfig(LOGGING)
+
+
+def set_proc_name(newname):
+    from ctypes import cdll, byref, create_string_buffer
+    libc = cdll.LoadLibrary('libc.so.7')
+    buff = create_string_buffer(len(newname) + 1)
+    buff.value = newname
+    libc.setproctitle(byref(buff))
+
+
+class PidFile(object):
+    """
+    Context manager that locks a pid file (see tools/webshell.py)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pidfile = None
+
+    def __enter__(self):
+        self.pidfile = open(self.path, "a+")
+        try:
+            fcntl.flock(self.pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise SystemExit("Already running according to " + self.path)
+        self.pidfile.seek(0)
+        self.pidfile.truncate()
+        self.pidfile.write(str(os.getpid()))
+        self.pidfile.flush()
+        self.pidfile.seek(0)
+        return self.pidfile
+
+    def __exit__(self, *args, **kwargs):
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.pidfile.close()
+        except IOError:
+            pass
+
+
+def usage():
+    print >> sys.stderr, (
+        "Usage: %s [-f] [-a] [-w workers] [-m mode] [-x exclude ...] "
+        "uid gid path" % (
+            os.path.basename(sys.argv[0]),
+        )
+    )
+    sys.exit(1)
+
+
+def main(argv):
+    foreground = False
+    workers = WORKERS
+    mode = None
+    winacl = False
+    exclude = []
+
+    try:
+        opts, args = getopt.getopt(argv, "faw:m:x:")
+        for opt, arg in opts:
+            if opt == '-f':
+                foreground = True
+            elif opt == '-a':
+                winacl = True
+            elif opt == '-w':
+                workers = int(arg)
+            elif opt == '-m':
+                mode = int(arg, 8)
+            elif opt == '-x':
+                exclude.append(arg)
+        uid, gid, path = int(args[0]), int(args[1]), args[2]
+    except (getopt.GetoptError, ValueError, IndexError):
+        usage()
+
+    if foreground:
+        job = PermissionJob(
+            path, uid, gid, mode, exclude, workers=workers, winacl=winacl
+        )
+        signal.signal(signal.SIGTERM, job.stop)
+        signal.signal(signal.SIGINT, job.stop)
+        print job.run()
+        return
+
+    context = daemon.DaemonContext(
+        working_directory='/',
+        umask=0o022,
+        pidfile=PidFile(PIDFILE),
+    )
+
+    with context:
+        set_proc_name('permission: %s' % path)
+        job = PermissionJob(
+            path, uid, gid, mode, exclude, workers=workers, winacl=winacl
+        )
+        signal.signal(signal.SIGTERM, job.stop)
+        job.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
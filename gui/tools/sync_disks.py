@@ -28,6 +28,7 @@
 import argparse
 import os
 import sys
+import time
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.join(HERE, ".."))
@@ -44,18 +45,57 @@ cache.get_apps()
 from freenasUI.middleware.notifier import notifier
 
 
+def show_plan(plan):
+    for disk in plan['create']:
+        print "create %s (identifier %s)" % (
+            disk.disk_name, disk.disk_identifier)
+    for disk, changes in plan['update']:
+        print "update %s: %s" % (disk.disk_name, ', '.join([
+            "%s %r -> %r" % (field, old, new)
+            for field, (old, new) in sorted(changes.items())
+        ]))
+    for disk in plan['delete']:
+        print "delete %s (identifier %s)" % (
+            disk.disk_name, disk.disk_identifier)
+    if not any(plan.values()):
+        print "nothing to do"
+
+
 def main():
     parser = argparse.ArgumentParser(description='Sync disks.')
     parser.add_argument('devs', metavar='N', type=str, nargs='*',
         help='device name(s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='report the identity probe latency of each disk')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='only show what would be changed in the database')
     args = parser.parse_args()
     _notifier = notifier()
+
+    if args.dry_run:
+        show_plan(_notifier.sync_disks_plan())
+        return
+
+    start = time.time()
+    times = {}
     if args.devs:
         for dev in args.devs:
             dev = dev.replace("/dev/", "")
-            _notifier.sync_disk(dev)
+            times.update(_notifier.sync_disk(dev) or {})
     else:
-        _notifier.sync_disks()
+        times = _notifier.sync_disks() or {}
+
+    if args.verbose:
+        for dev in sorted(times):
+            if times[dev] is None:
+                print "%-12s cached" % dev
+            else:
+                print "%-12s %8.3fs" % (dev, times[dev])
+        print "%d disk(s), %d probed, %.3fs total" % (
+            len(times),
+            len([t for t in times.values() if t is not None]),
+            time.time() - start,
+        )
 
 if __name__ == "__main__":
     main()
@@ -29,16 +29,18 @@
 from ctypes import cdll, byref, create_string_buffer
 from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
 import array
+import codecs
 import fcntl
+import itertools
 import logging
 import logging.config
 import os
 import pty
+import re
 import signal
 import select
 import struct
 import sys
-import SocketServer
 import termios
 import threading
 import time
@@ -52,10 +54,32 @@ sys.path.append('/usr/local/www')
 sys.path.append('/usr/local/www/freenasUI')
 
 from freenasUI.settings import LOGGING
+from freenasUI.common.unixrpc import (
+    PersistentUnixRPCHandler, ThreadingUnixRPCServer
+)
 
 log = logging.getLogger('tools.webshell')
 logging.config.dictConfig(LOGGING)
 
+SOCKFILE = '/var/run/webshell.sock'
+# Sessions not polled for this long are buried
+SESSION_TIMEOUT = 60
+
+# Runs of printable single width characters, written in one go
+RE_TEXT = re.compile(u'[\x20-\x7e\xa0-\u2e7f]+')
+# Complete CSI and ESC sequences, see Terminal.vt100_write
+RE_CSI = re.compile(u'\x1b\\[([\x30-\x3f]*)([\x20-\x2f]*)([\x40-\x7e])')
+RE_ESC = re.compile(u'\x1b([\x20-\x2f]*)([\x30-\x5a\x5c-\x7e])')
+# Characters outside the BMP are not displayed
+if sys.maxunicode > 0xffff:
+    RE_NON_BMP = re.compile(u'[\U00010000-\U0010ffff]')
+else:
+    RE_NON_BMP = re.compile(u'[\ud800-\udfff]')
+
+codecs.register_error(
+    'webshell', lambda e: (u'?' * (e.end - e.start), e.end)
+)
+
 
 def set_proc_name(newname):
     libc = cdll.LoadLibrary('libc.so.7')
@@ -64,23 +88,13 @@ def set_proc_name(newname):
     libc.setproctitle(byref(buff))
 
 
-class XMLRPCHandler(SocketServer.BaseRequestHandler):
-
-    def handle(self):
-        self.data = self.request.recv(1024).strip()
-        self.request.send(self.server.dispatcher._marshaled_dispatch(
-            self.data
-        ))
-
-
 def main_loop():
     set_proc_name('webshelld')
 
     dispatcher = SimpleXMLRPCDispatcher()
-    SOCKFILE = '/var/run/webshell.sock'
     if os.path.exists(SOCKFILE):
         os.unlink(SOCKFILE)
-    server = SocketServer.UnixStreamServer(SOCKFILE, XMLRPCHandler)
+    server = ThreadingUnixRPCServer(SOCKFILE, PersistentUnixRPCHandler)
     os.chmod(SOCKFILE, 0o700)
     dispatcher.register_instance(
         Multiplex("/usr/local/bin/bash", "xterm-color"))
@@ -147,6 +161,9 @@ class Terminal:
     def __init__(self, w, h):
         self.w = w
         self.h = h
+        # Dump revision, bumped whenever a dump renders changed rows.
+        # It survives resets so clients never see it going backwards.
+        self.rev = 0
         self.vt100_charset_graph = [
             0x25ca, 0x2026, 0x2022, 0x3f,
             0xb6, 0x3f, 0xb0, 0xb1,
@@ -289,10 +306,8 @@ class Terminal:
         #   F:  Foreground
         #   B:  Background
         self.attr = 0x00fe0000
-        # UTF-8 decoder
-        self.utf8_units_count = 0
-        self.utf8_units_received = 0
-        self.utf8_char = 0
+        # UTF-8 decoder, incomplete sequence from the previous write
+        self.utf8_pending = ''
         # Key filter
         self.vt100_keyfilter_escape = False
         # Last char
@@ -304,8 +319,6 @@ class Terminal:
         self.vt100_parse_param = ""
         # Buffers
         self.vt100_out = ""
-        # Caches
-        self.dump_cache = ""
         # Invoke other resets
         self.reset_screen()
         self.reset_soft()
@@ -345,9 +358,9 @@ class Terminal:
         self.esc_DECSC()
 
     def reset_screen(self):
-        # Screen
-        self.screen = array.array('i', [self.attr | 0x20] * self.w * self.h)
-        self.screen2 = array.array('i', [self.attr | 0x20] * self.w * self.h)
+        # Screen, one array of cells per row
+        self.screen = [self.blank_row() for y in range(self.h)]
+        self.screen2 = [self.blank_row() for y in range(self.h)]
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
@@ -356,41 +369,35 @@ class Terminal:
         self.cy = 0
         # Tab stops
         self.tab_stops = range(0, self.w, 8)
+        # Dump state, every row is rendered again on the next dump
+        self.dirty = set(range(self.h))
+        self.row_rev = [0] * self.h
+        self.row_html = [u''] * self.h
+        self.dump_cursor = None
+        self.dump_inverse = None
 
     # UTF-8 functions
     def utf8_decode(self, d):
-        o = ''
-        for c in d:
-            char = ord(c)
-            if self.utf8_units_count != self.utf8_units_received:
-                self.utf8_units_received += 1
-                if (char & 0xc0) == 0x80:
-                    self.utf8_char = (self.utf8_char << 6) | (char & 0x3f)
-                    if self.utf8_units_count == self.utf8_units_received:
-                        if self.utf8_char < 0x10000:
-                            o += unichr(self.utf8_char)
-                        self.utf8_units_count = self.utf8_units_received = 0
-                else:
-                    o += '?'
-                    while self.utf8_units_received:
-                        o += '?'
-                        self.utf8_units_received -= 1
-                    self.utf8_units_count = 0
+        d = self.utf8_pending + d
+        # Keep an incomplete trailing sequence for the next write
+        self.utf8_pending = ''
+        for i in range(1, min(4, len(d)) + 1):
+            char = ord(d[-i])
+            if (char & 0xc0) == 0x80:
+                continue
+            if (char & 0xe0) == 0xc0:
+                units = 2
+            elif (char & 0xf0) == 0xe0:
+                units = 3
+            elif (char & 0xf8) == 0xf0:
+                units = 4
             else:
-                if (char & 0x80) == 0x00:
-                    o += c
-                elif (char & 0xe0) == 0xc0:
-                    self.utf8_units_count = 1
-                    self.utf8_char = char & 0x1f
-                elif (char & 0xf0) == 0xe0:
-                    self.utf8_units_count = 2
-                    self.utf8_char = char & 0x0f
-                elif (char & 0xf8) == 0xf0:
-                    self.utf8_units_count = 3
-                    self.utf8_char = char & 0x07
-                else:
-                    o += '?'
-        return o
+                units = 1
+            if units > i:
+                self.utf8_pending = d[-i:]
+                d = d[:-i]
+            break
+        return RE_NON_BMP.sub(u'', d.decode('utf-8', 'webshell'))
 
     def utf8_charwidth(self, char):
         if char >= 0x2e80:
@@ -399,16 +406,39 @@ class Terminal:
             return 1
 
     # Low-level terminal functions
+    def blank_row(self):
+        return array.array('i', [self.attr | 0x20]) * self.w
+
     def peek(self, y0, x0, y1, x1):
-        return self.screen[self.w * y0 + x0:self.w * (y1 - 1) + x1]
+        if y1 - y0 == 1:
+            return self.screen[y0][x0:x1]
+        # Cells in reading order, as if the screen were a single array
+        y0, x0 = divmod(self.w * y0 + x0, self.w)
+        y1, x1 = divmod(self.w * (y1 - 1) + x1, self.w)
+        if y0 == y1:
+            return self.screen[y0][x0:x1]
+        s = self.screen[y0][x0:]
+        for y in range(y0 + 1, min(y1, self.h)):
+            s += self.screen[y]
+        if y1 < self.h:
+            s += self.screen[y1][:x1]
+        return s
 
     def poke(self, y, x, s):
-        pos = self.w * y + x
-        self.screen[pos:pos + len(s)] = s
+        y, x = divmod(self.w * y + x, self.w)
+        i = 0
+        while i < len(s) and y < self.h:
+            n = min(len(s) - i, self.w - x)
+            self.screen[y][x:x + n] = s[i:i + n]
+            self.dirty.add(y)
+            i += n
+            y += 1
+            x = 0
 
     def fill(self, y0, x0, y1, x1, char):
         n = self.w * (y1 - y0 - 1) + (x1 - x0)
-        self.poke(y0, x0, array.array('i', [char] * n))
+        if n > 0:
+            self.poke(y0, x0, array.array('i', [char]) * n)
 
     def clear(self, y0, x0, y1, x1):
         self.fill(y0, x0, y1, x1, self.attr | 0x20)
@@ -416,13 +446,19 @@ class Terminal:
     # Scrolling functions
     def scroll_area_up(self, y0, y1, n=1):
         n = min(y1 - y0, n)
-        self.poke(y0, 0, self.peek(y0 + n, 0, y1, self.w))
-        self.clear(y1 - n, 0, y1, self.w)
+        if n <= 0:
+            return
+        del self.screen[y0:y0 + n]
+        self.screen[y1 - n:y1 - n] = [self.blank_row() for i in range(n)]
+        self.dirty.update(range(y0, y1))
 
     def scroll_area_down(self, y0, y1, n=1):
         n = min(y1 - y0, n)
-        self.poke(y0 + n, 0, self.peek(y0, 0, y1 - n, self.w))
-        self.clear(y0, 0, y0 + n, self.w)
+        if n <= 0:
+            return
+        del self.screen[y1 - n:y1]
+        self.screen[y0:y0] = [self.blank_row() for i in range(n)]
+        self.dirty.update(range(y0, y1))
 
     def scroll_area_set(self, y0, y1):
         y0 = max(0, min(self.h - 1, y0))
@@ -445,12 +481,11 @@ class Terminal:
 
     # Cursor functions
     def cursor_line_width(self, next_char):
-        wx = self.utf8_charwidth(next_char)
-        lx = 0
-        for x in range(min(self.cx, self.w)):
-            char = self.peek(self.cy, x, self.cy + 1, x + 1)[0] & 0xffff
-            wx += self.utf8_charwidth(char)
-            lx += 1
+        lx = min(self.cx, self.w)
+        wx = self.utf8_charwidth(next_char) + lx
+        for d in itertools.islice(self.screen[self.cy], lx):
+            if (d & 0xffff) >= 0x2e80:
+                wx += 1
         return wx, lx
 
     def cursor_up(self, n=1):
@@ -536,9 +571,44 @@ class Terminal:
             self.vt100_charset_is_single_shift = False
         elif self.vt100_charset_is_graphical and (char & 0xffe0) == 0x0060:
             char = self.vt100_charset_graph[char - 0x60]
-        self.poke(self.cy, self.cx, array.array('i', [self.attr | char]))
+        self.screen[self.cy][self.cx] = self.attr | char
+        self.dirty.add(self.cy)
         self.cursor_set_x(self.cx + 1)
 
+    def dumb_echo_run(self, s):
+        """
+        Echo a run of printable single width characters, copying as many
+        of them as fit on the current line at once.
+        """
+        if self.vt100_mode_insert or not self.vt100_mode_autowrap:
+            for c in s:
+                self.dumb_echo(ord(c))
+            return
+        if self.vt100_charset_is_single_shift:
+            self.dumb_echo(ord(s[0]))
+            s = s[1:]
+        attr = self.attr
+        if self.vt100_charset_is_graphical:
+            graph = self.vt100_charset_graph
+            cells = array.array('i', [
+                attr | (graph[c - 0x60] if (c & 0xffe0) == 0x0060 else c)
+                for c in map(ord, s)
+            ])
+        else:
+            cells = array.array('i', [attr | c for c in map(ord, s)])
+        i = 0
+        while i < len(cells):
+            wx, cx = self.cursor_line_width(cells[i] & 0xffff)
+            if wx > self.w:
+                self.ctrl_CR()
+                self.ctrl_LF()
+                continue
+            n = min(len(cells) - i, self.w - wx + 1)
+            self.screen[self.cy][self.cx:self.cx + n] = cells[i:i + n]
+            self.dirty.add(self.cy)
+            self.cursor_set_x(self.cx + n)
+            i += n
+
     # VT100 CTRL, ESC, CSI handlers
     def vt100_charset_update(self):
         self.vt100_charset_is_graphical = (
@@ -599,6 +669,7 @@ class Terminal:
                 if ((state and not self.vt100_mode_alt_screen) or
                         (not state and self.vt100_mode_alt_screen)):
                     self.screen, self.screen2 = self.screen2, self.screen
+                    self.dirty.update(range(self.h))
                     self.vt100_saved, self.vt100_saved2 = self.vt100_saved2, \
                         self.vt100_saved
                 self.vt100_mode_alt_screen = state
@@ -1147,14 +1218,38 @@ class Terminal:
 
     def write(self, d):
         d = self.utf8_decode(d)
-        for c in d:
-            char = ord(c)
+        i = 0
+        while i < len(d):
+            if not self.vt100_parse_state:
+                # Fast paths for text and complete escape sequences
+                m = RE_TEXT.match(d, i)
+                if m:
+                    self.dumb_echo_run(m.group())
+                    self.vt100_lastchar = ord(d[m.end() - 1])
+                    i = m.end()
+                    continue
+                m = RE_CSI.match(d, i)
+                if m and m.end() - i <= 34:
+                    self.vt100_parse_reset('csi')
+                    self.vt100_parse_param = m.group(1)
+                    self.vt100_parse_func = m.group(2) + m.group(3)
+                    self.vt100_parse_process()
+                    i = m.end()
+                    continue
+                m = RE_ESC.match(d, i)
+                if m and m.end() - i <= 33:
+                    self.vt100_parse_reset('esc')
+                    self.vt100_parse_func = m.group(1) + m.group(2)
+                    self.vt100_parse_process()
+                    i = m.end()
+                    continue
+            char = ord(d[i])
+            i += 1
             if self.vt100_write(char):
                 continue
             if self.dumb_write(char):
                 continue
-            if char <= 0xffff:
-                self.dumb_echo(char)
+            self.dumb_echo(char)
         return True
 
     def pipe(self, d):
@@ -1183,64 +1278,99 @@ class Terminal:
                     o += chr(10)
         return o
 
-    def dump(self):
-        dump = u""
-        attr_ = -1
-        cx, cy = min(self.cx, self.w - 1), self.cy
-        for y in range(0, self.h):
-            wx = 0
-            for x in range(0, self.w):
-                d = self.screen[y * self.w + x]
-                char = d & 0xffff
-                attr = d >> 16
-                # Cursor
-                if cy == y and cx == x and self.vt100_mode_cursor:
-                    attr = attr & 0xfff0 | 0x000c
-                # Attributes
-                if attr != attr_:
-                    if attr_ != -1:
-                        dump += u'</span>'
-                    bg = attr & 0x000f
-                    fg = (attr & 0x00f0) >> 4
-                    # Inverse
-                    inv = attr & 0x0200
-                    inv2 = self.vt100_mode_inverse
-                    if (inv and not inv2) or (inv2 and not inv):
-                        fg, bg = bg, fg
-                    # Concealed
-                    if attr & 0x0400:
-                        fg = 0xc
-                    # Underline
-                    if attr & 0x0100:
-                        ul = ' ul'
-                    else:
-                        ul = ''
-                    dump += u'<span class="shell_f%x shell_b%x%s">' % (
-                        fg,
-                        bg,
-                        ul)
-                    attr_ = attr
-                # Escape HTML characters
-                if char == 38:
-                    dump += '&amp;'
-                elif char == 60:
-                    dump += '&lt;'
-                elif char == 62:
-                    dump += '&gt;'
-                else:
-                    wx += self.utf8_charwidth(char)
-                    if wx <= self.w:
-                        dump += unichr(char)
-            dump += "\n"
-        # Encode in UTF-8
-        dump = dump.encode('utf-8')
-        dump += '</span>'
-        # Cache dump
-        if self.dump_cache == dump:
-            return ''
+    def changed(self, rev):
+        """
+        Whether a dump for a client at revision ``rev`` has anything new
+        """
+        return bool(self.dirty) or self.rev > rev
+
+    def dump_span(self, attr):
+        bg = attr & 0x000f
+        fg = (attr & 0x00f0) >> 4
+        # Inverse
+        inv = attr & 0x0200
+        inv2 = self.vt100_mode_inverse
+        if (inv and not inv2) or (inv2 and not inv):
+            fg, bg = bg, fg
+        # Concealed
+        if attr & 0x0400:
+            fg = 0xc
+        # Underline
+        if attr & 0x0100:
+            ul = ' ul'
         else:
-            self.dump_cache = dump
-            return '<c cy="%03d" />' % cy + dump
+            ul = ''
+        return u'<span class="shell_f%x shell_b%x%s">' % (fg, bg, ul)
+
+    def dump_row(self, y):
+        row = self.screen[y]
+        if self.dump_cursor is not None and self.dump_cursor[0] == y:
+            cx = self.dump_cursor[1]
+            row = row[:]
+            row[cx] = row[cx] & ~0x000f0000 | 0x000c0000
+        wide = any((d & 0xffff) >= 0x2e80 for d in row)
+        dump = []
+        wx = 0
+        for attr, cells in itertools.groupby(row, lambda d: d >> 16):
+            text = u''.join([unichr(d & 0xffff) for d in cells])
+            if wide:
+                # Wide characters take two columns, drop what does not fit
+                chars = []
+                for c in text:
+                    if c not in u'&<>':
+                        wx += self.utf8_charwidth(ord(c))
+                        if wx > self.w:
+                            continue
+                    chars.append(c)
+                text = u''.join(chars)
+            # Escape HTML characters
+            text = text.replace(u'&', u'&amp;').replace(
+                u'<', u'&lt;').replace(u'>', u'&gt;')
+            dump.append(self.dump_span(attr))
+            dump.append(text)
+            dump.append(u'</span>')
+        return u''.join(dump)
+
+    def dump(self, rev=0):
+        """
+        Render the rows changed since revision ``rev``
+
+        Only rows touched since the previous dump are rendered again,
+        a client passing the ``rev`` it got back last time receives
+        just the rows that changed in between (all of them for 0).
+        """
+        if rev > self.rev:
+            # Client saw an older incarnation of this session
+            rev = 0
+        if self.vt100_mode_cursor:
+            cursor = (self.cy, min(self.cx, self.w - 1))
+        else:
+            cursor = None
+        if cursor != self.dump_cursor:
+            for c in (self.dump_cursor, cursor):
+                if c is not None:
+                    self.dirty.add(c[0])
+            self.dump_cursor = cursor
+        if self.vt100_mode_inverse != self.dump_inverse:
+            self.dirty.update(range(self.h))
+            self.dump_inverse = self.vt100_mode_inverse
+        if self.dirty:
+            self.rev += 1
+            for y in self.dirty:
+                self.row_html[y] = self.dump_row(y)
+                self.row_rev[y] = self.rev
+            self.dirty.clear()
+        rows = {}
+        for y in range(self.h):
+            if self.row_rev[y] > rev:
+                rows[str(y)] = self.row_html[y]
+        return {
+            'rev': self.rev,
+            'cy': self.cy,
+            'w': self.w,
+            'h': self.h,
+            'rows': rows,
+        }
 
 
 class SynchronizedMethod:
@@ -1268,16 +1398,23 @@ class Multiplex:
         self.env_term = env_term
         # Synchronize methods
         self.lock = threading.RLock()
+        # Signaled whenever a terminal receives output
+        self.output = threading.Condition(self.lock)
         for name in [
             'proc_keepalive',
             'proc_buryall',
             'proc_read',
             'proc_write',
             'proc_dump',
+            'proc_session',
             'proc_getalive'
         ]:
             orig = getattr(self, name)
             setattr(self, name, SynchronizedMethod(self.lock, orig))
+        # Self-pipe to wake the supervisor when the set of fds changes
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
         # Supervisor thread
         self.signal_stop = 0
         self.thread = threading.Thread(target=self.proc_thread)
@@ -1286,8 +1423,16 @@ class Multiplex:
     def stop(self):
         # Stop supervisor thread
         self.signal_stop = 1
+        self.proc_wakeup()
         self.thread.join()
 
+    def proc_wakeup(self):
+        try:
+            os.write(self.wakeup_w, '.')
+        except (IOError, OSError):
+            # Pipe full, the supervisor is going to wake up anyway
+            pass
+
     def proc_keepalive(self, sid, jid, shell, w, h):
         if not sid in self.session:
             if not shell:
@@ -1377,6 +1522,7 @@ class Multiplex:
             # Store session vars
             self.session[sid]['pid'] = pid
             self.session[sid]['fd'] = fd
+            self.proc_wakeup()
             # Set file control
             fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
             # Set terminal size
@@ -1390,6 +1536,7 @@ class Multiplex:
             return True
 
     def proc_waitfordeath(self, sid):
+        self.output.notify_all()
 
         try:
             os.close(self.session[sid]['fd'])
@@ -1442,6 +1589,7 @@ class Multiplex:
             return False
         term = self.session[sid]['term']
         term.write(d)
+        self.output.notify_all()
         # Read terminal response
         d = term.read()
         if d:
@@ -1468,40 +1616,78 @@ class Multiplex:
         return True
 
     # Dump terminal output
-    def proc_dump(self, sid):
+    def proc_dump(self, sid, rev=0):
         if sid not in self.session:
             return False
-        return self.session[sid]['term'].dump()
+        return self.session[sid]['term'].dump(rev)
+
+    # Keepalive, write and dump in a single round trip
+    def proc_session(self, sid, jid, shell, w, h, d, rev, wait):
+        """
+        Keep the session alive, send the keys in ``d`` and return the rows
+        changed since ``rev``.
+
+        If nothing changed yet, wait up to ``wait`` seconds for the
+        process to produce output so that the echo of the keys comes back
+        in the same response.
+        """
+        if not self.proc_keepalive(sid, jid, shell, w, h):
+            return False
+        if d.data and not self.proc_write(sid, d):
+            return False
+        term = self.session[sid]['term']
+        deadline = time.time() + wait
+        while not term.changed(rev):
+            timeout = deadline - time.time()
+            if timeout <= 0 or self.session.get(sid, {}).get(
+                'state'
+            ) != 'alive':
+                break
+            self.output.wait(timeout)
+        return self.proc_dump(sid, rev)
 
     # Get alive sessions, bury timed out ones
     def proc_getalive(self):
         fds = []
         fd2sid = {}
+        timeout = None
         now = time.time()
         for sid in self.session.keys():
-            then = self.session[sid]['time']
-            if (now - then) > 60:
+            left = SESSION_TIMEOUT - (now - self.session[sid]['time'])
+            if left < 0:
                 self.proc_bury(sid)
             else:
                 if self.session[sid]['state'] == 'alive':
                     fds.append(self.session[sid]['fd'])
                     fd2sid[self.session[sid]['fd']] = sid
-        return (fds, fd2sid)
+                if timeout is None or left < timeout:
+                    timeout = left
+        return (fds, fd2sid, timeout)
 
     # Supervisor thread
     def proc_thread(self):
+        """
+        Block until a shell has output, a session is spawned or the next
+        session is due to time out; idle sessions cost nothing.
+        """
         while not self.signal_stop:
-            # Read fds
-            (fds, fd2sid) = self.proc_getalive()
+            (fds, fd2sid, timeout) = self.proc_getalive()
             try:
-                i, o, e = select.select(fds, [], [], 1.0)
-            except (IOError, OSError):
+                i, o, e = select.select(
+                    fds + [self.wakeup_r], [], [], timeout
+                )
+            except (IOError, OSError, select.error):
                 i = []
             for fd in i:
+                if fd == self.wakeup_r:
+                    try:
+                        while os.read(self.wakeup_r, 512):
+                            pass
+                    except (IOError, OSError):
+                        pass
+                    continue
                 sid = fd2sid[fd]
                 self.proc_read(sid)
-            if len(i):
-                time.sleep(0.002)
         self.proc_buryall()
 
 if __name__ == '__main__':
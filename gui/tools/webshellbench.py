@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Replay terminal streams through the webshell Terminal and report the
+throughput of Terminal.write and Terminal.dump.
+
+Streams are raw terminal output, e.g. captured with
+
+    script -q /tmp/zpool.cap zpool status -v
+
+Without any file a set of synthetic streams is used (plain log lines,
+colored output, full screen redraws and UTF-8 text).
+"""
+import getopt
+import os
+import sys
+import time
+
+from webshell import Terminal
+
+
+def synthetic_streams():
+    log = ''.join([
+        'da%d: <ATA ST4000DM000-1F2168 CC52> Fixed Direct Access SCSI-6 '
+        'device\r\n' % (i % 16) for i in range(4000)
+    ])
+    color = ''.join([
+        '\t  \x1b[1mgptid/%08x-aa1e-11e3-8f3c-002590f5b3e%d\x1b[0m  '
+        '\x1b[32mONLINE\x1b[0m       0     0     %d\r\n' % (i, i % 10, i % 3)
+        for i in range(4000)
+    ])
+    screen = ''.join([
+        '\x1b[H\x1b[2J' + ''.join([
+            '\x1b[%d;1H%5d root        1  20    0 %6dK %5dK select  %d   '
+            '0:%02d  0.00%% \x1b[7mnginx\x1b[m' % (
+                y + 1, 1000 + y, 10000 + n, 2000 + y, y % 4, n % 60)
+            for y in range(24)
+        ]) for n in range(200)
+    ])
+    utf8 = ''.join([
+        u'%d: r\xe9sum\xe9 \u2013 \xfcber \u2713 \u65e5\u672c\u8a9e '
+        u'\u2500\u2500\u2500\u2500\r\n'.encode('utf-8') % i
+        for i in range(4000)
+    ])
+    return [
+        ('log', log),
+        ('color', color),
+        ('screen', screen),
+        ('utf8', utf8),
+    ]
+
+
+def replay(data, w, h, chunk):
+    """
+    Feed data to a new Terminal ``chunk`` bytes at a time, dumping the
+    changed rows after each chunk like a polling client would.
+    """
+    term = Terminal(w, h)
+    rev = 0
+    twrite = tdump = 0.0
+    for i in range(0, len(data), chunk):
+        t0 = time.time()
+        term.write(data[i:i + chunk])
+        t1 = time.time()
+        rev = term.dump(rev)['rev']
+        t2 = time.time()
+        twrite += t1 - t0
+        tdump += t2 - t1
+    return twrite, tdump
+
+
+def usage():
+    print >> sys.stderr, (
+        "Usage: %s [-n rounds] [-s WxH] [-c chunk] [file ...]" % (
+            os.path.basename(sys.argv[0]),
+        )
+    )
+    sys.exit(1)
+
+
+def main(argv):
+    rounds = 3
+    w, h = 80, 24
+    chunk = 4096
+
+    try:
+        opts, args = getopt.getopt(argv, "n:s:c:")
+    except getopt.GetoptError:
+        usage()
+
+    try:
+        for opt, arg in opts:
+            if opt == '-n':
+                rounds = int(arg)
+            elif opt == '-s':
+                w, h = map(int, arg.split('x'))
+            elif opt == '-c':
+                chunk = int(arg)
+    except ValueError:
+        usage()
+
+    if args:
+        streams = []
+        for path in args:
+            with open(path, 'rb') as f:
+                streams.append((os.path.basename(path), f.read()))
+    else:
+        streams = synthetic_streams()
+
+    print "%-12s %10s %10s %10s %10s" % (
+        'stream', 'bytes', 'write s', 'dump s', 'KiB/s')
+    for name, data in streams:
+        best = None
+        for i in range(rounds):
+            twrite, tdump = replay(data, w, h, chunk)
+            if best is None or twrite + tdump < sum(best):
+                best = (twrite, tdump)
+        twrite, tdump = best
+        print "%-12s %10d %10.3f %10.3f %10.1f" % (
+            name,
+            len(data),
+            twrite,
+            tdump,
+            len(data) / 1024.0 / max(twrite + tdump, 1e-6),
+        )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+zfsstated - keeps the ZFS dataset/snapshot/property tree in memory
+
+The index is loaded once at startup and then kept up to date from:
+  - explicit invalidations sent by the middleware after its own changes
+  - new records in ``zpool history -i``
+  - a periodic refresh of dataset space accounting
+  - a full rebuild every REBUILD_INTERVAL seconds as a safety net
+"""
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
+import fcntl
+import logging
+import logging.config
+import os
+import sys
+import threading
+import time
+
+import daemon
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+from freenasUI.settings import LOGGING
+from freenasUI.common.unixrpc import UnixRPCHandler, ThreadingUnixRPCServer
+from freenasUI.middleware.zfsstate import SOCKFILE, ZFSIndex
+
+log = logging.getLogger('tools.zfsstate')
+logging.config.dictConfig(LOGGING)
+
+PIDFILE = '/var/run/zfsstate.pid'
+
+DATASETS_INTERVAL = 30
+HISTORY_INTERVAL = 60
+REBUILD_INTERVAL = 3600
+
+
+def set_proc_name(newname):
+    from ctypes import cdll, byref, create_string_buffer
+    libc = cdll.LoadLibrary('libc.so.7')
+    buff = create_string_buffer(len(newname) + 1)
+    buff.value = newname
+    libc.setproctitle(byref(buff))
+
+
+class ZFSStateService(object):
+    """
+    Methods exported over XML-RPC
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def ping(self):
+        return self.index.generation
+
+    def datasets(self, path, recursive, types):
+        return self.index.datasets(path, recursive=recursive, types=types)
+
+    def snapshots(self, path, recursive):
+        return self.index.snapshots(path, recursive=recursive)
+
+    def query_snapshots(self, query):
+        total, rows = self.index.query_snapshots(**query)
+        return {'total': total, 'rows': rows}
+
+    def properties(self, name, recursive, props):
+        return self.index.properties(name, recursive=recursive, props=props)
+
+    def invalidate(self, name, recursive):
+        self.index.rescan(name, recursive=recursive)
+        return True
+
+    def stats(self):
+        return self.index.summary()
+
+
+class Refresher(threading.Thread):
+
+    def __init__(self, index, *args, **kwargs):
+        self.index = index
+        super(Refresher, self).__init__(*args, **kwargs)
+        self.daemon = True
+
+    def run(self):
+        last_datasets = last_history = last_rebuild = time.time()
+        while True:
+            time.sleep(1)
+            now = time.time()
+            try:
+                if now - last_rebuild > REBUILD_INTERVAL:
+                    self.index.rebuild()
+                    last_rebuild = last_datasets = last_history = now
+                    continue
+                if now - last_history > HISTORY_INTERVAL:
+                    self.index.poll_history()
+                    last_history = now
+                if now - last_datasets > DATASETS_INTERVAL:
+                    self.index.refresh_datasets()
+                    last_datasets = now
+            except Exception, e:
+                log.error("Failed to refresh ZFS index: %s", e)
+
+
+def main_loop():
+    set_proc_name('zfsstated')
+
+    index = ZFSIndex()
+    index.rebuild()
+    Refresher(index).start()
+
+    dispatcher = SimpleXMLRPCDispatcher(allow_none=False, encoding=None)
+    if os.path.exists(SOCKFILE):
+        os.unlink(SOCKFILE)
+    server = ThreadingUnixRPCServer(SOCKFILE, UnixRPCHandler)
+    os.chmod(SOCKFILE, 0o700)
+    dispatcher.register_instance(ZFSStateService(index))
+    server.dispatcher = dispatcher
+    server.serve_forever()
+
+
+class PidFile(object):
+    """
+    Context manager that locks a pid file (see tools/webshell.py)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pidfile = None
+
+    def __enter__(self):
+        self.pidfile = open(self.path, "a+")
+        try:
+            fcntl.flock(self.pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise SystemExit("Already running according to " + self.path)
+        self.pidfile.seek(0)
+        self.pidfile.truncate()
+        self.pidfile.write(str(os.getpid()))
+        self.pidfile.flush()
+        self.pidfile.seek(0)
+        return self.pidfile
+
+    def __exit__(self, *args, **kwargs):
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.pidfile.close()
+        except IOError:
+            pass
+
+
+def main(argv):
+    if argv and argv[0] == '-f':
+        main_loop()
+        return
+
+    context = daemon.DaemonContext(
+        working_directory='/',
+        umask=0o022,
+        pidfile=PidFile(PIDFILE),
+        stdout=sys.stdout,
+        stdin=sys.stdin,
+        stderr=sys.stderr,
+    )
+
+    with context:
+        main_loop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,7 +37,7 @@ from freenasUI.api import v1_api
 from freenasUI.api.resources import (
     AdminPasswordResource, AdminUserResource,
     AlertResource,
-    RebootResource, ShutdownResource,
+    RebootResource, ReportingExportResource, ShutdownResource,
     SnapshotResource
 )
 from freenasUI.freeadmin.site import site
@@ -51,10 +51,12 @@ v1_api.register(AdminPasswordResource())
 v1_api.register(AdminUserResource())
 v1_api.register(AlertResource())
 v1_api.register(RebootResource())
+v1_api.register(ReportingExportResource())
 v1_api.register(ShutdownResource())
 v1_api.register(SnapshotResource())
 
 navtree.prepare_modelforms()
+navtree.connect_signals()
 freeadmin.autodiscover()
 
 add_to_builtins('django.templatetags.i18n')
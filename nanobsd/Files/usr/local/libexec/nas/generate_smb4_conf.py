@@ -1,5 +1,6 @@
 #!/usr/local/bin/python
 
+import contextlib
 import os
 import re
 import sys
@@ -17,12 +18,11 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "freenasUI.settings"
 from django.db.models.loading import cache
 cache.get_apps()
 
-from django.db.models import Q
-
 from freenasUI.account.models import bsdUsers
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.samba import Samba4
 from freenasUI.common.system import get_samba4_path
+from freenasUI.middleware import zfsstate
 from freenasUI.middleware.notifier import notifier
 from freenasUI.services.models import (
     services,
@@ -38,34 +38,85 @@ from freenasUI.storage.models import Task
 from freenasUI.system.models import Settings
 
 
-def is_within_zfs(mountpoint):
-    try:
-        st = os.stat(mountpoint)
-    except:
-        return False
+class StageTimer(object):
+    """
+    Wall clock time spent in each stage of the generation
+    """
 
-    share_dev = st.st_dev
-    p = pipeopen("zfs list -H -o mountpoint")
-    zfsout = p.communicate()
-    if p.returncode != 0:
-        return False
-    if zfsout:
-        zfsout = zfsout[0]
-
-    for mp in zfsout.split('\n'):
-        mp = mp.strip()
-        if mp == '-':
-            continue
+    def __init__(self):
+        self.stages = []
 
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.time()
         try:
-            st = os.stat(mp)
-        except:
-            continue
+            yield
+        finally:
+            self.stages.append((name, time.time() - start))
+
+    def report(self, f):
+        for name, elapsed in self.stages:
+            print >> f, "%-12s %8.3fs" % (name, elapsed)
+        print >> f, "%-12s %8.3fs" % (
+            "total", sum([elapsed for name, elapsed in self.stages]))
+
+
+class ZFSMountpoints(object):
+    """
+    Mounted ZFS filesystems and periodic snapshot tasks, loaded once so
+    every share is looked up without running zfs or querying the
+    database again.
+    """
+
+    def __init__(self):
+        self.datasets = {}
+        self.devices = set()
+        for row in zfsstate.dataset_rows(types='filesystem'):
+            name, mountpoint = row[0], row[5]
+            if not mountpoint.startswith('/'):
+                # -, none, legacy
+                continue
+            self.datasets[mountpoint.rstrip('/') or '/'] = name
+            try:
+                self.devices.add(os.stat(mountpoint).st_dev)
+            except OSError:
+                pass
 
-        if st.st_dev == share_dev:
-            return True
+        self.tasks = {}
+        self.recursive_tasks = {}
+        for task in Task.objects.order_by('id'):
+            self.tasks.setdefault(task.task_filesystem, task)
+            if task.task_recursive:
+                self.recursive_tasks.setdefault(task.task_filesystem, task)
+
+    def mounts(self, path):
+        """
+        (mountpoint, dataset) of the filesystems containing ``path``,
+        the one it lives in first.
+        """
+        while True:
+            if path in self.datasets:
+                yield path, self.datasets[path]
+            if path == '/':
+                break
+            path = os.path.dirname(path)
+
+    def snapshot_task(self, path):
+        path = os.path.normpath(path)
+        for mountpoint, dataset in self.mounts(path):
+            if path == mountpoint:
+                task = self.tasks.get(dataset)
+            else:
+                task = self.recursive_tasks.get(dataset)
+            if task:
+                return task
+        return False
 
-    return False
+    def is_within_zfs(self, path):
+        try:
+            return os.stat(path).st_dev in self.devices
+        except OSError:
+            return False
 
 
 def get_server_services():
@@ -478,27 +529,14 @@ def generate_smb4_shares(smb4_shares):
     if len(shares) == 0:
         return
 
-    p = pipeopen("zfs list -H -o mountpoint,name")
-    zfsout = p.communicate()[0].split('\n')
-    if p.returncode != 0:
-        zfsout = []
+    mounts = ZFSMountpoints()
+    _n = notifier()
 
     for share in shares:
         if not os.path.isdir(share.cifs_path):
             continue
 
-        task = False
-        for line in zfsout:
-            try:
-                zfs_mp, zfs_ds = line.split()
-                if share.cifs_path == zfs_mp or share.cifs_path.startswith("%s/" % zfs_mp):
-                    if share.cifs_path == zfs_mp:
-                        task = Task.objects.filter(task_filesystem = zfs_ds)[0]
-                    else:
-                        task = Task.objects.filter(Q(task_filesystem = zfs_ds) & Q(task_recursive=True))[0]
-                    break
-            except:
-                pass
+        task = mounts.snapshot_task(share.cifs_path)
 
         confset1(smb4_shares, "\n")
         confset2(smb4_shares, "[%s]", share.cifs_name.encode('utf8'), space=0)
@@ -511,7 +549,7 @@ def generate_smb4_shares(smb4_shares):
         confset2(smb4_shares, "browseable = %s",
             "yes" if share.cifs_browsable else "no")
 
-        if notifier().get_dataset_share_type(
+        if _n.get_dataset_share_type(
             share.cifs_path.replace("/mnt/", "", 1)) != "windows":
             confset2(smb4_shares, "inherit owner = %s",
                 "yes" if share.cifs_inheritowner else "no")
@@ -523,7 +561,7 @@ def generate_smb4_shares(smb4_shares):
             vfs_objects.append('recycle')
         if task:
             vfs_objects.append('shadow_copy2')
-        if is_within_zfs(share.cifs_path):
+        if mounts.is_within_zfs(share.cifs_path):
             vfs_objects.append('zfsacl')
         vfs_objects.append('streams_xattr')
         vfs_objects.append('aio_pthread')
@@ -612,8 +650,8 @@ def smb4_setup():
     smb4_mkdir("/var/etc/private")
     os.chmod("/var/etc/private", 0700)
 
+    # smb4.conf is only replaced by main() if it has changed
     smb4_unlink("/usr/local/etc/smb.conf")
-    smb4_unlink("/usr/local/etc/smb4.conf")
 
     if hasattr(notifier, 'failover_status') and notifier().failover_status() == 'BACKUP':
         return
@@ -690,33 +728,58 @@ def do_migration(old_samba4_datasets):
     return True
 
 
+def write_if_changed(path, content):
+    """
+    Atomically replace ``path`` with ``content`` unless it already has
+    exactly that content. Returns whether the file was written.
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+
+    (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        os.write(fd, content)
+        os.fchmod(fd, 0644)
+    finally:
+        os.close(fd)
+    os.rename(tmpfile, path)
+    return True
+
+
 def main():
     smb_conf_path = "/usr/local/etc/smb4.conf"
+    timer = StageTimer()
 
     smb4_tdb = []
     smb4_conf = []
     smb4_shares = []
 
-    smb4_setup()
+    with timer("setup"):
+        smb4_setup()
 
-    old_samba4_datasets = get_old_samba4_datasets()
-    if migration_available(old_samba4_datasets):
-        do_migration(old_samba4_datasets)
+        old_samba4_datasets = get_old_samba4_datasets()
+        if migration_available(old_samba4_datasets):
+            do_migration(old_samba4_datasets)
 
-    generate_smb4_tdb(smb4_tdb)
-    generate_smb4_conf(smb4_conf)
-    generate_smb4_shares(smb4_shares)
+    with timer("tdb"):
+        generate_smb4_tdb(smb4_tdb)
+    with timer("global"):
+        generate_smb4_conf(smb4_conf)
+    with timer("shares"):
+        generate_smb4_shares(smb4_shares)
 
     role = get_server_role()
     if role == 'dc' and not Samba4().domain_provisioned():
-        provision_smb4()
+        with timer("provision"):
+            provision_smb4()
 
-    with open(smb_conf_path, "w") as f:
-        for line in smb4_conf:
-            f.write(line + '\n')
-        for line in smb4_shares:
-            f.write(line + '\n')
-        f.close()
+    with timer("write"):
+        content = ''.join([line + '\n' for line in smb4_conf + smb4_shares])
+        changed = write_if_changed(smb_conf_path, content)
 
     (fd, tmpfile) = tempfile.mkstemp(dir="/tmp")
     for line in smb4_tdb:
@@ -724,13 +787,19 @@ def main():
     os.close(fd)
 
     if role != 'dc':
-        p = pipeopen("/usr/local/bin/pdbedit -d 0 -i smbpasswd:%s -e %s -s %s" % (
-            tmpfile, "tdbsam:/var/etc/private/passdb.tdb", smb_conf_path))
-        out = p.communicate()
-        if out and out[1]:
-            for line in out[1].split('\n'):
-                print line
-        os.unlink(tmpfile)
+        with timer("pdbedit"):
+            p = pipeopen("/usr/local/bin/pdbedit -d 0 -i smbpasswd:%s -e %s -s %s" % (
+                tmpfile, "tdbsam:/var/etc/private/passdb.tdb", smb_conf_path))
+            out = p.communicate()
+            if out and out[1]:
+                for line in out[1].split('\n'):
+                    print line
+            os.unlink(tmpfile)
+
+    if '-t' in sys.argv[1:]:
+        timer.report(sys.stderr)
+        if not changed:
+            print >> sys.stderr, "%s unchanged" % smb_conf_path
 
 
 if __name__ == '__main__':